@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Benchmarks the burn rate collector's hot paths against synthetic offers,
+synthetic fleets and a local TCP stand-in for Grok.
+
+Each stage runs in its own process so that its peak RSS can be reported, and
+is timed over several iterations. Results may be saved as a baseline and later
+runs compared against it to flag regressions.
+"""
+
+import csv
+import json
+import multiprocessing
+import optparse
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import urllib
+import urllib2
+import xml.sax
+
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, _REPO_DIR)
+
+import price_table_builder
+from grok_transport import GrokTransport, SocketConnection
+from metric_batch import buildMetricBatch, formatGrokLines
+from metric_replay import replayHistory
+
+import synthetic_data
+
+
+
+# Recorded DescribeInstances pages parsed by the parseDescribeInstances stages
+_NUM_RECORDED_PAGES = 10
+_RECORDED_PAGE_SIZE = 1000
+
+
+class SkipStage(Exception):
+  """Raised by a stage whose dependencies are not available"""
+
+
+
+def _fileUrl(path):
+  return "file://" + urllib.pathname2url(os.path.abspath(path))
+
+
+
+def _timeIterations(fn, iterations):
+  """Call `fn` `iterations` times
+
+  :returns: list of durations in seconds
+  """
+  durations = []
+  for _ in xrange(iterations):
+    start = time.time()
+    fn()
+    durations.append(time.time() - start)
+  return durations
+
+
+
+def _loadPriceTable(context):
+  with open(context["binaryTablePath"], "rb") as fp:
+    return price_table_builder.loadBinary(fp)
+
+
+
+def _importCalculateBurnRate(context):
+  """Import calculate_burn_rate with the synthetic price table installed"""
+  try:
+    import calculate_burn_rate
+  except ImportError as e:
+    raise SkipStage("calculate_burn_rate unavailable: {}".format(e))
+
+  calculate_burn_rate._PriceTable._priceTableSingleton = (
+    _loadPriceTable(context))
+  return calculate_burn_rate
+
+
+
+def _generateFleet(context):
+  return synthetic_data.generateFleet(
+    context["numInstances"], list(_loadPriceTable(context)),
+    numRegions=context["numRegions"])
+
+
+
+def benchBuildLookupTable(context):
+  def run():
+    with open(context["offersPath"]) as fp:
+      price_table_builder.buildLookupTable(json.load(fp))
+
+  return _timeIterations(run, context["iterations"]), context["numSkus"]
+
+
+
+def benchBuildLookupTableFromStream(context):
+  def run():
+    price_table_builder.buildLookupTableFromStream(
+      urllib2.urlopen(_fileUrl(context["offersPath"])))
+
+  return _timeIterations(run, context["iterations"]), context["numSkus"]
+
+
+
+def benchLoadJson(context):
+  def run():
+    with open(context["jsonTablePath"]) as fp:
+      price_table_builder.load(fp)
+
+  return _timeIterations(run, context["iterations"]), context["numPrices"]
+
+
+
+def benchLoadBinary(context):
+  def run():
+    with open(context["binaryTablePath"], "rb") as fp:
+      price_table_builder.loadBinary(fp)
+
+  return _timeIterations(run, context["iterations"]), context["numPrices"]
+
+
+
+def benchGetBurnRate(context):
+  calculate_burn_rate = _importCalculateBurnRate(context)
+  instances = [instance for regionInstances in _generateFleet(context).values()
+               for instance in regionInstances]
+  getBurnRate = calculate_burn_rate.getBurnRate
+
+  def run():
+    for instance in instances:
+      getBurnRate(instance)
+
+  return _timeIterations(run, context["iterations"]), len(instances)
+
+
+
+def _serveFleet(calculate_burn_rate, fleet):
+  """Point calculate_burn_rate's region listing and connections at a
+  synthetic fleet"""
+  connections = {
+    name: synthetic_data.FakeEC2Connection(instances[0].region, instances)
+    for name, instances in fleet.iteritems() if instances
+  }
+  calculate_burn_rate._getRegions = lambda: [
+    conn.region for conn in connections.itervalues()]
+  calculate_burn_rate._getConnection = (
+    lambda region, credentials=None: connections[region.name])
+
+
+
+def benchGetDataByRegions(context):
+  calculate_burn_rate = _importCalculateBurnRate(context)
+  fleet = _generateFleet(context)
+  _serveFleet(calculate_burn_rate, fleet)
+
+  def run():
+    calculate_burn_rate.getDataByRegions()
+
+  return (_timeIterations(run, context["iterations"]),
+          sum(len(instances) for instances in fleet.itervalues()))
+
+
+
+def benchTagAttribution(context):
+  calculate_burn_rate = _importCalculateBurnRate(context)
+  fleet = _generateFleet(context)
+  _serveFleet(calculate_burn_rate, fleet)
+
+  def run():
+    calculate_burn_rate.getDataByRegions(
+      tagKeys=("team", "service", "environment"))
+
+  return (_timeIterations(run, context["iterations"]),
+          sum(len(instances) for instances in fleet.itervalues()))
+
+
+
+def benchSpendForecast(context):
+  calculate_burn_rate = _importCalculateBurnRate(context)
+  fleet = _generateFleet(context)
+  _serveFleet(calculate_burn_rate, fleet)
+
+  def run():
+    regionalData = calculate_burn_rate.getDataByRegions(forecast=True)
+    buildMetricBatch(regionalData, time.time(), forecastHours=1)
+
+  return (_timeIterations(run, context["iterations"]),
+          sum(len(instances) for instances in fleet.itervalues()))
+
+
+
+def benchParseDescribeInstances(context):
+  try:
+    from describe_instances import DescribeInstancesPage
+  except ImportError as e:
+    raise SkipStage("describe_instances unavailable: {}".format(e))
+
+  region = synthetic_data.FakeRegion("us-east-1")
+
+  def run():
+    for path in context["describeInstancesPaths"]:
+      with open(path) as fp:
+        for _ in DescribeInstancesPage(fp, region):
+          pass
+
+  return (_timeIterations(run, context["iterations"]),
+          context["numRecordedInstances"])
+
+
+
+def benchParseDescribeInstancesBoto(context):
+  try:
+    from boto.ec2.instance import Reservation
+    from boto.handler import XmlHandler
+    from boto.resultset import ResultSet
+  except ImportError as e:
+    raise SkipStage("boto unavailable: {}".format(e))
+
+  def run():
+    for path in context["describeInstancesPaths"]:
+      with open(path) as fp:
+        body = fp.read()
+      # As boto's get_all_instances does
+      xml.sax.parseString(body,
+                          XmlHandler(ResultSet([("item", Reservation)]), None))
+
+  return (_timeIterations(run, context["iterations"]),
+          context["numRecordedInstances"])
+
+
+
+def benchSendBatch(context):
+  regionalData = {
+    "region-%d" % i: {"burnrate": 123.45 * i,
+                      "numberRunningInstances": 100 * i,
+                      "numberStoppedInstances": 10 * i,
+                      "numberAllInstances": 110 * i}
+    for i in xrange(context["numRegions"] * 10)
+  }
+  records = buildMetricBatch(
+    regionalData, time.time(),
+    regionalMetrics=["burnrate", "runningInstances", "stoppedInstances",
+                     "allInstances"])
+
+  sink = synthetic_data.TcpSink()
+  sock = socket.create_connection(sink.address)
+
+  def run():
+    sock.sendall(formatGrokLines(records))
+
+  try:
+    return _timeIterations(run, context["iterations"] * 100), len(records)
+  finally:
+    sock.close()
+    sink.close()
+
+
+
+def benchGrokTransport(context):
+  """Queue batches on a GrokTransport whose idle connection the sink drops
+  every few batches, as a server or load balancer would between daemon
+  collections; fails unless every line is delivered"""
+  records = [("aws.region-%d.burnrate" % i, 123.45 * i, 1.4e9)
+             for i in xrange(context["numRegions"] * 40)]
+  data = formatGrokLines(records)
+  numBatches = 100
+  numLines = len(records) * numBatches
+
+  sink = synthetic_data.TcpSink()
+
+  def waitForSink(expectedLines):
+    deadline = time.time() + 10
+    while sink.linesReceived < expectedLines and time.time() < deadline:
+      time.sleep(0.001)
+    if sink.linesReceived < expectedLines:
+      raise RuntimeError("Sink received {} of {} lines".format(
+        sink.linesReceived, expectedLines))
+
+  def run():
+    linesBefore = sink.linesReceived
+    journalPath = os.path.join(context["workDir"], "transport.journal")
+    transport = GrokTransport(SocketConnection(sink.address),
+                              journalPath=journalPath, minBackoff=0.01,
+                              maxBackoff=0.1)
+    for i in xrange(numBatches):
+      transport.send(data)
+      if i % 25 == 24:
+        waitForSink(linesBefore + len(records) * (i + 1))
+        sink.dropConnections()
+
+    if not transport.close(timeout=60):
+      raise RuntimeError("GrokTransport did not send every line")
+    waitForSink(linesBefore + numLines)
+
+  try:
+    durations = _timeIterations(run, context["iterations"])
+  finally:
+    sink.close()
+
+  return durations, numLines
+
+
+
+def benchReplayHistory(context):
+  historyPath = os.path.join(context["workDir"], "history.csv")
+  numRecords = context["numInstances"] * 4
+  with open(historyPath, "wb") as fp:
+    writer = csv.writer(fp)
+    for i in xrange(numRecords):
+      writer.writerow(["aws.region-%d.burnrate" % (i % 40), str(i * 0.25),
+                       str(1.4e9 + i // 40 * 300.0)])
+
+  sink = synthetic_data.TcpSink()
+  sock = socket.create_connection(sink.address)
+
+  def run():
+    replayHistory(historyPath, sock)
+
+  try:
+    return _timeIterations(run, context["iterations"]), numRecords
+  finally:
+    sock.close()
+    sink.close()
+
+
+
+def benchColdStart(context):
+  """Start the collector in a fresh interpreter and exit after parsing its
+  options: the fixed cost that every cron-driven run pays before doing any
+  work"""
+  command = [sys.executable,
+             os.path.join(_REPO_DIR, "burnrate_collect_data.py"), "--help"]
+
+  def run():
+    with open(os.devnull, "w") as devnull:
+      subprocess.check_call(command, stdout=devnull)
+
+  return _timeIterations(run, context["iterations"]), 1
+
+
+
+# (stage name, benchmark function); each function returns a list of iteration
+# durations and the number of items processed per iteration
+STAGES = (
+  ("buildLookupTable", benchBuildLookupTable),
+  ("buildLookupTableFromStream", benchBuildLookupTableFromStream),
+  ("load", benchLoadJson),
+  ("loadBinary", benchLoadBinary),
+  ("getBurnRate", benchGetBurnRate),
+  ("parseDescribeInstances", benchParseDescribeInstances),
+  ("parseDescribeInstancesBoto", benchParseDescribeInstancesBoto),
+  ("getDataByRegions", benchGetDataByRegions),
+  ("tagAttribution", benchTagAttribution),
+  ("spendForecast", benchSpendForecast),
+  ("sendBatch", benchSendBatch),
+  ("grokTransport", benchGrokTransport),
+  ("replayHistory", benchReplayHistory),
+  ("coldStart", benchColdStart),
+)
+
+
+
+def _percentile(sortedValues, fraction):
+  index = min(int(round(fraction * (len(sortedValues) - 1))),
+              len(sortedValues) - 1)
+  return sortedValues[index]
+
+
+
+def _runStage(benchFn, context, resultQueue):
+  """Child process entry point: run one stage and report its statistics"""
+  try:
+    durations, numItems = benchFn(context)
+  except SkipStage as e:
+    resultQueue.put({"skipped": str(e)})
+    return
+  except Exception:  # pylint: disable=W0703
+    resultQueue.put({"error": traceback.format_exc()})
+    return
+
+  durations.sort()
+  total = sum(durations)
+  resultQueue.put({
+    "iterations": len(durations),
+    "itemsPerIteration": numItems,
+    "throughput": (numItems * len(durations) / total) if total else None,
+    "p50Ms": _percentile(durations, 0.5) * 1000,
+    "p90Ms": _percentile(durations, 0.9) * 1000,
+    "p99Ms": _percentile(durations, 0.99) * 1000,
+    # Kilobytes on Linux
+    "peakRssKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  })
+
+
+
+def runStage(benchFn, context):
+  """Run a stage in a fresh process
+
+  :returns: dict of statistics, or with a "skipped"/"error" key
+  """
+  resultQueue = multiprocessing.Queue()
+  process = multiprocessing.Process(target=_runStage,
+                                    args=(benchFn, context, resultQueue))
+  process.start()
+  result = resultQueue.get()
+  process.join()
+  return result
+
+
+
+def prepareContext(options, workDir):
+  """Generate the synthetic inputs shared by all stages"""
+  context = {
+    "workDir": workDir,
+    "iterations": options.iterations,
+    "numSkus": options.skus,
+    "numInstances": options.instances,
+    "numRegions": options.regions,
+    "offersPath": os.path.join(workDir, "offers.json"),
+    "jsonTablePath": os.path.join(workDir, "price_table.json"),
+    "binaryTablePath": os.path.join(workDir, "price_table.bin"),
+  }
+
+  with open(context["offersPath"], "w") as fp:
+    synthetic_data.writeOffers(fp, options.skus)
+
+  with open(context["offersPath"]) as fp:
+    priceMap = price_table_builder.buildLookupTableFromStream(fp)
+  context["numPrices"] = len(priceMap)
+
+  with open(context["jsonTablePath"], "w") as fp:
+    price_table_builder.dumpJson(priceMap, fp)
+
+  with open(context["binaryTablePath"], "wb") as fp:
+    price_table_builder.dumpBinary(priceMap, fp)
+
+  # Recorded DescribeInstances responses, written once so that parsing them
+  # is timed without rendering them
+  instances = synthetic_data.generateFleet(
+    min(options.instances, _NUM_RECORDED_PAGES * _RECORDED_PAGE_SIZE),
+    list(priceMap), numRegions=1).values()[0]
+  context["numRecordedInstances"] = len(instances)
+  context["describeInstancesPaths"] = []
+  for i in xrange(0, len(instances), _RECORDED_PAGE_SIZE):
+    path = os.path.join(workDir, "describe_instances_%d.xml" % i)
+    with open(path, "w") as fp:
+      fp.write(synthetic_data.renderDescribeInstances(
+        instances[i:i + _RECORDED_PAGE_SIZE]))
+    context["describeInstancesPaths"].append(path)
+
+  return context
+
+
+
+def findRegressions(results, baseline, threshold):
+  """Compare results with a saved baseline
+
+  :returns: list of human-readable regression descriptions
+  """
+  regressions = []
+  for stage, result in sorted(results.iteritems()):
+    previous = baseline.get(stage)
+    if not previous or "p50Ms" not in previous or "p50Ms" not in result:
+      continue
+
+    for metric in ("p50Ms", "peakRssKb"):
+      if (previous[metric] and
+          result[metric] > previous[metric] * (1 + threshold)):
+        regressions.append("{}: {} {:.1f} -> {:.1f} (+{:.0%})".format(
+          stage, metric, previous[metric], result[metric],
+          result[metric] / float(previous[metric]) - 1))
+
+  return regressions
+
+
+
+def main():
+  parser = optparse.OptionParser(description=__doc__)
+  parser.add_option("--skus",
+                    help="Number of products in the synthetic offers. "
+                    "(default: %default)",
+                    dest="skus", type="int", default=20000)
+  parser.add_option("--instances",
+                    help="Number of instances in the synthetic fleet. "
+                    "(default: %default)",
+                    dest="instances", type="int", default=50000)
+  parser.add_option("--regions",
+                    help="Number of regions the fleet is spread over. "
+                    "(default: %default)",
+                    dest="regions", type="int", default=10)
+  parser.add_option("--iterations",
+                    help="Timed iterations per stage. (default: %default)",
+                    dest="iterations", type="int", default=5)
+  parser.add_option("--stages",
+                    help="Comma-separated stages to run. (default: all)",
+                    dest="stages", default="")
+  parser.add_option("--save-baseline",
+                    help="Write results to this JSON file.",
+                    dest="saveBaseline", default="")
+  parser.add_option("--baseline",
+                    help="Compare results with this JSON file and exit "
+                    "non-zero on regressions.",
+                    dest="baseline", default="")
+  parser.add_option("--threshold",
+                    help="Relative slowdown or memory growth that counts as "
+                    "a regression. (default: %default)",
+                    dest="threshold", type="float", default=0.25)
+
+  options, _ = parser.parse_args()
+
+  selected = set(options.stages.split(",")) if options.stages else None
+
+  workDir = tempfile.mkdtemp(prefix="burnrate_benchmarks")
+  try:
+    context = prepareContext(options, workDir)
+
+    print "%-28s %10s %12s %10s %10s %10s %10s" % (
+      "stage", "items", "items/s", "p50 ms", "p90 ms", "p99 ms", "RSS KB")
+
+    results = {}
+    for stage, benchFn in STAGES:
+      if selected is not None and stage not in selected:
+        continue
+
+      result = runStage(benchFn, context)
+      results[stage] = result
+
+      if "skipped" in result:
+        print "%-28s skipped: %s" % (stage, result["skipped"])
+      elif "error" in result:
+        print "%-28s failed:\n%s" % (stage, result["error"])
+      else:
+        print "%-28s %10d %12.0f %10.2f %10.2f %10.2f %10d" % (
+          stage, result["itemsPerIteration"], result["throughput"] or 0,
+          result["p50Ms"], result["p90Ms"], result["p99Ms"],
+          result["peakRssKb"])
+  finally:
+    shutil.rmtree(workDir)
+
+  if options.saveBaseline:
+    with open(options.saveBaseline, "w") as fp:
+      json.dump(results, fp, indent=2, sort_keys=True)
+
+  if options.baseline:
+    with open(options.baseline) as fp:
+      regressions = findRegressions(results, json.load(fp), options.threshold)
+    for regression in regressions:
+      print "REGRESSION %s" % regression
+    if regressions:
+      sys.exit(1)
+
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Synthetic AWS offers, EC2 fleets and a Grok stand-in for benchmarks."""
+
+import datetime
+import json
+import random
+import socket
+import StringIO
+import threading
+
+
+
+# Region code -> location name used in the offers file
+REGION_LOCATIONS = (
+  ("us-east-1", "US East (N. Virginia)"),
+  ("us-west-1", "US West (N. California)"),
+  ("us-west-2", "US West (Oregon)"),
+  ("eu-west-1", "EU (Ireland)"),
+  ("eu-central-1", "EU (Frankfurt)"),
+  ("ap-northeast-1", "Asia Pacific (Tokyo)"),
+  ("ap-northeast-2", "Asia Pacific (Seoul)"),
+  ("ap-southeast-1", "Asia Pacific (Singapore)"),
+  ("ap-southeast-2", "Asia Pacific (Sydney)"),
+  ("sa-east-1", "South America (Sao Paulo)"),
+)
+
+OPERATING_SYSTEMS = ("Linux", "RHEL", "SUSE", "Windows")
+
+INSTANCE_FAMILIES = ("t2", "m3", "m4", "c3", "c4", "r3", "i2", "d2", "g2", "x1")
+
+INSTANCE_SIZES = ("nano", "micro", "small", "medium", "large", "xlarge",
+                  "2xlarge", "4xlarge", "8xlarge", "10xlarge", "16xlarge",
+                  "32xlarge")
+
+
+
+def _iterProducts(numSkus, rng):
+  """Yield (skuId, product, onDemandTerms, reservedTerms) for synthetic SKUs;
+  roughly one in four is not a Compute Instance, as in the real offers"""
+  for i in xrange(numSkus):
+    skuId = "SYNTH%08d" % i
+    if i % 4 == 3:
+      product = {
+        "sku": skuId,
+        "productFamily": "Storage",
+        "attributes": {"location": REGION_LOCATIONS[i % 10][1],
+                       "volumeType": "Magnetic"}
+      }
+    else:
+      product = {
+        "sku": skuId,
+        "productFamily": "Compute Instance",
+        "attributes": {
+          "location": REGION_LOCATIONS[i % len(REGION_LOCATIONS)][1],
+          "instanceType": "%s.%s%s" % (
+            INSTANCE_FAMILIES[(i // 10) % len(INSTANCE_FAMILIES)],
+            INSTANCE_SIZES[(i // 100) % len(INSTANCE_SIZES)],
+            i // 1200 or ""),
+          "operatingSystem": OPERATING_SYSTEMS[(i // 7) % 4],
+          "tenancy": "Shared",
+          "vcpu": str(rng.randint(1, 128)),
+          "memory": "%d GiB" % rng.randint(1, 2048)
+        }
+      }
+
+    price = "%.4f" % rng.uniform(0.005, 15.0)
+    onDemand = {
+      skuId + ".JRTCKXETXF": {
+        "offerTermCode": "JRTCKXETXF",
+        "sku": skuId,
+        "effectiveDate": "2016-03-01T00:00:00Z",
+        "priceDimensions": {
+          skuId + ".JRTCKXETXF.6YS6EN2CT7": {
+            "rateCode": skuId + ".JRTCKXETXF.6YS6EN2CT7",
+            "description": "synthetic",
+            "unit": "Hrs",
+            "pricePerUnit": {"USD": price}
+          }
+        },
+        "termAttributes": {}
+      }
+    }
+
+    upfront = "%.4f" % (float(price) * rng.uniform(2000, 8000))
+    reserved = {
+      skuId + ".4NA7Y494T4": {
+        "offerTermCode": "4NA7Y494T4",
+        "sku": skuId,
+        "effectiveDate": "2016-03-01T00:00:00Z",
+        "priceDimensions": {
+          skuId + ".4NA7Y494T4.2TG2D8R56U": {
+            "rateCode": skuId + ".4NA7Y494T4.2TG2D8R56U",
+            "unit": "Quantity",
+            "pricePerUnit": {"USD": upfront}
+          },
+          skuId + ".4NA7Y494T4.6YS6EN2CT7": {
+            "rateCode": skuId + ".4NA7Y494T4.6YS6EN2CT7",
+            "unit": "Hrs",
+            "pricePerUnit": {"USD": "%.4f" % (float(price) * 0.3)}
+          }
+        },
+        "termAttributes": {"LeaseContractLength": "1yr",
+                           "PurchaseOption": "Partial Upfront"}
+      }
+    }
+
+    yield skuId, product, onDemand, reserved
+
+
+
+def writeOffers(fp, numSkus, seed=42):
+  """Write a synthetic AmazonEC2 offers document with the same structure as
+  the real index.json. The document is written incrementally, so files far
+  larger than memory can be generated.
+
+  :param file fp: file object to write to
+  :param int numSkus: number of products to generate
+  :param int seed: random seed; equal seeds produce identical files
+  """
+  fp.write('{"formatVersion": "v1.0", "disclaimer": "Synthetic offers", '
+           '"offerCode": "AmazonEC2", "version": "20160301000000", '
+           '"publicationDate": "2016-03-01T00:00:00Z", "products": {')
+
+  for i, (skuId, product, _, _) in enumerate(
+      _iterProducts(numSkus, random.Random(seed))):
+    fp.write("%s\n%s: %s" % ("," if i else "", json.dumps(skuId),
+                             json.dumps(product)))
+
+  fp.write('}, "terms": {"OnDemand": {')
+  for i, (skuId, _, onDemand, _) in enumerate(
+      _iterProducts(numSkus, random.Random(seed))):
+    fp.write("%s\n%s: %s" % ("," if i else "", json.dumps(skuId),
+                             json.dumps(onDemand)))
+
+  fp.write('}, "Reserved": {')
+  for i, (skuId, _, _, reserved) in enumerate(
+      _iterProducts(numSkus, random.Random(seed))):
+    fp.write("%s\n%s: %s" % ("," if i else "", json.dumps(skuId),
+                             json.dumps(reserved)))
+
+  fp.write("}}}\n")
+
+
+
+class FakeRegion(object):
+  def __init__(self, name):
+    self.name = name
+
+
+
+class FakeInstance(object):
+  """The subset of boto.ec2.instance.Instance read by the collector"""
+
+  def __init__(self, instanceId, state, instanceType, region, platform,
+               launchTime, availabilityZone, tags):
+    self.id = instanceId
+    self.state = state
+    self.instance_type = instanceType
+    self.region = region
+    self.platform = platform
+    self.launch_time = launchTime
+    self.placement = availabilityZone
+    self.tags = tags
+
+
+
+# Namespace of DescribeInstances responses
+EC2_NAMESPACE = "http://ec2.amazonaws.com/doc/2014-10-01/"
+
+# One instance of a DescribeInstances response, with the fields EC2 returns
+# for a typical VPC instance
+_INSTANCE_XML = """\
+<item>
+<instanceId>%(id)s</instanceId>
+<imageId>ami-1a2b3c4d</imageId>
+<instanceState><code>%(stateCode)d</code><name>%(state)s</name></instanceState>
+<privateDnsName>ip-10-0-0-12.ec2.internal</privateDnsName>
+<dnsName>ec2-54-0-0-12.compute-1.amazonaws.com</dnsName>
+<reason/>
+<keyName>deploy</keyName>
+<amiLaunchIndex>0</amiLaunchIndex>
+<productCodes/>
+<instanceType>%(instanceType)s</instanceType>
+<launchTime>%(launchTime)s</launchTime>
+<placement><availabilityZone>%(placement)s</availabilityZone><groupName/>\
+<tenancy>default</tenancy></placement>
+%(platform)s<kernelId>aki-88aa75e1</kernelId>
+<monitoring><state>disabled</state></monitoring>
+<subnetId>subnet-1a2b3c4d</subnetId>
+<vpcId>vpc-1a2b3c4d</vpcId>
+<privateIpAddress>10.0.0.12</privateIpAddress>
+<ipAddress>54.0.0.12</ipAddress>
+<sourceDestCheck>true</sourceDestCheck>
+<groupSet><item><groupId>sg-1a2b3c4d</groupId><groupName>default</groupName>\
+</item></groupSet>
+<architecture>x86_64</architecture>
+<rootDeviceType>ebs</rootDeviceType>
+<rootDeviceName>/dev/xvda</rootDeviceName>
+<blockDeviceMapping><item><deviceName>/dev/xvda</deviceName><ebs>\
+<volumeId>vol-1a2b3c4d</volumeId><status>attached</status>\
+<attachTime>%(launchTime)s</attachTime>\
+<deleteOnTermination>true</deleteOnTermination></ebs></item>\
+</blockDeviceMapping>
+<virtualizationType>hvm</virtualizationType>
+<clientToken/>
+<tagSet>%(tags)s</tagSet>
+<hypervisor>xen</hypervisor>
+<networkInterfaceSet><item><networkInterfaceId>eni-1a2b3c4d</networkInterfaceId>\
+<subnetId>subnet-1a2b3c4d</subnetId><vpcId>vpc-1a2b3c4d</vpcId>\
+<description/><ownerId>123456789012</ownerId><status>in-use</status>\
+<macAddress>0a:1b:2c:3d:4e:5f</macAddress>\
+<privateIpAddress>10.0.0.12</privateIpAddress>\
+<sourceDestCheck>true</sourceDestCheck><groupSet><item>\
+<groupId>sg-1a2b3c4d</groupId><groupName>default</groupName></item></groupSet>\
+<attachment><attachmentId>eni-attach-1a2b3c4d</attachmentId>\
+<deviceIndex>0</deviceIndex><status>attached</status>\
+<attachTime>%(launchTime)s</attachTime>\
+<deleteOnTermination>true</deleteOnTermination></attachment>\
+<privateIpAddressesSet><item><privateIpAddress>10.0.0.12</privateIpAddress>\
+<primary>true</primary></item></privateIpAddressesSet></item>\
+</networkInterfaceSet>
+<ebsOptimized>false</ebsOptimized>
+</item>
+"""
+
+_STATE_CODES = {"pending": 0, "running": 16, "shutting-down": 32,
+                "terminated": 48, "stopping": 64, "stopped": 80}
+
+
+
+def renderDescribeInstances(instances, nextToken=None,
+                            instancesPerReservation=4):
+  """Render a DescribeInstances response body
+
+  :param instances: FakeInstances to list
+  :param str nextToken: token of the next page, if any
+
+  :returns: str
+  """
+  parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<DescribeInstancesResponse xmlns="%s">\n'
+           '<requestId>8f7724cf-496f-496e-8fe3-example</requestId>\n'
+           '<reservationSet>\n' % EC2_NAMESPACE]
+
+  for i in xrange(0, len(instances), instancesPerReservation):
+    parts.append("<item><reservationId>r-%08x</reservationId>"
+                 "<ownerId>123456789012</ownerId><groupSet/>"
+                 "<instancesSet>\n" % i)
+    for instance in instances[i:i + instancesPerReservation]:
+      parts.append(_INSTANCE_XML % {
+        "id": instance.id,
+        "stateCode": _STATE_CODES[instance.state],
+        "state": instance.state,
+        "instanceType": instance.instance_type,
+        "launchTime": instance.launch_time,
+        "placement": instance.placement,
+        "platform": ("<platform>%s</platform>\n" % instance.platform
+                     if instance.platform else ""),
+        "tags": "".join("<item><key>%s</key><value>%s</value></item>" %
+                        (key, value)
+                        for key, value in sorted(instance.tags.iteritems())),
+      })
+    parts.append("</instancesSet></item>\n")
+
+  parts.append("</reservationSet>\n")
+  if nextToken is not None:
+    parts.append("<nextToken>%s</nextToken>\n" % nextToken)
+  parts.append("</DescribeInstancesResponse>\n")
+
+  return "".join(parts)
+
+
+
+class FakeResponse(StringIO.StringIO):
+  """Stand-in for the httplib.HTTPResponse returned by boto's make_request"""
+
+  def __init__(self, body, status=200, reason="OK"):
+    StringIO.StringIO.__init__(self, body)
+    self.status = status
+    self.reason = reason
+
+
+
+class FakeEC2Connection(object):
+  """Stand-in for boto.ec2.connection.EC2Connection that serves a synthetic
+  fleet as DescribeInstances responses, honoring paging and state filters"""
+
+  ResponseError = RuntimeError
+
+  def __init__(self, region, instances, instancesPerReservation=4):
+    self.region = region
+    self._instances = instances
+    self._instancesPerReservation = instancesPerReservation
+    self.numCalls = 0
+
+
+  def make_request(self, action, params=None, path="/", verb="GET"):
+    assert action == "DescribeInstances"
+    self.numCalls += 1
+    params = params or {}
+
+    instances = self._instances
+    i = 1
+    while "Filter.%d.Name" % i in params:
+      if params["Filter.%d.Name" % i] == "instance-state-name":
+        states = set()
+        j = 1
+        while "Filter.%d.Value.%d" % (i, j) in params:
+          states.add(params["Filter.%d.Value.%d" % (i, j)])
+          j += 1
+        instances = [instance for instance in instances
+                     if instance.state in states]
+      i += 1
+
+    start = int(params.get("NextToken") or 0)
+    end = (len(instances) if params.get("MaxResults") is None
+           else start + params["MaxResults"])
+
+    return FakeResponse(renderDescribeInstances(
+      instances[start:end],
+      nextToken=str(end) if end < len(instances) else None,
+      instancesPerReservation=self._instancesPerReservation))
+
+
+
+def generateFleet(numInstances, priceKeys, numRegions=len(REGION_LOCATIONS),
+                  unknownFraction=0.01, stoppedFraction=0.2, seed=42):
+  """Generate a synthetic fleet spread across regions
+
+  :param int numInstances: total number of instances
+  :param priceKeys: (instance type, region, platform) keys to draw instance
+    types from, e.g. the keys of a synthetic price table
+  :param int numRegions: number of regions to spread the fleet over
+  :param float unknownFraction: fraction of instances with an instance type
+    that is not in `priceKeys`
+  :param float stoppedFraction: fraction of stopped instances
+  :param int seed: random seed
+
+  :returns: dict of region name -> list of FakeInstance
+  """
+  rng = random.Random(seed)
+  regionNames = [name for name, _ in REGION_LOCATIONS[:numRegions]]
+  regionObjects = {name: FakeRegion(name) for name in regionNames}
+
+  typesByRegion = {name: [] for name in regionNames}
+  for instanceType, region, platform in priceKeys:
+    if region in typesByRegion:
+      typesByRegion[region].append((instanceType, platform))
+
+  now = datetime.datetime.utcnow()
+  fleet = {name: [] for name in regionNames}
+  for i in xrange(numInstances):
+    regionName = regionNames[i % len(regionNames)]
+    candidates = typesByRegion[regionName]
+    if candidates and rng.random() >= unknownFraction:
+      instanceType, platform = rng.choice(candidates)
+    else:
+      instanceType, platform = "zz.unknown", "linux"
+
+    if rng.random() < stoppedFraction:
+      state = "stopped"
+    else:
+      state = "running"
+
+    launchTime = now - datetime.timedelta(seconds=rng.randint(0, 90 * 86400))
+    fleet[regionName].append(FakeInstance(
+      instanceId="i-%08x" % i,
+      state=state,
+      instanceType=instanceType,
+      region=regionObjects[regionName],
+      platform=None if platform == "linux" else platform,
+      launchTime=launchTime.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+      availabilityZone="%s%s" % (regionName, "abc"[rng.randint(0, 2)]),
+      tags={"team": "team%d" % rng.randint(0, 20),
+            "service": "svc%d" % int(rng.paretovariate(1.2)),
+            "environment": rng.choice(("prod", "staging", "dev"))}))
+
+  return fleet
+
+
+
+class TcpSink(object):
+  """Local TCP server standing in for Grok's custom metrics port. It counts
+  the bytes and lines it receives and can drop connections on demand."""
+
+  def __init__(self, host="127.0.0.1", port=0):
+    self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._server.bind((host, port))
+    self._server.listen(16)
+    self.address = self._server.getsockname()
+
+    self._lock = threading.Lock()
+    self._connections = []
+    self.bytesReceived = 0
+    self.linesReceived = 0
+    self.numConnections = 0
+
+    thread = threading.Thread(target=self._acceptLoop, name="TcpSink")
+    thread.daemon = True
+    thread.start()
+
+
+  def _acceptLoop(self):
+    while True:
+      try:
+        conn, _ = self._server.accept()
+      except socket.error:
+        return
+
+      with self._lock:
+        self._connections.append(conn)
+        self.numConnections += 1
+
+      thread = threading.Thread(target=self._receiveLoop, args=(conn,))
+      thread.daemon = True
+      thread.start()
+
+
+  def _receiveLoop(self, conn):
+    while True:
+      try:
+        data = conn.recv(1 << 16)
+      except socket.error:
+        return
+      if not data:
+        return
+      with self._lock:
+        self.bytesReceived += len(data)
+        self.linesReceived += data.count("\n")
+
+
+  def dropConnections(self):
+    """Abruptly close every connection accepted so far"""
+    with self._lock:
+      connections, self._connections = self._connections, []
+    for conn in connections:
+      try:
+        conn.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+      conn.close()
+
+
+  def close(self):
+    self.dropConnections()
+    self._server.close()
@@ -15,18 +15,50 @@
 # limitations under the License.
 #
 
-""" Grok Custom Metrics data collector for collecting AWS burn rate metrics."""
-import datetime, time, sys, csv, os.path
+""" Grok Custom Metrics data collector for collecting AWS burn rate metrics.
+
+Modules that only some runs need are imported where they are used: boto only
+by runs that collect from EC2, grokcli only by runs that send to Grok, and so
+on. A --noserver run never imports grokcli, and a replay never imports boto.
+"""
+import datetime, time, sys, csv, os.path, socket, traceback
+
+# Reported as the cold-start time, along with the time spent in imports and
+# option parsing up to the first collection
+_startTime = time.time()
+
 from optparse import OptionParser
-from grokcli.api import GrokSession
 
-from calculate_burn_rate import getDataByRegions
+import instrumentation
+from metric_batch import (BREAKDOWNS, buildMetricBatch, formatCsvRows,
+                          formatGrokLines)
+from price_table_builder import RESERVED_PRICING_MODELS
 
 
 
-def sendMetricsToGrok(opt):
-  """Collects data for burnrate metrics, writes it to a csv file and
-  sends it to Grok.
+# (metric name, option enabling its per-region records)
+_REGIONAL_METRIC_FLAGS = (
+  ("burnrate", "regionalBurnrates"),
+  ("runningInstances", "regionalRunning"),
+  ("stoppedInstances", "regionalStopped"),
+  ("allInstances", "regionalAll"),
+)
+
+# --accrualfile path -> CostAccrual, kept across daemon collections
+_accruals = {}
+
+# --emissionfile path -> DeadbandFilter, kept across daemon collections
+_emissionFilters = {}
+
+# --emissionfile path -> GrokTransport.linesDropped when the filter's values
+# were last committed
+_emissionLinesDropped = {}
+
+
+
+def collectMetricBatch(opt):
+  """Collects data for burnrate metrics and builds the batch of records to
+  report.
 
   Collects the following metrics (toggled with CL flags):
   - Total hourly burnrate
@@ -37,208 +69,370 @@ def sendMetricsToGrok(opt):
   - Regional number stopped instances (use -p)
   - Total number all instances
   - Regional number all instances (use -t)
+  - Burnrate and number running instances by instance family, instance type
+    or availability zone (use --breakdowns)
+  - Total and, with -b, regional burnrate under Reserved Instance pricing
+    models (use --pricingmodels)
+  - Total and, with -b, regional cost accrued over the last 1h, 24h, 7d and
+    30d (use --accrualfile)
+  - Total and, with -b, regional burnrate and number running instances by
+    the values of instance tags, capped at --maxtagvalues values per tag
+    (use --tags)
+  - Total and, with -b, regional spend forecast over the next
+    --forecasthours hours from each running instance's launch time
+
+  With --accounts, metrics are reported for each configured account and for
+  all accounts together. With --meta, the collector's own timings and
+  counters are added as <prefix>.meta.* metrics.
+
+  :returns: list of (metric name, value, ts) records
+  """
+  if opt.accounts:
+    records, ts = _collectAccountsMetricBatch(opt)
+  else:
+    from calculate_burn_rate import getDataByRegions
+
+    tagKeys = opt.tags.split(",") if opt.tags else ()
+
+    with instrumentation.timer("stages.collectRegions.seconds"):
+      regionalData = getDataByRegions(maxConcurrency=opt.concurrency,
+                                      regionTimeout=opt.regionTimeout,
+                                      pageSize=opt.pageSize,
+                                      scheduleDir=opt.scheduleDir or None,
+                                      maxActivePollInterval=(
+                                        opt.maxActivePollInterval),
+                                      maxIdlePollInterval=(
+                                        opt.maxIdlePollInterval),
+                                      tagKeys=tagKeys,
+                                      maxTagValues=opt.maxTagValues,
+                                      forecast=bool(opt.forecastHours))
+    ts = time.mktime(datetime.datetime.utcnow().timetuple())
+
+    regionalMetrics = [name for name, flag in _REGIONAL_METRIC_FLAGS
+                       if getattr(opt, flag)]
+
+    breakdowns = opt.breakdowns.split(",") if opt.breakdowns else ()
+    pricingModels = (opt.pricingModels.split(",") if opt.pricingModels
+                     else ())
+
+    with instrumentation.timer("stages.buildBatch.seconds"):
+      records = buildMetricBatch(regionalData, ts, prefix=opt.prefix,
+                                 regionalMetrics=regionalMetrics,
+                                 breakdowns=breakdowns,
+                                 pricingModels=pricingModels,
+                                 accrual=_getAccrual(opt),
+                                 maxTagValues=opt.maxTagValues,
+                                 forecastHours=opt.forecastHours)
+
+    if opt.verbose:
+      print "Collected %d metrics from %d regions" % (len(records),
+                                                       len(regionalData))
+
+  accrual = _getAccrual(opt)
+  if accrual is not None:
+    accrual.save()
+
+  if opt.meta:
+    records.extend(instrumentation.buildMetaRecords(ts, prefix=opt.prefix))
+
+  return records
+
+
+
+def _getAccrual(opt):
+  """Return the CostAccrual of --accrualfile, loading it on first use; None
+  without --accrualfile"""
+  if not opt.accrualFile:
+    return None
+
+  accrual = _accruals.get(opt.accrualFile)
+  if accrual is None:
+    from cost_accrual import CostAccrual
+    accrual = _accruals[opt.accrualFile] = CostAccrual(
+      opt.accrualFile, maxGap=opt.accrualMaxGap)
+  return accrual
+
+
+
+def _getEmissionFilter(opt):
+  """Return the DeadbandFilter of --emissionfile, loading it on first use;
+  None without --changeonly"""
+  if not opt.changeOnly:
+    return None
+
+  emissionFilter = _emissionFilters.get(opt.emissionFile)
+  if emissionFilter is None:
+    from emission_filter import DeadbandFilter
+    emissionFilter = _emissionFilters[opt.emissionFile] = DeadbandFilter(
+      opt.emissionFile or None, absolute=opt.deadband,
+      relative=opt.deadbandRelative, heartbeat=opt.heartbeat)
+  return emissionFilter
+
+
+
+def _collectAccountsMetricBatch(opt):
+  """Collects the metrics of the accounts listed in the --accounts file
+
+  :returns: two-tuple (list of (metric name, value, ts) records, ts)
   """
-  grok = GrokSession(server=opt.server, apikey=opt.key)
-  regionalData = getDataByRegions()
+  from multi_account import (buildAccountsMetricBatch, collectAccounts,
+                             loadAccounts)
+
+  with open(opt.accounts) as fp:
+    orgPrefix, accounts = loadAccounts(fp, defaultPrefix=opt.prefix)
+
+  with instrumentation.timer("stages.collectRegions.seconds"):
+    accountData = collectAccounts(accounts, processes=opt.processes,
+                                  maxConcurrency=opt.concurrency,
+                                  regionTimeout=opt.regionTimeout,
+                                  pageSize=opt.pageSize,
+                                  scheduleDir=opt.scheduleDir or None,
+                                  maxActivePollInterval=(
+                                    opt.maxActivePollInterval),
+                                  maxIdlePollInterval=opt.maxIdlePollInterval,
+                                  tagKeys=(opt.tags.split(",") if opt.tags
+                                           else ()),
+                                  maxTagValues=opt.maxTagValues,
+                                  forecast=bool(opt.forecastHours))
   ts = time.mktime(datetime.datetime.utcnow().timetuple())
 
+  regionalMetrics = [name for name, flag in _REGIONAL_METRIC_FLAGS
+                     if getattr(opt, flag)]
+  breakdowns = opt.breakdowns.split(",") if opt.breakdowns else ()
+  pricingModels = opt.pricingModels.split(",") if opt.pricingModels else ()
+
+  with instrumentation.timer("stages.buildBatch.seconds"):
+    records = buildAccountsMetricBatch(accounts, accountData, ts, orgPrefix,
+                                       regionalMetrics=regionalMetrics,
+                                       breakdowns=breakdowns,
+                                       pricingModels=pricingModels,
+                                       accrual=_getAccrual(opt),
+                                       maxTagValues=opt.maxTagValues,
+                                       forecastHours=opt.forecastHours)
+
+  if opt.verbose:
+    print "Collected %d metrics from %d of %d accounts" % (
+      len(records), len(accountData), len(accounts))
+
+  return records, ts
+
+
+
+def _writeHistory(opt, records):
+  """Record a batch in the history store if one is configured, otherwise
+  append it to the csv output file"""
+  if opt.historyDir:
+    from metric_history import MetricHistoryStore
+    MetricHistoryStore(opt.historyDir).append(records)
+    return
+
   with open(opt.outputfile, "ab") as csvfile:
-    csvwriter = csv.writer(csvfile)
+    csv.writer(csvfile).writerows(formatCsvRows(records))
+
+
+
+def _createTransport(opt):
+  from grok_transport import GrokTransport
+  return GrokTransport(_PersistentGrokConnection(opt.server, opt.key),
+                       journalPath=opt.journal or None,
+                       sendTimeout=opt.sendTimeout)
 
-    with grok.connect() as sock:
-      # Regional burn rate calculation/send
-      if opt.regionalBurnrates:
-        if opt.verbose:
-          print "Calculating / sending regional hourly burn rates"
-        for region in regionalData.items():
-          sock.sendall("%s %s %d\n" % (opt.prefix + "." + region[0] +
-                                       ".burnrate",
-                                       (region[1]["burnrate"]*int(opt.scale)),
-                                       ts))
-          csvwriter.writerow([(opt.prefix + "." + region[0] + ".burnrate"),
-                              str(region[1]["burnrate"]),
-                              str(ts)])
-
-      # Total burn rate calculation/send
-      if opt.verbose:
-        print "Calculating / sending total hourly burn rate"
-      burnrate = sum(region[1]["burnrate"] for region in regionalData.items())
-      sock.sendall("%s %s %d\n" % (opt.prefix + ".total.burnrate",
-                                   (burnrate*int(opt.scale)),
-                                   ts))
-      csvwriter.writerow([opt.prefix + ".total.burnrate",
-                          str(burnrate),
-                          str(ts)])
-
-      # Regional running instances calculate/send
-      if opt.regionalRunning:
-        if opt.verbose:
-          print "Calculating / sending regional running instances"
-        for region in regionalData.items():
-          sock.sendall("%s %s %d\n" % (opt.prefix + "." + region[0] +
-                                       ".runningInstances",
-                                       (region[1]["numberRunningInstances"]
-                                        *int(opt.scale)),
-                                       ts))
-          csvwriter.writerow([(opt.prefix + "." + region[0] +
-                               ".runningInstances"),
-                              str(region[1]["numberRunningInstances"]),
-                              str(ts)])
-      # Total running instances calculate/send
-      if opt.verbose:
-        print "Calculating / sending total running instances"
-      numRunning = sum(region[1]["numberRunningInstances"] for region in
-                     regionalData.items())
-      sock.sendall("%s %s %d\n" % (opt.prefix + ".total.runningInstances",
-                                   (numRunning*int(opt.scale)),
-                                   ts))
-      csvwriter.writerow([opt.prefix + ".total.runningInstances",
-                          str(numRunning),
-                          str(ts)])
-
-      # Regional stopped instances calculate/send
-      if opt.regionalStopped:
-        if opt.verbose:
-          print "Calculating / sending regional stopped instances"
-        for region in regionalData.items():
-          sock.sendall("%s %s %d\n" % (opt.prefix + "." + region[0] +
-                                       ".stoppedInstances",
-                                       (region[1]["numberStoppedInstances"]
-                                        *int(opt.scale)),
-                                       ts))
-          csvwriter.writerow([(opt.prefix + "." + region[0] +
-                               ".stoppedInstances"),
-                              str(region[1]["numberStoppedInstances"]),
-                              str(ts)])
-
-      # Total stopped instances calculate/send
-      if opt.verbose:
-        print "Calculating / sending total stopped instances"
-      numStopped = sum(region[1]["numberStoppedInstances"] for region in
-                     regionalData.items())
-      sock.sendall("%s %s %d\n" % (opt.prefix + ".total.stoppedInstances",
-                                   (numStopped*int(opt.scale)),
-                                   ts))
-      csvwriter.writerow([opt.prefix + ".total.stoppedInstances",
-                          str(numStopped),
-                          str(ts)])
-
-      # Regional all instances calculate/send
-      if opt.regionalAll:
-        if opt.verbose:
-          print "Calculating / sending regional all instances"
-        for region in regionalData.items():
-          sock.sendall("%s %s %d\n" % (opt.prefix + "." + region[0] +
-                                       ".allInstances",
-                                       (region[1]["numberAllInstances"]
-                                        *int(opt.scale)),
-                                       ts))
-          csvwriter.writerow([(opt.prefix + "." + region[0] + ".AllInstances"),
-                              str(region[1]["numberAllInstances"]),
-                              str(ts)])
-
-      # Total all instances calculate/send
-      if opt.verbose:
-        print "Calculating / sending total all instances"
-      numAll = sum(region[1]["numberAllInstances"] for region in
-                     regionalData.items())
-      sock.sendall("%s %s %d\n" % (opt.prefix + ".total.allInstances",
-                                   (numAll*int(opt.scale)),
-                                   ts))
-      csvwriter.writerow([opt.prefix + ".total.allInstances",
-                          str(numAll),
-                          str(ts)])
 
 
+def sendMetricsToGrok(opt, transport=None):
+  """Collects data for burnrate metrics, writes it to a csv file and
+  sends it to Grok.
+
+  :param transport: GrokTransport to queue the metrics on; by default one is
+    created for this collection and closed once the metrics are sent or
+    --sendtimeout expires.
+
+  :returns: list of (metric name, value, ts) records
+  """
+  records = collectMetricBatch(opt)
+
+  with instrumentation.timer("stages.writeHistory.seconds"):
+    _writeHistory(opt, records)
+
+  sendRecords = records
+  emissionFilter = _getEmissionFilter(opt)
+  if emissionFilter is not None:
+    if (transport is not None and
+        transport.linesDropped > _emissionLinesDropped.get(opt.emissionFile,
+                                                           0)):
+      # The shared transport dropped lines queued by earlier collections, so
+      # the values they carried may not have reached Grok
+      emissionFilter.reset()
+    sendRecords = emissionFilter.filter(records)
+    if opt.verbose:
+      print "Suppressed %d unchanged metrics" % (len(records) -
+                                                 len(sendRecords))
+
+  data = formatGrokLines(sendRecords, int(opt.scale))
+
+  if transport is not None:
+    with instrumentation.timer("stages.send.seconds"):
+      transport.send(data)
+    if emissionFilter is not None:
+      # Queued lines are sent eventually unless dropped, which the next
+      # collection checks for
+      _emissionLinesDropped[opt.emissionFile] = transport.linesDropped
+      emissionFilter.commit()
+      emissionFilter.save()
+    if opt.verbose:
+      print "Queued %d metrics for Grok" % len(sendRecords)
+      print "Done!"
+    return records
+
+  with instrumentation.timer("stages.send.seconds"):
+    transport = _createTransport(opt)
+    transport.send(data)
+    allSent = transport.close(timeout=opt.sendTimeout)
+
+  if emissionFilter is not None and not transport.linesDropped:
+    # Journaled lines are sent by a later run before any newer ones, so only
+    # dropped lines need sending again
+    emissionFilter.commit()
+    emissionFilter.save()
+
+  if not allSent:
+    print >> sys.stderr, "Grok unreachable; {} {} metrics".format(
+      "journaled" if opt.journal else "dropped",
+      transport.linesJournaled if opt.journal else transport.linesDropped)
+
   if opt.verbose:
+    print "Sent %d metrics to Grok" % transport.linesSent
     print "Done!"
 
+  return records
+
 
 def writeMetricsToFile(opt):
-  """Collects data for burnrate metrics and writes it to a csv file."""
+  """Collects data for burnrate metrics and writes it to a csv file.
 
-  regionalData = getDataByRegions()
-  ts = time.mktime(datetime.datetime.utcnow().timetuple())
+  :returns: list of (metric name, value, ts) records
+  """
 
-  with open(opt.outputfile, "ab") as csvfile:
-    csvwriter = csv.writer(csvfile)
-
-    # Regional burn rate calculation/send
-    if opt.regionalBurnrates:
-      if opt.verbose:
-        print "Calculating / writing regional hourly burn rates"
-      for region in regionalData.items():
-        csvwriter.writerow([(opt.prefix + "." + region[0] + ".burnrate"),
-                            str(region[1]["burnrate"]),
-                            str(ts)])
-
-    # Total burn rate calculation/send
-    if opt.verbose:
-      print "Calculating / writing total hourly burn rate"
-    burnrate = sum(region[1]["burnrate"] for region in regionalData.items())
-    csvwriter.writerow([opt.prefix + ".total.burnrate",
-                        str(burnrate),
-                        str(ts)])
-
-    # Regional running instances calculate/send
-    if opt.regionalRunning:
-      if opt.verbose:
-        print "Calculating / writing regional running instances"
-      for region in regionalData.items():
-        csvwriter.writerow([(opt.prefix + "." + region[0] +
-                             ".runningInstances"),
-                            str(region[1]["numberRunningInstances"]),
-                            str(ts)])
-    # Total running instances calculate/send
-    if opt.verbose:
-      print "Calculating / writing total running instances"
-    numRunning = sum(region[1]["numberRunningInstances"] for region in
-                   regionalData.items())
-    csvwriter.writerow([opt.prefix + ".total.runningInstances",
-                        str(numRunning),
-                        str(ts)])
-
-    # Regional stopped instances calculate/send
-    if opt.regionalStopped:
-      if opt.verbose:
-        print "Calculating / writing regional stopped instances"
-      for region in regionalData.items():
-        csvwriter.writerow([(opt.prefix + "." + region[0] +
-                             ".stoppedInstances"),
-                            str(region[1]["numberStoppedInstances"]),
-                            str(ts)])
-
-    # Total stopped instances calculate/send
-    if opt.verbose:
-      print "Calculating / writing total stopped instances"
-    numStopped = sum(region[1]["numberStoppedInstances"] for region in
-                   regionalData.items())
-    csvwriter.writerow([opt.prefix + ".total.stoppedInstances",
-                        str(numStopped),
-                        str(ts)])
-
-    # Regional total instances calculate/send
-    if opt.regionalAll:
-      if opt.verbose:
-        print "Calculating / writing regional all instances"
-      for region in regionalData.items():
-        csvwriter.writerow([(opt.prefix + "." + region[0] +
-                             ".allInstances"),
-                            str(region[1]["numberAllInstances"]),
-                            str(ts)])
-
-    # Total total instances calculate/send
-    if opt.verbose:
-      print "Calculating / writing total all instances"
-    numAll = sum(region[1]["numberAllInstances"] for region in
-                   regionalData.items())
-    csvwriter.writerow([opt.prefix + ".total.allInstances",
-                        str(numAll),
-                        str(ts)])
+  records = collectMetricBatch(opt)
+
+  with instrumentation.timer("stages.writeHistory.seconds"):
+    _writeHistory(opt, records)
 
   if opt.verbose:
+    print "Wrote %d metrics to %s" % (len(records),
+                                      opt.historyDir or opt.outputfile)
     print "Done!"
 
+  return records
+
+
+
+class _PersistentGrokConnection(object):
+  """Grok socket that is kept open across sends and reopened after an
+  error"""
+
+  def __init__(self, server, apikey):
+    from grokcli.api import GrokSession
+    self._grok = GrokSession(server=server, apikey=apikey)
+    self._context = None
+    self._sock = None
+
+
+  def getSocket(self):
+    if self._sock is None:
+      self._context = self._grok.connect()
+      self._sock = self._context.__enter__()
+    return self._sock
+
+
+  def close(self):
+    if self._context is not None:
+      try:
+        self._context.__exit__(None, None, None)
+      except socket.error:
+        pass
+    self._context = None
+    self._sock = None
+
+
+
+def iterSchedule(interval, clock=time.time, sleep=time.sleep):
+  """Yield scheduled run times on a fixed interval
+
+  Run times are multiples of `interval` from the first run, so time spent in
+  each collection does not accumulate as drift. Runs missed because a
+  collection overran are skipped rather than run back-to-back.
+
+  :param float interval: seconds between runs
+  """
+  nextRun = clock()
+  while True:
+    now = clock()
+    if now < nextRun:
+      sleep(nextRun - now)
+
+    yield nextRun
+
+    nextRun += interval
+    now = clock()
+    if nextRun <= now:
+      missed = int((now - nextRun) // interval) + 1
+      print >> sys.stderr, "Collection overran; skipping {} run(s)".format(
+        missed)
+      nextRun += missed * interval
+
+
+
+def runDaemon(opt):
+  """Collect metrics every `opt.interval` seconds until interrupted, keeping
+  the price table, EC2 connections and Grok transport warm between runs.
+
+  With --metricsport, the latest metrics are also served over HTTP for
+  pull-based pollers such as Prometheus.
+  """
+  from calculate_burn_rate import loadPriceTable, startPriceTableRefresher
+
+  if opt.accounts:
+    # Fork the account workers once, before any threads are started, and
+    # after the price table is loaded so that they share it
+    from multi_account import startPool
+    loadPriceTable()
+    startPool(opt.processes)
+
+  startPriceTableRefresher()
+
+  snapshot = None
+  if opt.metricsPort:
+    from metrics_endpoint import MetricsServer, MetricsSnapshot
+    snapshot = MetricsSnapshot()
+    MetricsServer((opt.metricsHost, opt.metricsPort), snapshot).start()
+
+  transport = None
+  if not opt.noserver:
+    transport = _createTransport(opt)
+
+  try:
+    for _ in iterSchedule(opt.interval):
+      try:
+        with instrumentation.profiled(opt.profile):
+          if transport is not None:
+            records = sendMetricsToGrok(opt, transport=transport)
+          else:
+            records = writeMetricsToFile(opt)
+
+        if snapshot is not None:
+          snapshot.update(records)
+      except Exception:  # pylint: disable=W0703
+        print >> sys.stderr, "Collection failed:"
+        traceback.print_exc()
+  finally:
+    if transport is not None:
+      transport.close(timeout=opt.sendTimeout)
+    if opt.accounts:
+      from multi_account import stopPool
+      stopPool()
+
+
 
 if __name__ == "__main__":
   parser = OptionParser()
@@ -249,11 +443,56 @@ if __name__ == "__main__":
                     help="Grok API key.",
                     dest="key", default="")
   parser.add_option("-i", "--inputfile",
-                    help="File with existing burnrate data.",
+                    help="File with existing burnrate data; may be "
+                    "gzip-compressed (.gz).",
                     dest="inputfile", default="")
+  parser.add_option("--checkpoint",
+                    help="Record --inputfile replay progress in this file "
+                    "and resume from it.",
+                    dest="checkpoint", default="")
+  parser.add_option("--replayrate",
+                    help="Maximum metrics per second sent when replaying "
+                    "--inputfile; 0 for no limit. (default: %default)",
+                    dest="replayRate", type="float", default=0)
   parser.add_option("-o", "--outputfile",
                     help="File to output data to. (default: %default)",
                     dest="outputfile", default="burnrates.csv")
+  parser.add_option("--historydir",
+                    help="Record metrics in a partitioned, compressed history "
+                    "store in this directory instead of --outputfile.",
+                    dest="historyDir", default="")
+  parser.add_option("--journal",
+                    help="Spill metrics that cannot be sent to Grok to this "
+                    "file, and send them once Grok is reachable again.",
+                    dest="journal", default="")
+  parser.add_option("--sendtimeout",
+                    help="Seconds to wait for Grok to accept metrics before "
+                    "journaling or dropping them. (default: %default)",
+                    dest="sendTimeout", type="float", default=30)
+  parser.add_option("--changeonly",
+                    help="Only send metrics to Grok whose values moved out of "
+                    "the deadband around the value last sent, or that have "
+                    "not been sent for --heartbeat seconds. --outputfile and "
+                    "--historydir still record every value. "
+                    "(default: %default)",
+                    dest="changeOnly", action="store_true", default=False)
+  parser.add_option("--deadband",
+                    help="Changes up to this amount are not sent with "
+                    "--changeonly. (default: %default)",
+                    dest="deadband", type="float", default=0)
+  parser.add_option("--deadbandrelative",
+                    help="Changes up to this fraction of the value last sent "
+                    "are not sent with --changeonly. (default: %default)",
+                    dest="deadbandRelative", type="float", default=0)
+  parser.add_option("--heartbeat",
+                    help="Seconds after which --changeonly sends a metric "
+                    "even if it hasn't changed. (default: %default)",
+                    dest="heartbeat", type="float", default=3600)
+  parser.add_option("--emissionfile",
+                    help="Keep the values last sent with --changeonly in "
+                    "this file, so that cron-driven runs only send changes "
+                    "too.",
+                    dest="emissionFile", default="")
   parser.add_option("-v", "--verbose",
                     help="Run in verbose mode. (default: %default)",
                     dest="verbose", action="store_true", default=False)
@@ -272,40 +511,191 @@ if __name__ == "__main__":
   parser.add_option("-t",
                     help="Count total instances by region.",
                     dest="regionalAll", action="store_true", default=False)
+  parser.add_option("--breakdowns",
+                    help="Comma-separated breakdowns of burnrate and running "
+                    "instances to report: family, type and/or az.",
+                    dest="breakdowns", default="")
+  parser.add_option("--pricingmodels",
+                    help="Comma-separated Reserved Instance pricing models to "
+                    "also report the burnrate under, as if every running "
+                    "instance were billed that way: {}.".format(
+                      ", ".join(RESERVED_PRICING_MODELS)),
+                    dest="pricingModels", default="")
+  parser.add_option("--tags",
+                    help="Comma-separated tag keys to report the burnrate and "
+                    "running instances by the values of, e.g. "
+                    "team,service,environment.",
+                    dest="tags", default="")
+  parser.add_option("--maxtagvalues",
+                    help="Maximum number of values reported per tag key; the "
+                    "values with the highest burnrates are reported, and the "
+                    "rest are summed as \"other\". (default: %default)",
+                    dest="maxTagValues", type="int", default=20)
+  parser.add_option("--forecasthours",
+                    help="Forecast the spend of the running instances over "
+                    "this many hours from their launch times, and report it; "
+                    "0 to disable. (default: %default)",
+                    dest="forecastHours", type="float", default=0)
+  parser.add_option("--accrualfile",
+                    help="Accrue the cost implied by each collection's "
+                    "burnrates in this file, and report the cost accrued "
+                    "over the last 1h, 24h, 7d and 30d.",
+                    dest="accrualFile", default="")
+  parser.add_option("--accrualmaxgap",
+                    help="Longest time in seconds between collections that "
+                    "is accrued with --accrualfile. (default: %default)",
+                    dest="accrualMaxGap", type="float", default=3600)
   parser.add_option("--prefix",
                     help="Prefix for burnrate metrics. (default: %default)",
                     dest="prefix", default="aws")
   parser.add_option("--scale",
                     help="Scale metrics by this integer. (default: %default)",
                     dest="scale", default=1)
+  parser.add_option("--concurrency",
+                    help="Maximum number of regions to query at once. "
+                    "(default: %default)",
+                    dest="concurrency", type="int", default=16)
+  parser.add_option("--regiontimeout",
+                    help="Seconds to wait for a region before skipping it. "
+                    "(default: %default)",
+                    dest="regionTimeout", type="float", default=60)
+  parser.add_option("--pagesize",
+                    help="Instances to request per DescribeInstances call. "
+                    "(default: %default)",
+                    dest="pageSize", type="int", default=1000)
+  parser.add_option("--scheduledir",
+                    help="Keep an adaptive polling schedule of the regions in "
+                    "this directory: regions whose instances don't change are "
+                    "polled less and less often, and report their last "
+                    "values in between.",
+                    dest="scheduleDir", default="")
+  parser.add_option("--maxactiveinterval",
+                    help="Maximum seconds between polls of a region with "
+                    "instances with --scheduledir. (default: %default)",
+                    dest="maxActivePollInterval", type="float", default=900)
+  parser.add_option("--maxidleinterval",
+                    help="Maximum seconds between polls of an empty or "
+                    "failing region with --scheduledir. (default: %default)",
+                    dest="maxIdlePollInterval", type="float", default=21600)
+  parser.add_option("--accounts",
+                    help="JSON file listing the AWS accounts to collect, "
+                    "with their credentials and metric prefixes, instead of "
+                    "the single account in the environment.",
+                    dest="accounts", default="")
+  parser.add_option("--processes",
+                    help="Number of accounts to collect at once with "
+                    "--accounts. (default: %default)",
+                    dest="processes", type="int", default=4)
+  parser.add_option("-d", "--daemon",
+                    help="Keep running and collect every --interval seconds. "
+                    "(default: %default)",
+                    dest="daemon", action="store_true", default=False)
+  parser.add_option("--interval",
+                    help="Seconds between collections in daemon mode. "
+                    "(default: %default)",
+                    dest="interval", type="float", default=300)
+  parser.add_option("--metricsport",
+                    help="In daemon mode, serve the latest metrics for "
+                    "Prometheus and other pollers over HTTP on this port; 0 "
+                    "to disable. (default: %default)",
+                    dest="metricsPort", type="int", default=0)
+  parser.add_option("--metricshost",
+                    help="Address to serve --metricsport on. "
+                    "(default: all interfaces)",
+                    dest="metricsHost", default="")
+  parser.add_option("--meta",
+                    help="Also report the collector's own stage and region "
+                    "timings, API calls, bytes sent, cache hits and misses, "
+                    "unknown prices and peak memory as <prefix>.meta.* "
+                    "metrics. (default: %default)",
+                    dest="meta", action="store_true", default=False)
+  parser.add_option("--profile",
+                    help="Profile each collection and write the statistics "
+                    "to this file in pstats format.",
+                    dest="profile", default="")
+  parser.add_option("--priceregions",
+                    help="Comma-separated regions whose offer files the "
+                    "price table is built from, instead of the complete "
+                    "offers file.",
+                    dest="priceRegions", default="")
+  parser.add_option("--prewarm",
+                    help="Build or refresh the price table cache if it has "
+                    "expired, then exit without collecting, so that later "
+                    "runs start warm; e.g. from a separate cron job. "
+                    "(default: %default)",
+                    dest="prewarm", action="store_true", default=False)
 
 
   opt, arg = parser.parse_args(sys.argv[1:])
 
+  if opt.metricsPort and not opt.daemon:
+    parser.error("--metricsport requires --daemon")
+
+  for breakdown in opt.breakdowns.split(",") if opt.breakdowns else ():
+    if breakdown not in BREAKDOWNS:
+      parser.error("Unknown breakdown {!r}; expected one of {}".format(
+        breakdown, ", ".join(BREAKDOWNS)))
+
+  for model in opt.pricingModels.split(",") if opt.pricingModels else ():
+    if model not in RESERVED_PRICING_MODELS:
+      parser.error("Unknown pricing model {!r}; expected one of {}".format(
+        model, ", ".join(RESERVED_PRICING_MODELS)))
+
+  if opt.maxTagValues < 1:
+    parser.error("--maxtagvalues must be at least 1")
+
+  if opt.forecastHours < 0:
+    parser.error("--forecasthours must not be negative")
+
   path = os.path.dirname(os.path.abspath(__file__))
 
+  if opt.prewarm:
+    from calculate_burn_rate import prewarmPriceTable, setPriceTableRegions
+    if opt.priceRegions:
+      setPriceTableRegions(opt.priceRegions.split(","))
+    status = prewarmPriceTable()
+    if status["ageSec"] is None:
+      print >> sys.stderr, "Price table is being built by another process"
+      sys.exit(1)
+    if opt.verbose:
+      print "Price table is %.0f seconds old" % status["ageSec"]
+    sys.exit(0)
+
   if ((opt.server=="" or opt.key=="") and not opt.noserver):
     print ("burnrate_collect_data.py -s <server> -k <key>")
     sys.exit(2)
 
   if opt.inputfile != "" and not opt.noserver:
+    from grokcli.api import GrokSession
+    from metric_replay import replayHistory
+
     if opt.verbose:
       print "Sending existing data to grok..."
-    with open(opt.inputfile, "rb") as inputFile:
-      grok = GrokSession(server=opt.server, apikey=opt.key)
-      with grok.connect() as sock:
-        csvreader = csv.reader(inputFile)
-        for row in csvreader:
-          metricName = row[0]
-          data = float(row[1])
-          ts = row[2]
-          sock.sendall("%s %s %s\n" % (metricName, (data*int(opt.scale)),
-                                       int(float(ts))))
+    grok = GrokSession(server=opt.server, apikey=opt.key)
+    with grok.connect() as sock:
+      numSent = replayHistory(opt.inputfile, sock, scale=int(opt.scale),
+                              maxRecordsPerSec=opt.replayRate or None,
+                              checkpointPath=opt.checkpoint or None)
+    if opt.verbose:
+      print "Sent %d metrics to Grok" % numSent
   else:
+    if opt.priceRegions:
+      from calculate_burn_rate import setPriceTableRegions
+      setPriceTableRegions(opt.priceRegions.split(","))
+
     if not os.path.isfile(opt.outputfile):
       open(opt.outputfile, "w").close()
 
-    if not opt.noserver:
-      sendMetricsToGrok(opt)
+    startupSec = time.time() - _startTime
+    instrumentation.setValue("process.startupSeconds", startupSec)
+    if opt.verbose:
+      print "Started in %.3f seconds" % startupSec
+
+    if opt.daemon:
+      runDaemon(opt)
     else:
-      writeMetricsToFile(opt)
+      with instrumentation.profiled(opt.profile):
+        if not opt.noserver:
+          sendMetricsToGrok(opt)
+        else:
+          writeMetricsToFile(opt)
@@ -17,65 +17,418 @@
 
 """ This script calculates various metrics related to AWS hourly burn rate."""
 
+import contextlib
+import errno
+import fcntl
+import json
+import Queue
 import shutil
 import os
 import sys
 import tempfile
+import threading
 import time
+import traceback
 
-import boto
-import boto.exception
-from boto.ec2 import regions
-
+from describe_instances import (buildDescribeInstancesParams,
+                                DescribeInstancesPage)
+import instrumentation
 import price_table_builder
+from region_scheduler import RegionScheduler
+import spend_forecast
+from tag_attribution import DEFAULT_MAX_TAG_VALUES, TagAttribution
+
+
+
+_DEFAULT_MAX_CONCURRENCY = 16
+_DEFAULT_REGION_TIMEOUT_SEC = 60
+_DEFAULT_PAGE_SIZE = 1000
+_DEFAULT_PRICE_REFRESH_INTERVAL_SEC = 3600
+_DEFAULT_MAX_ACTIVE_POLL_INTERVAL_SEC = 900
+_DEFAULT_MAX_IDLE_POLL_INTERVAL_SEC = 6 * 3600
+
+# Terminated instances are neither billed nor counted
+_INSTANCE_STATE_FILTER = {
+  "instance-state-name": ["pending", "running", "shutting-down", "stopping",
+                          "stopped"]
+}
+
+# Hourly rate reported for instances missing from the price table; much higher
+# than any real hourly rate, so that Grok recognizes it as an anomaly
+_UNKNOWN_PRICE = {"USD": 50.00}
+
+# (access key id, region name) -> EC2Connection, reused across collections by long-running
+# collectors
+_connectionPool = {}
+_connectionPoolLock = threading.Lock()
+
+# Schedule directory -> RegionScheduler
+_schedulers = {}
+_schedulersLock = threading.Lock()
 
 
 
 class _PriceTable(object):
-  _CACHE_FILE_PATH = "/tmp/burnrate_instance_price_table.json"
+  _CACHE_FILE_PATH = "/tmp/burnrate_instance_price_table.bin"
+  _VALIDATORS_FILE_PATH = "/tmp/burnrate_instance_price_table.validators.json"
+  _LOCK_FILE_PATH = "/tmp/burnrate_instance_price_table.lock"
   _MAX_CACHE_AGE_SEC = (24 * 3600)
 
-  # Price table singleton in format returned by `price_table_builder.load()`
+  # Bumped when the cache gains contents that older versions didn't build, so
+  # that a cache from before the change is rebuilt even if the offers are
+  # unchanged
+  _CACHE_FORMAT_VERSION = 2
+
+  # Regions whose offer files the table is built from; None for all regions
+  _regions = None
+
+  # Price table singleton as returned by `price_table_builder.loadBinary()`
   _priceTableSingleton = None
 
+  # Modification time of the cache file that the singleton was loaded from
+  _loadedCacheMtime = None
+
+  # Thread revalidating an expired cache in the background, if any
+  _revalidationThread = None
+  _revalidationThreadLock = threading.Lock()
+
 
   @classmethod
   def getTable(cls):
     """Return price table, possibly loading it from file and rebuilding cache
     if needed
+
+    An expired cache is still returned while it is revalidated in the
+    background; only a missing cache makes the caller wait for a build.
     """
     if cls._priceTableSingleton is not None:
       return cls._priceTableSingleton
 
-    needToRebuild = True
+    if cls._isCacheFresh():
+      instrumentation.increment("priceTable.cacheHits")
+    elif os.path.exists(cls._CACHE_FILE_PATH):
+      instrumentation.increment("priceTable.cacheMisses")
+      cls._startRevalidation()
+    else:
+      instrumentation.increment("priceTable.cacheMisses")
+      with cls._lockCache(blocking=True):
+        # Another process may have built the cache while we waited
+        if not os.path.exists(cls._CACHE_FILE_PATH):
+          cls._rebuildCache()
+
+    cls._loadCache()
 
-    # Check if cache needs to be rebuilt
-    if os.path.exists(cls._CACHE_FILE_PATH):
+    return cls._priceTableSingleton
+
+
+  @classmethod
+  def refresh(cls):
+    """Rebuild the cache if it has expired and swap the new table in.
+
+    Only one process rebuilds at a time; if another one already is, the
+    expired table is kept until it is done. Lookups in progress keep using
+    the table they already hold.
+    """
+    if not cls._isCacheFresh():
+      with cls._lockCache(blocking=False) as locked:
+        # Another process may have rebuilt the cache since we checked
+        if locked and not cls._isCacheFresh():
+          instrumentation.increment("priceTable.cacheMisses")
+          cls._rebuildCache()
+
+    cls.reloadIfChanged()
+
+
+  @classmethod
+  def reloadIfChanged(cls):
+    """Load the cache file if it changed since the table was loaded"""
+    if not os.path.exists(cls._CACHE_FILE_PATH):
+      return
+
+    if (cls._priceTableSingleton is None or
+        os.path.getmtime(cls._CACHE_FILE_PATH) != cls._loadedCacheMtime):
+      cls._loadCache()
+
+
+  @classmethod
+  def getStatus(cls):
+    """
+    :returns: dict with keys "ageSec", seconds since the table in use (or else
+      the cache file) was built or last revalidated, None if there is neither;
+      "stale", whether that exceeds the maximum cache age; and "revalidating",
+      whether a background revalidation is in progress
+    """
+    mtime = cls._loadedCacheMtime
+    if mtime is None and os.path.exists(cls._CACHE_FILE_PATH):
       mtime = os.path.getmtime(cls._CACHE_FILE_PATH)
-      if (time.time() - mtime) <= cls._MAX_CACHE_AGE_SEC:
-        needToRebuild = False
 
-    if needToRebuild:
-      # Regnereate the pricing table
+    ageSec = (time.time() - mtime) if mtime is not None else None
 
-      # Create new pricing cache in temp file first, then move to static
-      # location, to minimize window for corruption
-      tempFd, tempPath = tempfile.mkstemp(
-        suffix="burnrate_instance_price_table")
+    with cls._revalidationThreadLock:
+      revalidating = (cls._revalidationThread is not None and
+                      cls._revalidationThread.is_alive())
 
-      with os.fdopen(tempFd, "wb") as fileObj:
-        price_table_builder.dump(fileObj)
+    return {"ageSec": ageSec,
+            "stale": ageSec is None or ageSec > cls._MAX_CACHE_AGE_SEC,
+            "revalidating": revalidating}
 
-      shutil.move(tempPath, cls._CACHE_FILE_PATH)
 
-      print >> sys.stderr, "(Re)built {}".format(cls._CACHE_FILE_PATH)
+  @classmethod
+  def _startRevalidation(cls):
+    """Refresh the table in a background thread, unless one already is
 
-    # Load into memory
-    with open(cls._CACHE_FILE_PATH) as inputFp:
-      cls._priceTableSingleton = price_table_builder.load(inputFp)
+    The thread is not a daemon thread, so a short-lived collector finishes
+    the rebuild before it exits and the next run finds a fresh cache.
+    """
+    def revalidate():
+      try:
+        cls.refresh()
+      except Exception:  # pylint: disable=W0703
+        print >> sys.stderr, "Price table revalidation failed:"
+        traceback.print_exc()
 
-    return cls._priceTableSingleton
+    with cls._revalidationThreadLock:
+      if (cls._revalidationThread is not None and
+          cls._revalidationThread.is_alive()):
+        return
+
+      cls._revalidationThread = threading.Thread(
+        target=revalidate, name="PriceTableRevalidation")
+      cls._revalidationThread.start()
+
+
+  @classmethod
+  @contextlib.contextmanager
+  def _lockCache(cls, blocking):
+    """Context manager holding the cache file lock, which is shared by every
+    collector on the host, while the cache is rebuilt
+
+    :param bool blocking: wait for the lock; otherwise give up if another
+      process holds it
+
+    :returns: yields whether the lock was acquired
+    """
+    fd = os.open(cls._LOCK_FILE_PATH, os.O_RDWR | os.O_CREAT, 0666)
+    try:
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+      except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+          raise
+        yield False
+        return
+
+      try:
+        yield True
+      finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+      os.close(fd)
+
+
+  @classmethod
+  def _isCacheFresh(cls):
+    if not os.path.exists(cls._CACHE_FILE_PATH):
+      return False
+
+    mtime = os.path.getmtime(cls._CACHE_FILE_PATH)
+    return (time.time() - mtime) <= cls._MAX_CACHE_AGE_SEC
+
+
+  @classmethod
+  def _rebuildCache(cls):
+    with instrumentation.timer("stages.priceTableRebuild.seconds"):
+      cls._rebuildCacheUntimed()
+
+
+  @classmethod
+  def _rebuildCacheUntimed(cls):
+    # Regnereate the pricing table, unless the offers it was built from are
+    # unchanged
+    validators = cls._loadValidators()
+
+    if cls._regions:
+      previousTable = None
+      if "regions" in validators:
+        previousTable = cls._priceTableSingleton
+        if previousTable is None:
+          with open(cls._CACHE_FILE_PATH, "rb") as inputFp:
+            previousTable = price_table_builder.loadBinary(inputFp)
+
+      priceMap, regionVersions = price_table_builder.fetchRegionalLookupTable(
+        cls._regions, versions=validators.get("regions"),
+        previousTable=previousTable)
+      validators = {"regions": regionVersions}
+    else:
+      priceMap, offersValidators = price_table_builder.fetchLookupTable(
+        validators=validators.get("offers"))
+      validators = {"offers": offersValidators}
+
+    validators["formatVersion"] = cls._CACHE_FORMAT_VERSION
+
+    if priceMap is None:
+      # Reset the cache's age so that we don't check again until it expires
+      os.utime(cls._CACHE_FILE_PATH, None)
+      print >> sys.stderr, "Offers unchanged; kept {}".format(
+        cls._CACHE_FILE_PATH)
+      return
+
+    # Create new pricing cache in temp file first, then move to static
+    # location, to minimize window for corruption
+    tempFd, tempPath = tempfile.mkstemp(
+      dir=os.path.dirname(cls._CACHE_FILE_PATH),
+      suffix="burnrate_instance_price_table")
 
+    with os.fdopen(tempFd, "wb") as fileObj:
+      price_table_builder.writeTable(priceMap, fileObj, outputFormat="binary")
+
+    shutil.move(tempPath, cls._CACHE_FILE_PATH)
+
+    tempFd, tempPath = tempfile.mkstemp(
+      dir=os.path.dirname(cls._VALIDATORS_FILE_PATH),
+      suffix="burnrate_instance_price_table_validators")
+
+    with os.fdopen(tempFd, "w") as fileObj:
+      json.dump(validators, fileObj)
+
+    shutil.move(tempPath, cls._VALIDATORS_FILE_PATH)
+
+    print >> sys.stderr, "(Re)built {}".format(cls._CACHE_FILE_PATH)
+
+
+  @classmethod
+  def _loadValidators(cls):
+    """Return the validators recorded when the cache was last built; empty if
+    there is no cache to revalidate, or it is of an older format
+    """
+    if not (os.path.exists(cls._CACHE_FILE_PATH) and
+            os.path.exists(cls._VALIDATORS_FILE_PATH)):
+      return {}
+
+    try:
+      with open(cls._VALIDATORS_FILE_PATH) as inputFp:
+        validators = json.load(inputFp)
+    except ValueError:
+      return {}
+
+    if validators.get("formatVersion") != cls._CACHE_FORMAT_VERSION:
+      return {}
+    return validators
+
+
+  @classmethod
+  def _loadCache(cls):
+    # Map into memory; entries are only paged in as they are looked up
+    with open(cls._CACHE_FILE_PATH, "rb") as inputFp:
+      cls._loadedCacheMtime = os.path.getmtime(cls._CACHE_FILE_PATH)
+      cls._priceTableSingleton = price_table_builder.loadBinary(inputFp)
+
+
+
+def setPriceTableRegions(regions):
+  """Build the price table from only the given regions' offer files
+
+  :param regions: region names, or None to use the complete offers file
+  """
+  _PriceTable._regions = sorted(regions) if regions else None
+
+
+
+def loadPriceTable():
+  """Load the price table now, rebuilding the cache if needed, rather than on
+  first use; e.g. before forking workers that should share it"""
+  _PriceTable.getTable()
+
+
+
+def prewarmPriceTable():
+  """Bring the price table cache up to date now, building it if it is missing
+  or has expired, so that later runs map it in milliseconds instead of
+  building or revalidating it themselves
+
+  Doesn't import boto, so it is cheap to run e.g. from a separate cron job.
+
+  :returns: dict as returned by `getPriceTableStatus`
+  """
+  _PriceTable.refresh()
+  return _PriceTable.getStatus()
+
+
+
+def getPriceTableStatus():
+  """Return the age and staleness of the price table
+
+  :returns: dict with keys "ageSec" (None if there is no table yet), "stale"
+    and "revalidating"
+  """
+  return _PriceTable.getStatus()
+
+
+
+def startPriceTableRefresher(interval=_DEFAULT_PRICE_REFRESH_INTERVAL_SEC):
+  """Start a daemon thread that periodically refreshes the price table, so a
+  long-running collector never blocks on a rebuild
+
+  :param float interval: seconds between checks for an expired price table
+
+  :returns: the started threading.Thread
+  """
+  def refresher():
+    while True:
+      time.sleep(interval)
+      try:
+        _PriceTable.refresh()
+      except Exception:  # pylint: disable=W0703
+        print >> sys.stderr, "Price table refresh failed:"
+        traceback.print_exc()
+
+  thread = threading.Thread(target=refresher, name="PriceTableRefresher")
+  thread.daemon = True
+  thread.start()
+  return thread
+
+
+
+
+def reloadPriceTable():
+  """Swap in the cached price table if another process, e.g. the parent of a
+  worker process, has rebuilt it since this process loaded its table"""
+  _PriceTable.reloadIfChanged()
+
+
+
+def discardPersistentState():
+  """Drop the in-memory region schedules, so that they are read again from
+  their directories; e.g. in a worker process that may not have been the last
+  to update them"""
+  with _schedulersLock:
+    _schedulers.clear()
+
+
+
+def resetAfterFork():
+  """Replace the locks and drop the connections and state inherited by a
+  forked child process
+
+  Another thread of the parent may have held a lock when it forked, which
+  would leave it locked in the child forever, and the parent's connections
+  must not be shared with it.
+  """
+  global _connectionPoolLock, _schedulersLock  # pylint: disable=W0603
+  _connectionPoolLock = threading.Lock()
+  _schedulersLock = threading.Lock()
+  _PriceTable._revalidationThreadLock = threading.Lock()
+  _PriceTable._revalidationThread = None
+
+  _connectionPool.clear()
+  _schedulers.clear()
+
+
+
+def _lookupPrice(priceKey):
+  """Return the prices of an (instance type, region, platform) key, or
+  `_UNKNOWN_PRICE` if the price table doesn't have it"""
+  return _PriceTable.getTable().get(priceKey) or _UNKNOWN_PRICE
 
 
 
@@ -90,37 +443,519 @@ def getBurnRate(instance):
   #warning: If this function comes across an instance not in the dictionary, it
   #         will return a rate of $50.00/hr (much higher than any real hourly
   #         rate) which should be recognized by Grok as an anomaly.
-  return _PriceTable.getTable().get(key, {"USD": 50.00})["USD"]
+  price = _lookupPrice(key)
+  if price is _UNKNOWN_PRICE:
+    instrumentation.increment("pricing.unknownPriceInstances")
+  return price["USD"]
 
 
 
-def getDataByRegions():
-  regionalData = {}
-  for r in regions():
-    try:
+def iterInstances(conn, filters=None, pageSize=_DEFAULT_PAGE_SIZE):
+  """Page through DescribeInstances, yielding one instance at a time
+
+  Each response is parsed as it is read, keeping only the fields the
+  collector uses, so at most one reservation's instances are held in memory
+  at once.
+
+  :param conn: boto.ec2.connection.EC2Connection
+  :param dict filters: DescribeInstances filters applied by the server;
+    defaults to instances in a billable or stopped state
+  :param int pageSize: maximum number of instances to request per page
+
+  :returns: generator of describe_instances.InstanceRecord
+  """
+  if filters is None:
+    filters = _INSTANCE_STATE_FILTER
+
+  nextToken = None
+  while True:
+    response = conn.make_request(
+      "DescribeInstances",
+      buildDescribeInstancesParams(filters, pageSize, nextToken),
+      verb="POST")
+    instrumentation.increment("api.describeInstances.calls")
+    if response.status != 200:
+      raise conn.ResponseError(response.status, response.reason,
+                               response.read())
+
+    page = DescribeInstancesPage(response, conn.region)
+    for instance in page:
+      yield instance
+
+    nextToken = page.nextToken
+    if not nextToken:
+      return
+
+
+
+# Breakdown name -> function from a (instance type, platform, availability
+# zone, stopped) combination to the group it is summed into
+_BREAKDOWN_KEYS = {
+  "family": lambda combination: combination[0].split(".", 1)[0],
+  "type": lambda combination: combination[0],
+  "az": lambda combination: combination[2],
+}
+
+
+
+def _getCombination(instance):
+  """Return the attributes of an instance that its price and breakdown
+  groups depend on
+
+  :returns: tuple (instance type, platform, availability zone, stopped)
+  """
+  return (instance.instance_type,
+          (instance.platform or "linux").lower(),
+          instance.placement,
+          instance.state == "stopped")
+
+
+
+class _RegionAggregator(object):
+  """Instance counts of one region by (instance type, platform, availability
+  zone, stopped) combination.
+
+  Instances are only counted; pricing and group-by sums run over the distinct
+  combinations, of which a fleet has far fewer than instances, so adding
+  breakdowns costs no extra work per instance.
+  """
+
+  def __init__(self, regionName):
+    self.regionName = regionName
+    # (instance type, platform, availability zone, stopped) -> count
+    self.counts = {}
+
+
+  def add(self, instance):
+    combination = _getCombination(instance)
+    self.counts[combination] = self.counts.get(combination, 0) + 1
+
+
+  def addCombination(self, combination, count):
+    """Adjust the count of a combination by `count`, which may be negative"""
+    count += self.counts.get(combination, 0)
+    if count:
+      self.counts[combination] = count
+    else:
+      del self.counts[combination]
+
+
+  def getData(self):
+    """
+    :returns: dict with keys "burnrate", "numberRunningInstances",
+      "numberStoppedInstances", "numberAllInstances", "modelBurnrates" and
+      "breakdowns". "modelBurnrates" maps each name in
+      `price_table_builder.RESERVED_PRICING_MODELS` to the burn rate if every
+      running instance were billed under that model, at the OnDemand price
+      where the model isn't offered for an instance. "breakdowns" maps each
+      name in `_BREAKDOWN_KEYS` to a dict of group ->
+      {"burnrate": ..., "numberRunningInstances": ...} over running instances.
+    """
+    priceTable = _PriceTable.getTable()
+    prices = {}
+
+    burnrate = 0.0
+    numRunning = 0
+    numStopped = 0
+    modelBurnrates = dict.fromkeys(price_table_builder.RESERVED_PRICING_MODELS,
+                                   0.0)
+    breakdowns = {name: {} for name in _BREAKDOWN_KEYS}
+
+    for combination, count in self.counts.iteritems():
+      if combination[3]:
+        numStopped += count
+        continue
+
+      priceKey = (combination[0], self.regionName, combination[1])
+      price = prices.get(priceKey)
+      if price is None:
+        price = priceTable.get(priceKey)
+        if price is None:
+          price = _UNKNOWN_PRICE
+        prices[priceKey] = price
+
+      if price is _UNKNOWN_PRICE:
+        instrumentation.increment("pricing.unknownPriceInstances", count)
+
+      cost = price["USD"] * count
+      burnrate += cost
+      numRunning += count
+
+      for model in price_table_builder.RESERVED_PRICING_MODELS:
+        modelBurnrates[model] += price.get(model, price["USD"]) * count
+
+      for name, getGroup in _BREAKDOWN_KEYS.iteritems():
+        group = breakdowns[name].setdefault(
+          getGroup(combination),
+          {"burnrate": 0.0, "numberRunningInstances": 0})
+        group["burnrate"] += cost
+        group["numberRunningInstances"] += count
+
+    return {"burnrate":burnrate,
+            "numberRunningInstances":numRunning,
+            "numberStoppedInstances":numStopped,
+            "numberAllInstances":numRunning+numStopped,
+            "modelBurnrates":modelBurnrates,
+            "breakdowns":breakdowns}
+
+
+
+def _iterAttributed(instances, regionName, attribution):
+  """Pass instances through, attributing the running ones to their tags
+
+  :param instances: iterable of describe_instances.InstanceRecord
+  :param str regionName: region of the instances
+  :param attribution: tag_attribution.TagAttribution
+  """
+  prices = {}
+
+  for instance in instances:
+    if instance.state != "stopped":
+      priceKey = (instance.instance_type, regionName,
+                  (instance.platform or "linux").lower())
+      price = prices.get(priceKey)
+      if price is None:
+        price = prices[priceKey] = _lookupPrice(priceKey)["USD"]
+      attribution.add(instance.tags, price)
+
+    yield instance
+
+
+
+def _iterLaunchCounted(instances, launchCounts):
+  """Pass instances through, counting the billed ones by instance type,
+  platform and launch minute
+
+  :param instances: iterable of describe_instances.InstanceRecord
+  :param dict launchCounts: (instance type, platform, launch minute) -> count
+    to add to
+  """
+  for instance in instances:
+    if instance.state in spend_forecast.BILLED_STATES:
+      key = (instance.instance_type, (instance.platform or "linux").lower(),
+             spend_forecast.getLaunchBin(instance.launch_time))
+      launchCounts[key] = launchCounts.get(key, 0) + 1
+
+    yield instance
+
+
+
+def _getLaunchSpend(launchCounts, regionName):
+  """Price the counts of `_iterLaunchCounted`
+
+  :returns: list of the hourly spend by launch minute
+  """
+  launchSpend = spend_forecast.newLaunchSpend()
+  for (instanceType, platform, launchBin), count in launchCounts.iteritems():
+    launchSpend[launchBin] += _lookupPrice(
+      (instanceType, regionName, platform))["USD"] * count
+  return launchSpend.tolist()
+
+
+
+def _getScheduler(scheduleDir, maxActiveInterval, maxIdleInterval):
+  """Return the region scheduler persisted in a directory, loading it if
+  needed"""
+  with _schedulersLock:
+    scheduler = _schedulers.get(scheduleDir)
+    if scheduler is None:
+      if not os.path.isdir(scheduleDir):
+        os.makedirs(scheduleDir)
+      scheduler = RegionScheduler(
+        os.path.join(scheduleDir, "region_schedule.json"))
+      _schedulers[scheduleDir] = scheduler
+
+  scheduler.maxActiveInterval = maxActiveInterval
+  scheduler.maxIdleInterval = maxIdleInterval
+  return scheduler
+
+
+
+def _getCredentials(credentials):
+  """Return the given (access key id, secret access key) pair, or the one in
+  the environment if None"""
+  if credentials is None:
+    return (os.environ["AWS_ACCESS_KEY_ID"],
+            os.environ["AWS_SECRET_ACCESS_KEY"])
+  return credentials
+
+
+
+def _getRegions():
+  """
+  :returns: list of boto.ec2.regioninfo.RegionInfo of all EC2 regions
+  """
+  # boto is imported on first use, so that runs that never query EC2, such as
+  # prewarming the price table, don't pay for importing it
+  from boto.ec2 import regions
+  return regions()
+
+
+
+def _getConnection(region, credentials=None):
+  """Return the pooled EC2 connection for a region, connecting if needed
+
+  :param region: boto.ec2.regioninfo.RegionInfo
+  :param tuple credentials: (access key id, secret access key); defaults to
+    AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY from the environment
+  """
+  import boto
+
+  accessKeyId, secretAccessKey = _getCredentials(credentials)
+
+  with _connectionPoolLock:
+    conn = _connectionPool.get((accessKeyId, region.name))
+    if conn is None:
       conn = boto.connect_ec2(
-        aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
-        aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
-        region = r
+        aws_access_key_id=accessKeyId,
+        aws_secret_access_key=secretAccessKey,
+        region = region
       )
-      reservations = conn.get_all_instances()
-      totalByRegion = 0.0
-      numStopped = 0
-      numRunning = 0
-
-      for reservation in reservations:
-        for instance in reservation.instances:
-          if instance.state == "stopped":
-            numStopped += 1
-          else:
-            totalByRegion = totalByRegion + getBurnRate(instance)
-            numRunning += 1
-
-      regionalData.update(
-        {"%s" % r.name: {"burnrate":totalByRegion,
-                         "numberRunningInstances":numRunning,
-                         "numberStoppedInstances":numStopped,
-                         "numberAllInstances":numRunning+numStopped}})
-    except boto.exception.EC2ResponseError:
-      pass
+      _connectionPool[(accessKeyId, region.name)] = conn
+
+    return conn
+
+
+
+def _discardConnection(regionName, credentials=None):
+  """Drop a region's pooled connection, e.g. after it failed or timed out"""
+  accessKeyId, _ = _getCredentials(credentials)
+  with _connectionPoolLock:
+    _connectionPool.pop((accessKeyId, regionName), None)
+
+
+
+def _getRegionData(region, pageSize=_DEFAULT_PAGE_SIZE, credentials=None,
+                   tagKeys=(),
+                   maxTagValues=DEFAULT_MAX_TAG_VALUES, forecast=False):
+  """Count instances and sum the hourly burn rate in one region
+
+  :param region: boto.ec2.regioninfo.RegionInfo
+  :param int pageSize: maximum number of instances to request per page
+  :param tuple credentials: (access key id, secret access key), or None for
+    the environment's
+  :param tagKeys: tag keys to attribute the burn rate of running instances to
+  :param int maxTagValues: maximum number of values reported per tag key
+  :param bool forecast: whether to count billed instances by launch minute
+    for `spend_forecast.forecastSpend`
+
+  :returns: dict as returned by `_RegionAggregator.getData`, with additional
+    keys "tags", mapping each of `tagKeys` to the groups returned by
+    `tag_attribution.TagAttribution.getData`, and "launchSpend", the hourly
+    spend of billed instances by launch minute if `forecast`, otherwise None
+  """
+  conn = _getConnection(region, credentials)
+
+  instances = iterInstances(conn, pageSize=pageSize)
+  attribution = None
+  if tagKeys:
+    attribution = TagAttribution(tagKeys, maxTagValues)
+    instances = _iterAttributed(instances, region.name, attribution)
+
+  launchCounts = None
+  if forecast:
+    launchCounts = {}
+    instances = _iterLaunchCounted(instances, launchCounts)
+
+  aggregator = _RegionAggregator(region.name)
+  for instance in instances:
+    aggregator.add(instance)
+  data = aggregator.getData()
+
+  data["tags"] = attribution.getData() if attribution is not None else {}
+  data["launchSpend"] = (_getLaunchSpend(launchCounts, region.name)
+                         if launchCounts is not None else None)
+  return data
+
+
+
+def collectRegionalData(maxConcurrency=_DEFAULT_MAX_CONCURRENCY,
+                        regionTimeout=_DEFAULT_REGION_TIMEOUT_SEC,
+                        pageSize=_DEFAULT_PAGE_SIZE, credentials=None,
+                        scheduleDir=None,
+                        maxActivePollInterval=(
+                          _DEFAULT_MAX_ACTIVE_POLL_INTERVAL_SEC),
+                        maxIdlePollInterval=_DEFAULT_MAX_IDLE_POLL_INTERVAL_SEC,
+                        tagKeys=(), maxTagValues=DEFAULT_MAX_TAG_VALUES,
+                        forecast=False):
+  """Query all EC2 regions concurrently
+
+  :param int maxConcurrency: maximum number of regions queried at once
+  :param float regionTimeout: seconds to wait for a single region before
+    giving up on it
+  :param int pageSize: maximum number of instances to request per
+    DescribeInstances page
+  :param tuple credentials: (access key id, secret access key) of the account
+    to query; defaults to the environment's
+  :param str scheduleDir: directory of the persistent region schedule; if
+    given, only the regions that are due are queried (see
+    `region_scheduler`), and the others report the data of their last query
+  :param float maxActivePollInterval: with `scheduleDir`, maximum seconds
+    between queries of a region with instances
+  :param float maxIdlePollInterval: with `scheduleDir`, maximum seconds
+    between queries of an empty or failing region
+  :param tagKeys: tag keys to attribute the burn rate of running instances to
+  :param int maxTagValues: maximum number of values reported per tag key and
+    region
+  :param bool forecast: whether to count billed instances by launch minute,
+    to forecast their spend
+
+  :returns: two-tuple (regionalData, failedRegions); regionalData maps region
+    name to the dict returned by `_getRegionData` for each region that
+    succeeded or was carried forward, and failedRegions maps region name to
+    the exception (or a timeout description) for each region that did not.
+  """
+  # Load the price table up front so that workers don't race to rebuild it
+  with instrumentation.timer("stages.priceTable.seconds"):
+    _PriceTable.getTable()
+
+  status = _PriceTable.getStatus()
+  instrumentation.setValue("priceTable.ageSeconds", status["ageSec"] or 0)
+  instrumentation.setValue("priceTable.stale", int(status["stale"]))
+
+  scheduler = None
+  if scheduleDir:
+    scheduler = _getScheduler(scheduleDir, maxActivePollInterval,
+                              maxIdlePollInterval)
+
+  regionalData = {}
+  failedRegions = {}
+
+  pending = Queue.Queue()
+  outstanding = set()
+  for region in _getRegions():
+    if scheduler is not None and not scheduler.isDue(region.name):
+      data = scheduler.getCarriedForward(region.name)
+      if data is not None:
+        regionalData[region.name] = data
+      instrumentation.increment("regions.skipped")
+      continue
+
+    pending.put(region)
+    outstanding.add(region.name)
+
+  instrumentation.increment("regions.polled", len(outstanding))
+
+  results = Queue.Queue()
+
+  # Region name -> time a worker started querying it, until it is done
+  inFlight = {}
+
+  # Regions given up on; their workers have been replaced, and must exit
+  # rather than take more regions once their query returns
+  abandoned = set()
+  inFlightLock = threading.Lock()
+
+  def worker():
+    while True:
+      try:
+        region = pending.get_nowait()
+      except Queue.Empty:
+        return
+
+      with inFlightLock:
+        inFlight[region.name] = time.time()
+      try:
+        with instrumentation.timer("regions.%s.seconds" % region.name):
+          data = _getRegionData(region, pageSize, credentials, tagKeys,
+                                maxTagValues, forecast)
+        results.put((region.name, data, None))
+      except Exception as e:  # pylint: disable=W0703
+        results.put((region.name, None, e))
+
+      with inFlightLock:
+        del inFlight[region.name]
+        if region.name in abandoned:
+          return
+
+  def startWorker():
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+
+  for _ in xrange(min(max(maxConcurrency, 1), len(outstanding))):
+    startWorker()
+
+  polledData = {}
+
+  while outstanding:
+    now = time.time()
+
+    # Abandon regions that have exceeded their timeout; their worker can't be
+    # interrupted, so start a replacement to keep the pool at full strength,
+    # and have the stuck worker exit once its query returns
+    with inFlightLock:
+      timedOut = [name for name, startTime in inFlight.iteritems()
+                  if name in outstanding and now - startTime > regionTimeout]
+      abandoned.update(timedOut)
+      deadlines = [startTime + regionTimeout - now
+                   for name, startTime in inFlight.iteritems()
+                   if name in outstanding and name not in abandoned]
+
+    for name in timedOut:
+      outstanding.remove(name)
+      failedRegions[name] = "Timed out after {}s".format(regionTimeout)
+      _discardConnection(name, credentials)
+      if not pending.empty():
+        startWorker()
+
+    if not outstanding:
+      break
+
+    try:
+      name, data, error = results.get(
+        timeout=max(min(deadlines), 0.01) if deadlines else 0.1)
+    except Queue.Empty:
+      continue
+
+    if name not in outstanding:
+      # Late result from a region that already timed out
+      continue
+
+    outstanding.remove(name)
+    if error is None:
+      polledData[name] = data
+    else:
+      failedRegions[name] = error
+      _discardConnection(name, credentials)
+
+  instrumentation.increment("regions.failures", len(failedRegions))
+
+  regionalData.update(polledData)
+
+  if scheduler is not None:
+    for name, data in polledData.iteritems():
+      scheduler.recordSuccess(name, data)
+    for name in failedRegions:
+      scheduler.recordFailure(name)
+    scheduler.save()
+
+  return regionalData, failedRegions
+
+
+
+def getDataByRegions(maxConcurrency=_DEFAULT_MAX_CONCURRENCY,
+                     regionTimeout=_DEFAULT_REGION_TIMEOUT_SEC,
+                     pageSize=_DEFAULT_PAGE_SIZE, scheduleDir=None,
+                     maxActivePollInterval=(
+                       _DEFAULT_MAX_ACTIVE_POLL_INTERVAL_SEC),
+                     maxIdlePollInterval=_DEFAULT_MAX_IDLE_POLL_INTERVAL_SEC,
+                     tagKeys=(), maxTagValues=DEFAULT_MAX_TAG_VALUES,
+                     forecast=False):
+  """Collect burn rate data from all regions, reporting failed regions to
+  stderr
+
+  :returns: dict of region name to the dict returned by `_getRegionData`; only
+    regions that were queried successfully or carried forward are included.
+  """
+  regionalData, failedRegions = collectRegionalData(
+    maxConcurrency=maxConcurrency, regionTimeout=regionTimeout,
+    pageSize=pageSize, scheduleDir=scheduleDir,
+    maxActivePollInterval=maxActivePollInterval,
+    maxIdlePollInterval=maxIdlePollInterval, tagKeys=tagKeys,
+    maxTagValues=maxTagValues, forecast=forecast)
+
+  for name, error in sorted(failedRegions.iteritems()):
+    print >> sys.stderr, "Failed to collect region {}: {}".format(name, error)
+
   return regionalData
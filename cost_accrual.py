@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Accrues the cost implied by successive burn rate samples over rolling
+time windows.
+
+Between two samples of a series, the earlier hourly rate is taken to have
+applied for the time in between, and the cost it implies is added to each
+window. Each window is a ring of equal-width buckets with a running sum, so
+a sample costs constant time however long the window is, and buckets that
+fall out of the window are dropped as time advances. The reported windows may
+be up to one bucket, 1/60th of their length, longer than nominal.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+
+
+# (name, seconds) of the reported windows
+WINDOWS = (
+  ("1h", 3600),
+  ("24h", 24 * 3600),
+  ("7d", 7 * 24 * 3600),
+  ("30d", 30 * 24 * 3600),
+)
+
+# Name of the accrued cost metric of a window, e.g. "accruedCost24h"
+ACCRUED_COST_METRIC = "accruedCost%s"
+
+_BUCKETS_PER_WINDOW = 60
+
+_DEFAULT_MAX_GAP_SEC = 3600
+
+
+
+class _RingWindow(object):
+  """Sum of the amounts added within the last `length` seconds"""
+
+  def __init__(self, length, state=None):
+    self._width = float(length) / _BUCKETS_PER_WINDOW
+
+    if state is None:
+      self._buckets = [0.0] * _BUCKETS_PER_WINDOW
+      # Number of the newest bucket, counted in bucket widths since the epoch
+      self._head = None
+      self.total = 0.0
+    else:
+      self._buckets = state["buckets"]
+      self._head = state["head"]
+      self.total = sum(self._buckets)
+
+
+  def advance(self, ts):
+    """Drop the buckets that are no longer within the window at `ts`"""
+    bucket = int(ts // self._width)
+
+    if self._head is None or bucket - self._head >= _BUCKETS_PER_WINDOW:
+      self._buckets = [0.0] * _BUCKETS_PER_WINDOW
+      self.total = 0.0
+    else:
+      for number in xrange(self._head + 1, bucket + 1):
+        index = number % _BUCKETS_PER_WINDOW
+        self.total -= self._buckets[index]
+        self._buckets[index] = 0.0
+
+    if self._head is None or bucket > self._head:
+      self._head = bucket
+
+
+  def add(self, amount, ts):
+    self.advance(ts)
+    # Amounts from before the newest bucket, e.g. after the clock was set
+    # back, are counted in the newest bucket
+    self._buckets[self._head % _BUCKETS_PER_WINDOW] += amount
+    self.total += amount
+
+
+  def getState(self):
+    return {"buckets": self._buckets, "head": self._head}
+
+
+
+class CostAccrual(object):
+  """Accrued cost of burn rate series over the `WINDOWS`"""
+
+  def __init__(self, path=None, maxGap=_DEFAULT_MAX_GAP_SEC):
+    """
+    :param str path: file the accrued costs are persisted to, or None to keep
+      them in memory only
+    :param float maxGap: longest time in seconds between two samples of a
+      series that is accrued; a longer gap, e.g. while the collector was
+      down, accrues nothing, rather than assuming the earlier rate held
+    """
+    self._path = path
+    self._maxGap = maxGap
+
+    # Series name -> {"ts": time of the last sample, "rate": its hourly rate,
+    #                 "windows": [_RingWindow for each of WINDOWS]}
+    self._series = {}
+
+    if path is not None and os.path.exists(path):
+      with open(path) as fp:
+        for name, state in json.load(fp).iteritems():
+          self._series[str(name)] = {
+            "ts": state["ts"],
+            "rate": state["rate"],
+            "windows": [_RingWindow(length, windowState)
+                        for (_, length), windowState
+                        in zip(WINDOWS, state["windows"])]
+          }
+
+
+  def addSample(self, name, rate, ts):
+    """Accrue a series' cost up to a new burn rate sample
+
+    :param str name: series name, e.g. "aws.us-east-1"
+    :param float rate: burn rate in US$ per hour at `ts`
+    :param float ts: time of the sample, in seconds
+
+    :returns: list of ("<name>.accruedCost<window>", US$ accrued within the
+      window, ts) records
+    """
+    series = self._series.get(name)
+    if series is None:
+      series = self._series[name] = {
+        "ts": ts, "rate": rate,
+        "windows": [_RingWindow(length) for _, length in WINDOWS]}
+
+    elapsed = ts - series["ts"]
+    amount = 0.0
+    if 0 < elapsed <= self._maxGap:
+      amount = series["rate"] * elapsed / 3600.0
+
+    records = []
+    for (windowName, _), window in zip(WINDOWS, series["windows"]):
+      window.add(amount, ts)
+      records.append(("%s.%s" % (name, ACCRUED_COST_METRIC % windowName),
+                      max(window.total, 0.0), ts))
+
+    if ts >= series["ts"]:
+      series["ts"] = ts
+      series["rate"] = rate
+
+    return records
+
+
+  def save(self):
+    if self._path is None:
+      return
+
+    state = {
+      name: {"ts": series["ts"], "rate": series["rate"],
+             "windows": [window.getState() for window in series["windows"]]}
+      for name, series in self._series.iteritems()
+    }
+
+    # Write to a temp file first, then move into place, to minimize window for
+    # corruption
+    tempFd, tempPath = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(self._path)),
+      suffix=".burnrate_accrual")
+    with os.fdopen(tempFd, "w") as fp:
+      json.dump(state, fp)
+
+    shutil.move(tempPath, self._path)
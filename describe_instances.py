@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Lean parsing of EC2 DescribeInstances responses.
+
+boto's `get_all_instances` builds a full `Instance` object for every instance,
+with its block device mappings, security groups, network interfaces and so
+on, of which the collector reads a handful of fields. Here the response is
+parsed incrementally as it is read, one reservation's instances at a time,
+and only those fields are kept, in `InstanceRecord`s with `__slots__`.
+"""
+
+from xml.etree import cElementTree
+
+
+
+class InstanceRecord(object):
+  """The fields of an EC2 instance that the collector reads, named like those
+  of boto.ec2.instance.Instance"""
+
+  __slots__ = ("id", "state", "instance_type", "region", "platform",
+               "placement", "launch_time", "tags")
+
+  def __init__(self, instanceId, state, instanceType, region, platform,
+               placement, launchTime, tags):
+    self.id = instanceId
+    self.state = state
+    self.instance_type = instanceType
+    self.region = region
+    self.platform = platform
+    self.placement = placement
+    self.launch_time = launchTime
+    self.tags = tags
+
+
+
+def buildDescribeInstancesParams(filters=None, maxResults=None,
+                                 nextToken=None):
+  """Build the query parameters of a DescribeInstances request
+
+  :param dict filters: filter name -> value or list of values
+  :param int maxResults: maximum number of instances to return
+  :param str nextToken: token of the page to return
+
+  :returns: dict of parameter name -> value
+  """
+  params = {}
+  for i, (name, values) in enumerate(sorted((filters or {}).iteritems()), 1):
+    params["Filter.%d.Name" % i] = name
+    if not isinstance(values, list):
+      values = [values]
+    for j, value in enumerate(values, 1):
+      params["Filter.%d.Value.%d" % (i, j)] = value
+
+  if maxResults is not None:
+    params["MaxResults"] = maxResults
+  if nextToken is not None:
+    params["NextToken"] = nextToken
+
+  return params
+
+
+
+class DescribeInstancesPage(object):
+  """Iterable of the `InstanceRecord`s in one DescribeInstances response
+
+  `nextToken` is set once the response has been iterated through.
+  """
+
+  def __init__(self, fp, region):
+    """
+    :param fp: file-like object of the response body, e.g. an
+      httplib.HTTPResponse
+    :param region: boto.ec2.regioninfo.RegionInfo the instances are in
+    """
+    self._fp = fp
+    self._region = region
+    self.nextToken = None
+
+
+  def __iter__(self):
+    # Qualified names of the elements read, e.g. "{<namespace>}instanceId";
+    # the namespace depends on the API version, and is taken from the first
+    # element parsed
+    names = None
+
+    for _, elem in cElementTree.iterparse(self._fp):
+      if names is None:
+        names = _getNames(elem.tag[:elem.tag.find("}") + 1])
+
+      tag = elem.tag
+      if tag == names["instancesSet"]:
+        for item in elem:
+          yield _parseInstance(item, names, self._region)
+
+        # Drop the instances, which make up most of each reservation
+        elem.clear()
+
+      elif tag == names["nextToken"]:
+        self.nextToken = elem.text
+
+
+
+def _getNames(namespace):
+  return {
+    "instancesSet": namespace + "instancesSet",
+    "nextToken": namespace + "nextToken",
+    "instanceId": namespace + "instanceId",
+    "state": "%sinstanceState/%sname" % (namespace, namespace),
+    "instanceType": namespace + "instanceType",
+    "platform": namespace + "platform",
+    "placement": "%splacement/%savailabilityZone" % (namespace, namespace),
+    "launchTime": namespace + "launchTime",
+    "tagItems": "%stagSet/%sitem" % (namespace, namespace),
+    "key": namespace + "key",
+    "value": namespace + "value",
+  }
+
+
+
+def _parseInstance(item, names, region):
+  tags = {}
+  for tagItem in item.iterfind(names["tagItems"]):
+    tags[tagItem.findtext(names["key"])] = tagItem.findtext(names["value"])
+
+  return InstanceRecord(item.findtext(names["instanceId"]),
+                        item.findtext(names["state"]),
+                        item.findtext(names["instanceType"]),
+                        region,
+                        item.findtext(names["platform"]),
+                        item.findtext(names["placement"]),
+                        item.findtext(names["launchTime"]),
+                        tags)
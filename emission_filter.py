@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Change-only emission of metric records.
+
+A record is only passed on if its value moved out of the deadband around the
+value last passed on for the same metric, or if the metric has been silent
+for the heartbeat interval, so that a series that doesn't change still shows
+up as live. The values passed on are staged until the caller confirms they
+were delivered, so that values lost on the way are sent again next time.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import instrumentation
+
+
+
+_DEFAULT_HEARTBEAT_SEC = 3600
+
+
+
+class DeadbandFilter(object):
+  """Suppresses records whose values are within a deadband of the last value
+  sent"""
+
+  def __init__(self, path=None, absolute=0.0, relative=0.0,
+               heartbeat=_DEFAULT_HEARTBEAT_SEC):
+    """
+    :param str path: file the last values sent are persisted to, so that
+      successive runs filter against each other; None to keep them in memory
+      only
+    :param float absolute: changes up to this amount are suppressed
+    :param float relative: changes up to this fraction of the last value sent
+      are suppressed
+    :param float heartbeat: seconds after which a metric is sent again even
+      if it hasn't changed
+    """
+    self._path = path
+    self.absolute = absolute
+    self.relative = relative
+    self.heartbeat = heartbeat
+
+    # Metric name -> [value, ts] last sent
+    self._lastSent = {}
+
+    # Metric name -> [value, ts] passed on by the last `filter`, but not yet
+    # confirmed as sent
+    self._staged = {}
+
+    if path is not None and os.path.exists(path):
+      with open(path) as fp:
+        self._lastSent = {str(name): last
+                          for name, last in json.load(fp).iteritems()}
+
+    self.numSent = 0
+    self.numSuppressed = 0
+
+
+  def filter(self, records):
+    """Return the records that should be sent, and stage them until `commit`
+    is called; records staged by an earlier call are discarded
+
+    :param records: (metric name, value, ts) records
+
+    :returns: list of the records to send
+    """
+    self._staged = {}
+    kept = []
+    for record in records:
+      name, value, ts = record
+      last = self._lastSent.get(name)
+      if (last is not None and ts - last[1] < self.heartbeat and
+          abs(value - last[0]) <= max(self.absolute,
+                                      self.relative * abs(last[0]))):
+        continue
+
+      self._staged[name] = [value, ts]
+      kept.append(record)
+
+    numSuppressed = len(records) - len(kept)
+    self.numSent += len(kept)
+    self.numSuppressed += numSuppressed
+    instrumentation.increment("emission.sent", len(kept))
+    instrumentation.increment("emission.suppressed", numSuppressed)
+
+    return kept
+
+
+  def commit(self):
+    """Remember the records returned by the last `filter` as sent"""
+    self._lastSent.update(self._staged)
+    self._staged = {}
+
+
+  def reset(self):
+    """Forget the values sent, e.g. after some of them were lost, so that
+    every metric is sent again"""
+    self._lastSent = {}
+    self._staged = {}
+
+
+  def save(self):
+    if self._path is None:
+      return
+
+    # Metrics silent for longer than the heartbeat will be sent next time
+    # anyway, so there's no need to keep them
+    if self._lastSent:
+      newest = max(ts for _, ts in self._lastSent.itervalues())
+      self._lastSent = {name: last for name, last in self._lastSent.iteritems()
+                        if newest - last[1] < self.heartbeat}
+
+    # Write to a temp file first, then move into place, to minimize window for
+    # corruption
+    tempFd, tempPath = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(self._path)),
+      suffix=".burnrate_emission")
+    with os.fdopen(tempFd, "w") as fp:
+      json.dump(self._lastSent, fp)
+
+    shutil.move(tempPath, self._path)
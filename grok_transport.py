@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Non-blocking transport for Grok custom metric lines.
+
+Metric lines are queued in memory and written by a background thread in
+large batches. When Grok is unreachable the thread reconnects with
+exponential backoff, and data that cannot be sent is spilled to an on-disk
+journal. The journal is always drained before newer data is sent, so Grok
+receives the lines in the order they were queued.
+"""
+
+import collections
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+import instrumentation
+
+
+
+_DEFAULT_MAX_QUEUE_BYTES = (64 << 20)
+_DEFAULT_MAX_BATCH_BYTES = (1 << 20)
+_DEFAULT_MIN_BACKOFF_SEC = 1.0
+_DEFAULT_MAX_BACKOFF_SEC = 60.0
+_DEFAULT_SEND_TIMEOUT_SEC = 30.0
+
+
+
+class SocketConnection(object):
+  """Plain TCP connection to a Grok custom metrics port, e.g. a local stand-in
+  for Grok, with the interface `GrokTransport` expects"""
+
+  def __init__(self, address, connectTimeout=_DEFAULT_SEND_TIMEOUT_SEC):
+    """
+    :param tuple address: (host, port)
+    :param float connectTimeout: seconds to wait for a connection
+    """
+    self._address = address
+    self._connectTimeout = connectTimeout
+    self._sock = None
+
+
+  def getSocket(self):
+    if self._sock is None:
+      self._sock = socket.create_connection(self._address,
+                                            self._connectTimeout)
+    return self._sock
+
+
+  def close(self):
+    if self._sock is not None:
+      try:
+        self._sock.close()
+      except socket.error:
+        pass
+    self._sock = None
+
+
+
+def _isConnectionClosed(sock):
+  """Check whether the peer has closed a connection that we only write to
+
+  Grok never writes on its custom metrics port, so a readable socket means
+  the connection was closed or reset. Catching this before a send avoids
+  losing the send to a connection that is already gone.
+  """
+  try:
+    readable, _, _ = select.select([sock], [], [], 0)
+    if not readable:
+      return False
+    return not sock.recv(1, socket.MSG_PEEK)
+  except (socket.error, select.error, ValueError):
+    return True
+
+
+
+class GrokTransport(object):
+  """Sends Grok custom metric lines from a background thread
+
+  `send` never blocks on the network. Data that has not been sent is held in
+  a queue of up to `maxQueueBytes`; beyond that, or when a send fails, the
+  oldest data moves to the journal if there is one, and is dropped otherwise.
+  """
+
+  def __init__(self, connection, journalPath=None,
+               maxQueueBytes=_DEFAULT_MAX_QUEUE_BYTES,
+               maxBatchBytes=_DEFAULT_MAX_BATCH_BYTES,
+               minBackoff=_DEFAULT_MIN_BACKOFF_SEC,
+               maxBackoff=_DEFAULT_MAX_BACKOFF_SEC,
+               sendTimeout=_DEFAULT_SEND_TIMEOUT_SEC):
+    """
+    :param connection: object whose `getSocket()` returns a connected socket,
+      reconnecting if needed, and whose `close()` drops the connection; e.g.
+      `SocketConnection`
+    :param str journalPath: file to spill unsent data to; data journaled by
+      an earlier transport is sent first. None to keep data in memory only.
+    :param int maxQueueBytes: maximum bytes held in memory
+    :param int maxBatchBytes: approximate maximum bytes per write
+    :param float minBackoff: seconds to wait before the first reconnect
+    :param float maxBackoff: maximum seconds between reconnects
+    :param float sendTimeout: socket timeout for each write
+    """
+    self._connection = connection
+    self._journalPath = journalPath
+    self._maxQueueBytes = maxQueueBytes
+    self._maxBatchBytes = maxBatchBytes
+    self._minBackoff = minBackoff
+    self._maxBackoff = maxBackoff
+    self._sendTimeout = sendTimeout
+
+    # Everything in the journal is older than everything in the queue
+    self._queue = collections.deque()
+    self._queueBytes = 0
+    self._journalOffset = 0
+    self._journalBytes = 0
+    if journalPath is not None and os.path.exists(journalPath):
+      self._journalBytes = os.path.getsize(journalPath)
+
+    self._condition = threading.Condition()
+    self._closing = False
+    self._stopped = False
+    self._backoff = 0
+    self._retryAt = 0
+
+    # (data, fromJournal) of the batch the thread is sending, if any; `close`
+    # takes it over if the thread is stuck sending it
+    self._inFlight = None
+
+    self.linesSent = 0
+    self.bytesSent = 0
+    self.linesJournaled = 0
+    self.linesDropped = 0
+    self.numConnectionFailures = 0
+
+    self._thread = threading.Thread(target=self._run, name="GrokTransport")
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def send(self, data):
+    """Queue Grok custom metric lines for sending
+
+    :param str data: complete lines, e.g. from `metric_batch.formatGrokLines`
+    """
+    if not data:
+      return
+
+    with self._condition:
+      if self._closing:
+        raise ValueError("Transport is closed")
+
+      self._queue.append(data)
+      self._queueBytes += len(data)
+
+      while self._queueBytes > self._maxQueueBytes and len(self._queue) > 1:
+        self._spill(self._queue.popleft())
+
+      self._condition.notify()
+
+
+  def getPendingBytes(self):
+    """Return the number of bytes queued or journaled but not yet sent"""
+    with self._condition:
+      return self._queueBytes + self._journalBytes - self._journalOffset
+
+
+  def close(self, timeout=None):
+    """Stop accepting data and wait for the queue and journal to be sent
+
+    :param float timeout: maximum seconds to wait; whatever is still unsent
+      then is moved to the journal, or dropped if there is none
+
+    :returns: True if everything was sent; False if anything is left in the
+      journal or was dropped
+    """
+    with self._condition:
+      self._closing = True
+      self._condition.notify()
+
+    self._thread.join(timeout)
+
+    with self._condition:
+      # Stop the thread, even if it is in the middle of a send, and take over
+      # the batch it is sending; a journaled batch is still in the journal
+      self._stopped = True
+      if self._inFlight is not None:
+        data, fromJournal = self._inFlight
+        self._inFlight = None
+        if not fromJournal:
+          self._queueBytes += len(data)
+          self._spill(data)
+      while self._queue:
+        self._spill(self._queue.popleft())
+      self._condition.notify()
+
+    self._thread.join(self._sendTimeout)
+    self._connection.close()
+
+    return self.getPendingBytes() == 0 and self.linesDropped == 0
+
+
+  def _spill(self, data):
+    """Move data out of the queue into the journal, or drop it.
+    The caller must hold the condition."""
+    self._queueBytes -= len(data)
+    numLines = data.count("\n")
+
+    if self._journalPath is None:
+      self.linesDropped += numLines
+      return
+
+    with open(self._journalPath, "ab") as fp:
+      fp.write(data)
+    self._journalBytes += len(data)
+    self.linesJournaled += numLines
+
+
+  def _nextJournalChunk(self):
+    """Read the next unsent chunk of the journal; caller holds the condition"""
+    with open(self._journalPath, "rb") as fp:
+      fp.seek(self._journalOffset)
+      chunk = fp.read(self._maxBatchBytes)
+
+    # Only send complete lines; a write interrupted by a crash may have left
+    # a partial one at the end
+    end = chunk.rfind("\n") + 1
+    if end == 0:
+      # Skip a trailing partial line
+      self._markJournalSent(len(chunk))
+    return chunk[:end]
+
+
+  def _markJournalSent(self, numBytes):
+    """Advance past sent journal data; caller holds the condition"""
+    self._journalOffset += numBytes
+    if self._journalOffset >= self._journalBytes:
+      open(self._journalPath, "wb").close()
+      self._journalOffset = 0
+      self._journalBytes = 0
+
+
+  def _nextBatch(self):
+    """Take the next batch to send: journaled data first, then queued data.
+    The caller must hold the condition.
+
+    :returns: two-tuple (data, fromJournal)
+    """
+    if self._journalBytes > self._journalOffset:
+      return self._nextJournalChunk(), True
+
+    parts = []
+    numBytes = 0
+    while self._queue and (not parts or
+                           numBytes + len(self._queue[0]) <=
+                           self._maxBatchBytes):
+      data = self._queue.popleft()
+      parts.append(data)
+      numBytes += len(data)
+    self._queueBytes -= numBytes
+
+    return "".join(parts), False
+
+
+  def _returnBatch(self, data, fromJournal):
+    """Put back a batch that could not be sent; caller holds the condition"""
+    if fromJournal:
+      return
+
+    if self._journalPath is not None:
+      self._queueBytes += len(data)
+      self._spill(data)
+    else:
+      self._queue.appendleft(data)
+      self._queueBytes += len(data)
+
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while True:
+          if self._stopped:
+            return
+
+          hasData = self._queue or self._journalBytes > self._journalOffset
+          if not hasData and self._closing:
+            return
+
+          wait = self._retryAt - time.time() if hasData else None
+          if wait is not None and wait <= 0:
+            break
+          self._condition.wait(wait)
+
+        data, fromJournal = self._nextBatch()
+        if data:
+          self._inFlight = (data, fromJournal)
+
+      if not data:
+        continue
+
+      try:
+        sock = self._connection.getSocket()
+        if _isConnectionClosed(sock):
+          self._connection.close()
+          sock = self._connection.getSocket()
+
+        sock.settimeout(self._sendTimeout)
+        sock.sendall(data)
+      except Exception as e:  # pylint: disable=W0703
+        self._connection.close()
+        with self._condition:
+          if self._inFlight is None:
+            # `close` already took the batch over
+            return
+          self._inFlight = None
+          self._returnBatch(data, fromJournal)
+          self.numConnectionFailures += 1
+          instrumentation.increment("grok.connectionFailures")
+          if not self._backoff:
+            print >> sys.stderr, "Grok unreachable, retrying: {}".format(e)
+          self._backoff = min(max(self._backoff * 2, self._minBackoff),
+                              self._maxBackoff)
+          self._retryAt = time.time() + self._backoff
+        continue
+
+      with self._condition:
+        if self._inFlight is None:
+          # `close` already took the batch over, and has journaled or
+          # dropped it, so it may be sent again
+          return
+        self._inFlight = None
+        if fromJournal:
+          self._markJournalSent(len(data))
+        self._backoff = 0
+        self.linesSent += data.count("\n")
+        self.bytesSent += len(data)
+      instrumentation.increment("grok.bytesSent", len(data))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Process-wide counters and timers describing the collector's own work,
+reported as "<prefix>.meta.*" metrics.
+
+Values accumulate from the moment they are recorded until the next
+`takeSnapshot`, so a snapshot taken once per collection yields per-collection
+figures. Anything recorded after the snapshot, such as the time spent sending
+a batch, is reported with the following collection.
+"""
+
+import contextlib
+import cProfile
+import resource
+import threading
+import time
+
+
+
+_lock = threading.Lock()
+
+# Name -> value accumulated since the last snapshot
+_values = {}
+
+# Counters reported even when nothing was counted, so that their metrics
+# don't come and go
+_COUNTERS = (
+  "api.describeInstances.calls",
+  "emission.sent",
+  "emission.suppressed",
+  "grok.bytesSent",
+  "grok.connectionFailures",
+  "priceTable.cacheHits",
+  "priceTable.cacheMisses",
+  "pricing.unknownPriceInstances",
+  "regions.polled",
+  "regions.skipped",
+)
+
+
+
+def increment(name, amount=1):
+  """Add `amount` to a counter"""
+  with _lock:
+    _values[name] = _values.get(name, 0) + amount
+
+
+
+def setValue(name, value):
+  """Record the latest value of a gauge, replacing any earlier one"""
+  with _lock:
+    _values[name] = value
+
+
+
+@contextlib.contextmanager
+def timer(name):
+  """Context manager adding the seconds spent in its block to `name`"""
+  start = time.time()
+  try:
+    yield
+  finally:
+    increment(name, time.time() - start)
+
+
+
+def merge(values, prefix=""):
+  """Add the values of a snapshot taken elsewhere, e.g. in a worker process
+
+  :param dict values: as returned by `takeSnapshot`
+  :param str prefix: prepended to each name
+  """
+  with _lock:
+    for name, value in values.iteritems():
+      name = prefix + name
+      _values[name] = _values.get(name, 0) + value
+
+
+
+def resetAfterFork():
+  """Replace the lock and drop the values inherited by a forked child
+  process; another thread of the parent may have held the lock when it
+  forked, which would leave it locked in the child forever"""
+  global _lock, _values  # pylint: disable=W0603
+  _lock = threading.Lock()
+  _values = {}
+
+
+
+def takeSnapshot():
+  """Return the values recorded since the last snapshot and start over
+
+  :returns: dict of name -> value
+  """
+  global _values  # pylint: disable=W0603
+  with _lock:
+    values, _values = _values, {}
+  return values
+
+
+
+def buildMetaRecords(ts, prefix="aws"):
+  """Take a snapshot and add the process's peak memory use
+
+  :returns: list of ("<prefix>.meta.<name>", value, ts) records
+  """
+  values = takeSnapshot()
+  for name in _COUNTERS:
+    values.setdefault(name, 0)
+
+  # Kilobytes on Linux
+  values["process.peakRssKb"] = resource.getrusage(
+    resource.RUSAGE_SELF).ru_maxrss
+
+  return [("%s.meta.%s" % (prefix, name), value, ts)
+          for name, value in sorted(values.iteritems())]
+
+
+
+@contextlib.contextmanager
+def profiled(path):
+  """Context manager profiling its block and writing the statistics to `path`
+  in `pstats` format, replacing any earlier dump; a no-op if `path` is
+  empty
+
+  Only the calling thread is profiled; time spent in region worker threads
+  shows up as waiting in `collectRegionalData`.
+  """
+  if not path:
+    yield
+    return
+
+  profile = cProfile.Profile()
+  profile.enable()
+  try:
+    yield
+  finally:
+    profile.disable()
+    profile.dump_stats(path)
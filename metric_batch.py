@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Builds the batch of burn rate metric records for one collection and
+formats it for Grok and CSV output."""
+
+import time
+
+from spend_forecast import FORECAST_METRIC, forecastSpend
+from tag_attribution import (DEFAULT_MAX_TAG_VALUES, TAG_METRICS,
+                             mergeTagGroups, sanitizeTagName)
+
+
+
+# (metric name, key in the per-region dicts returned by getDataByRegions)
+METRICS = (
+  ("burnrate", "burnrate"),
+  ("runningInstances", "numberRunningInstances"),
+  ("stoppedInstances", "numberStoppedInstances"),
+  ("allInstances", "numberAllInstances"),
+)
+
+# (metric name, key in the per-group dicts of the "breakdowns" entry)
+BREAKDOWN_METRICS = (
+  ("burnrate", "burnrate"),
+  ("runningInstances", "numberRunningInstances"),
+)
+
+BREAKDOWNS = ("family", "type", "az")
+
+# Name of the burn rate metric of a pricing model, e.g.
+# "reserved1yrNoUpfrontBurnrate"
+PRICING_MODEL_METRIC = "%sBurnrate"
+
+
+
+def buildMetricBatch(regionalData, ts, prefix="aws", regionalMetrics=(),
+                     breakdowns=(), pricingModels=(), accrual=None,
+                     maxTagValues=DEFAULT_MAX_TAG_VALUES, forecastHours=None):
+  """Compute all regional and total metrics in a single pass
+
+  :param dict regionalData: region name -> dict as returned by
+    `calculate_burn_rate.getDataByRegions`
+  :param float ts: timestamp of the collection
+  :param str prefix: metric name prefix
+  :param regionalMetrics: names from `METRICS` to also report per region;
+    totals are always reported
+  :param breakdowns: names from `BREAKDOWNS` to report `BREAKDOWN_METRICS`
+    for, summed over all regions, e.g. "aws.family.m4.burnrate"
+  :param pricingModels: names from
+    `price_table_builder.RESERVED_PRICING_MODELS` to report the effective
+    burn rate under, e.g. "aws.total.reserved1yrNoUpfrontBurnrate"; also
+    reported per region if "burnrate" is in `regionalMetrics`
+  :param accrual: `cost_accrual.CostAccrual` to accrue the total burnrate in,
+    and the regional ones if "burnrate" is in `regionalMetrics`, reporting
+    the accrued cost of each window, e.g. "aws.total.accruedCost24h"
+  :param int maxTagValues: maximum number of values of each tag key in the
+    "tags" entries to report over all regions, besides
+    `tag_attribution.OTHER_GROUP`, e.g. "aws.tag.team.infra.burnrate"; also
+    reported per region if "burnrate" is in `regionalMetrics`
+  :param float forecastHours: horizon in hours to forecast the spend of the
+    regions with a "launchSpend" entry over, e.g. "aws.total.forecastSpend";
+    also reported per region if "burnrate" is in `regionalMetrics`. The
+    horizon starts now rather than at `ts`, which needn't be a true epoch
+    time.
+
+  :returns: list of (metric name, value, ts) records
+  """
+  regionalMetrics = frozenset(regionalMetrics)
+  totals = [0] * len(METRICS)
+  modelTotals = [0.0] * len(pricingModels)
+  records = []
+
+  for regionName, data in sorted(regionalData.iteritems()):
+    for i, (name, key) in enumerate(METRICS):
+      value = data[key]
+      totals[i] += value
+      if name in regionalMetrics:
+        records.append(("%s.%s.%s" % (prefix, regionName, name), value, ts))
+
+    for i, model in enumerate(pricingModels):
+      value = data["modelBurnrates"][model]
+      modelTotals[i] += value
+      if "burnrate" in regionalMetrics:
+        records.append(("%s.%s.%s" % (prefix, regionName,
+                                      PRICING_MODEL_METRIC % model),
+                        value, ts))
+
+  for i, (name, _) in enumerate(METRICS):
+    records.append(("%s.total.%s" % (prefix, name), totals[i], ts))
+
+  for i, model in enumerate(pricingModels):
+    records.append(("%s.total.%s" % (prefix, PRICING_MODEL_METRIC % model),
+                    modelTotals[i], ts))
+
+  if accrual is not None:
+    if "burnrate" in regionalMetrics:
+      for regionName, data in sorted(regionalData.iteritems()):
+        records.extend(accrual.addSample("%s.%s" % (prefix, regionName),
+                                         data["burnrate"], ts))
+
+    # "burnrate" is the first of METRICS
+    records.extend(accrual.addSample("%s.total" % prefix, totals[0], ts))
+
+  for breakdown in breakdowns:
+    groupTotals = {}
+    for data in regionalData.itervalues():
+      for group, groupData in data["breakdowns"][breakdown].iteritems():
+        groupTotal = groupTotals.setdefault(group, [0] * len(BREAKDOWN_METRICS))
+        for i, (_, key) in enumerate(BREAKDOWN_METRICS):
+          groupTotal[i] += groupData[key]
+
+    for group, groupTotal in sorted(groupTotals.iteritems()):
+      for i, (name, _) in enumerate(BREAKDOWN_METRICS):
+        records.append(("%s.%s.%s.%s" % (prefix, breakdown, group, name),
+                        groupTotal[i], ts))
+
+  if forecastHours:
+    # Launch minutes are matched against the current UTC minute of the hour
+    forecastStart = time.time()
+    totalForecast = 0.0
+    for regionName, data in sorted(regionalData.iteritems()):
+      if data.get("launchSpend") is None:
+        continue
+      value = forecastSpend(data["launchSpend"], forecastHours,
+                            forecastStart)
+      totalForecast += value
+      if "burnrate" in regionalMetrics:
+        records.append(("%s.%s.%s" % (prefix, regionName, FORECAST_METRIC),
+                        value, ts))
+
+    records.append(("%s.total.%s" % (prefix, FORECAST_METRIC), totalForecast,
+                    ts))
+
+  tagGroups = {}
+  for regionName, data in sorted(regionalData.iteritems()):
+    for tagKey, groups in sorted(data.get("tags", {}).iteritems()):
+      tagGroups.setdefault(tagKey, []).append(groups)
+      if "burnrate" in regionalMetrics:
+        records.extend(_buildTagRecords(
+          "%s.%s.tag.%s" % (prefix, regionName, sanitizeTagName(tagKey)),
+          groups, ts))
+
+  for tagKey, groupsList in sorted(tagGroups.iteritems()):
+    records.extend(_buildTagRecords(
+      "%s.tag.%s" % (prefix, sanitizeTagName(tagKey)),
+      mergeTagGroups(groupsList, maxTagValues), ts))
+
+  return records
+
+
+
+def _buildTagRecords(prefix, groups, ts):
+  return [("%s.%s.%s" % (prefix, group, name), groupData[key], ts)
+          for group, groupData in sorted(groups.iteritems())
+          for name, key in TAG_METRICS]
+
+
+
+def mergeRegionalData(regionalDataList, maxTagValues=DEFAULT_MAX_TAG_VALUES):
+  """Sum the per-region data of several accounts region by region
+
+  :param regionalDataList: iterable of dicts as returned by
+    `calculate_burn_rate.getDataByRegions`
+  :param int maxTagValues: maximum number of values of each tag key kept per
+    region
+
+  :returns: dict of the same form
+  """
+  merged = {}
+  # (region name, tag key) -> list of the groups of each account
+  tagGroups = {}
+  for regionalData in regionalDataList:
+    for regionName, data in regionalData.iteritems():
+      mergedData = merged.get(regionName)
+      if mergedData is None:
+        mergedData = merged[regionName] = {key: 0 for _, key in METRICS}
+        mergedData["modelBurnrates"] = {}
+        mergedData["breakdowns"] = {breakdown: {} for breakdown in BREAKDOWNS}
+        mergedData["launchSpend"] = None
+
+      for _, key in METRICS:
+        mergedData[key] += data[key]
+
+      modelBurnrates = mergedData["modelBurnrates"]
+      for model, value in data["modelBurnrates"].iteritems():
+        modelBurnrates[model] = modelBurnrates.get(model, 0.0) + value
+
+      for breakdown in BREAKDOWNS:
+        mergedGroups = mergedData["breakdowns"][breakdown]
+        for group, groupData in data["breakdowns"][breakdown].iteritems():
+          mergedGroup = mergedGroups.setdefault(
+            group, {key: 0 for _, key in BREAKDOWN_METRICS})
+          for _, key in BREAKDOWN_METRICS:
+            mergedGroup[key] += groupData[key]
+
+      for tagKey, groups in data.get("tags", {}).iteritems():
+        tagGroups.setdefault((regionName, tagKey), []).append(groups)
+
+      if data.get("launchSpend") is not None:
+        if mergedData["launchSpend"] is None:
+          mergedData["launchSpend"] = list(data["launchSpend"])
+        else:
+          mergedData["launchSpend"] = map(sum, zip(mergedData["launchSpend"],
+                                                   data["launchSpend"]))
+
+  for data in merged.itervalues():
+    data["tags"] = {}
+  for (regionName, tagKey), groupsList in tagGroups.iteritems():
+    merged[regionName]["tags"][tagKey] = mergeTagGroups(groupsList,
+                                                        maxTagValues)
+
+  return merged
+
+
+
+def formatGrokLines(records, scale=1):
+  """Format records as a single buffer of Grok custom metric lines
+
+  :param records: (metric name, value, ts) records
+  :param int scale: factor to scale values by
+
+  :returns: str ready to be sent with one `sendall`
+  """
+  return "".join("%s %s %d\n" % (name, value * scale, ts)
+                 for name, value, ts in records)
+
+
+
+def formatCsvRows(records):
+  """Format records as rows for `csv.writer.writerows`
+
+  :param records: (metric name, value, ts) records
+
+  :returns: list of [metric name, value, ts] string rows
+  """
+  return [[name, str(value), str(ts)] for name, value, ts in records]
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Burn rate metric history store, partitioned by metric and UTC day.
+
+Layout under the store's root directory:
+
+  <metric name>/<YYYY-MM-DD>.log.gz
+    Records appended by collections, as a sequence of gzip members each
+    holding packed little-endian (ts, value) doubles.
+  <metric name>/<YYYY-MM-DD>.col.gz
+    Compacted partition: a record count followed by the sorted timestamp
+    column and the value column, all little-endian doubles, in one gzip
+    member.
+
+Partition file names are the time index: a range query only opens the
+partitions of the days it overlaps.
+"""
+
+import argparse
+import array
+import calendar
+import csv
+import datetime
+import gzip
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+
+
+_ROW = struct.Struct("<dd")
+_COUNT = struct.Struct("<I")
+_LOG_SUFFIX = ".log.gz"
+_COLUMNAR_SUFFIX = ".col.gz"
+_DAY_FORMAT = "%Y-%m-%d"
+
+
+
+def _dayOf(ts):
+  return datetime.datetime.utcfromtimestamp(ts).strftime(_DAY_FORMAT)
+
+
+
+def _readLog(path):
+  with gzip.open(path, "rb") as fp:
+    data = fp.read()
+
+  # Ignore a trailing partial record left by an interrupted append
+  data = data[:len(data) - len(data) % _ROW.size]
+  return [_ROW.unpack_from(data, offset)
+          for offset in xrange(0, len(data), _ROW.size)]
+
+
+
+def _readColumnar(path):
+  with gzip.open(path, "rb") as fp:
+    count, = _COUNT.unpack(fp.read(_COUNT.size))
+    timestamps = array.array("d")
+    timestamps.fromstring(fp.read(count * 8))
+    values = array.array("d")
+    values.fromstring(fp.read(count * 8))
+
+  if sys.byteorder != "little":
+    timestamps.byteswap()
+    values.byteswap()
+
+  return zip(timestamps, values)
+
+
+
+def _writeColumnar(path, rows):
+  timestamps = array.array("d", (ts for ts, _ in rows))
+  values = array.array("d", (value for _, value in rows))
+  if sys.byteorder != "little":
+    timestamps.byteswap()
+    values.byteswap()
+
+  # Write to a temp file first, then move into place, to minimize window for
+  # corruption
+  tempFd, tempPath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                      suffix=".burnrate_history")
+  with os.fdopen(tempFd, "wb") as rawFp:
+    with gzip.GzipFile(fileobj=rawFp, mode="wb") as fp:
+      fp.write(_COUNT.pack(len(rows)))
+      fp.write(timestamps.tostring())
+      fp.write(values.tostring())
+
+  shutil.move(tempPath, path)
+
+
+
+class MetricHistoryStore(object):
+  """Append-only store of (metric name, value, ts) records"""
+
+  def __init__(self, rootDir):
+    """
+    :param str rootDir: directory holding the store; created if needed
+    """
+    self._rootDir = rootDir
+    if not os.path.isdir(rootDir):
+      os.makedirs(rootDir)
+
+
+  def _metricDir(self, metricName):
+    if "/" in metricName or metricName.startswith("."):
+      raise ValueError("Invalid metric name {!r}".format(metricName))
+    return os.path.join(self._rootDir, metricName)
+
+
+  def _listDays(self, metricName):
+    """Return the sorted days that have partitions for a metric"""
+    metricDir = self._metricDir(metricName)
+    if not os.path.isdir(metricDir):
+      return []
+
+    days = set()
+    for fileName in os.listdir(metricDir):
+      for suffix in (_LOG_SUFFIX, _COLUMNAR_SUFFIX):
+        if fileName.endswith(suffix):
+          days.add(fileName[:-len(suffix)])
+    return sorted(days)
+
+
+  def _readPartition(self, metricName, day):
+    """Return the sorted (ts, value) rows of one partition, later duplicates
+    of a timestamp replacing earlier ones"""
+    basePath = os.path.join(self._metricDir(metricName), day)
+
+    rows = []
+    if os.path.exists(basePath + _COLUMNAR_SUFFIX):
+      rows.extend(_readColumnar(basePath + _COLUMNAR_SUFFIX))
+    if os.path.exists(basePath + _LOG_SUFFIX):
+      rows.extend(_readLog(basePath + _LOG_SUFFIX))
+
+    return sorted(dict(rows).iteritems())
+
+
+  def metricNames(self):
+    return sorted(name for name in os.listdir(self._rootDir)
+                  if os.path.isdir(os.path.join(self._rootDir, name)))
+
+
+  def append(self, records):
+    """Add records to the store
+
+    :param records: (metric name, value, ts) records, e.g. as returned by
+      `metric_batch.buildMetricBatch`
+    """
+    partitions = {}
+    for metricName, value, ts in records:
+      partitions.setdefault((metricName, _dayOf(ts)), []).append(
+        _ROW.pack(ts, value))
+
+    for (metricName, day), rows in partitions.iteritems():
+      metricDir = self._metricDir(metricName)
+      if not os.path.isdir(metricDir):
+        os.makedirs(metricDir)
+
+      # Each append adds a gzip member; readers see the concatenation
+      with gzip.open(os.path.join(metricDir, day + _LOG_SUFFIX), "ab") as fp:
+        fp.write("".join(rows))
+
+
+  def query(self, metricName, startTs=None, endTs=None):
+    """Yield a metric's (ts, value) rows in time order
+
+    :param float startTs: earliest timestamp to return, inclusive
+    :param float endTs: latest timestamp to return, inclusive
+    """
+    startDay = _dayOf(startTs) if startTs is not None else None
+    endDay = _dayOf(endTs) if endTs is not None else None
+
+    for day in self._listDays(metricName):
+      if ((startDay is not None and day < startDay) or
+          (endDay is not None and day > endDay)):
+        continue
+
+      for ts, value in self._readPartition(metricName, day):
+        if ((startTs is None or ts >= startTs) and
+            (endTs is None or ts <= endTs)):
+          yield ts, value
+
+
+  def compact(self, now=None, retentionDays=None):
+    """Rewrite appended partitions of past days in the columnar format, and
+    optionally drop old partitions
+
+    The current day's partitions are left alone, since collections are still
+    appending to them.
+
+    :param float now: current time; defaults to the system clock
+    :param int retentionDays: drop partitions older than this many days
+
+    :returns: two-tuple (number of partitions compacted, number dropped)
+    """
+    if now is None:
+      now = calendar.timegm(datetime.datetime.utcnow().timetuple())
+    today = _dayOf(now)
+
+    oldestDay = None
+    if retentionDays is not None:
+      oldestDay = _dayOf(now - retentionDays * 86400)
+
+    numCompacted = 0
+    numDropped = 0
+    for metricName in self.metricNames():
+      metricDir = self._metricDir(metricName)
+      for day in self._listDays(metricName):
+        basePath = os.path.join(metricDir, day)
+
+        if oldestDay is not None and day < oldestDay:
+          for suffix in (_LOG_SUFFIX, _COLUMNAR_SUFFIX):
+            if os.path.exists(basePath + suffix):
+              os.remove(basePath + suffix)
+          numDropped += 1
+          continue
+
+        if day >= today or not os.path.exists(basePath + _LOG_SUFFIX):
+          continue
+
+        _writeColumnar(basePath + _COLUMNAR_SUFFIX,
+                       self._readPartition(metricName, day))
+        os.remove(basePath + _LOG_SUFFIX)
+        numCompacted += 1
+
+    return numCompacted, numDropped
+
+
+  def exportCsv(self, fp, metricNames=None, startTs=None, endTs=None):
+    """Write records in the collector's CSV format
+
+    :param file fp: file object to write to
+    :param metricNames: metrics to export; all by default
+
+    :returns: number of rows written
+    """
+    writer = csv.writer(fp)
+    numRows = 0
+    for metricName in metricNames or self.metricNames():
+      for ts, value in self.query(metricName, startTs, endTs):
+        writer.writerow([metricName, str(value), str(ts)])
+        numRows += 1
+    return numRows
+
+
+  def importCsv(self, fp):
+    """Add the records of a CSV file written by the collector
+
+    :returns: number of records imported
+    """
+    batch = []
+    numRows = 0
+    for row in csv.reader(fp):
+      if not row:
+        continue
+      batch.append((row[0], float(row[1]), float(row[2])))
+      if len(batch) >= 100000:
+        self.append(batch)
+        numRows += len(batch)
+        batch = []
+
+    self.append(batch)
+    return numRows + len(batch)
+
+
+
+def _parseTime(value):
+  """Parse a command-line time: epoch seconds or YYYY-MM-DD[THH:MM:SS] UTC"""
+  try:
+    return float(value)
+  except ValueError:
+    pass
+
+  for fmt in ("%Y-%m-%dT%H:%M:%S", _DAY_FORMAT):
+    try:
+      return calendar.timegm(datetime.datetime.strptime(value, fmt).timetuple())
+    except ValueError:
+      pass
+
+  raise argparse.ArgumentTypeError("Invalid time {!r}".format(value))
+
+
+
+def main():
+  """Export, import or compact a metric history store"""
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=
+                                   argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("historyDir", metavar="HISTORY_DIR",
+                      help="Metric history store directory")
+  subparsers = parser.add_subparsers(dest="command")
+
+  exportParser = subparsers.add_parser(
+    "export", help="Write records to stdout in the collector's CSV format")
+  exportParser.add_argument("--metric", action="append", dest="metricNames",
+                            help="Metric to export; may be repeated. "
+                            "(default: all)")
+  exportParser.add_argument("--start", type=_parseTime, dest="startTs",
+                            help="Earliest time, as epoch seconds or "
+                            "YYYY-MM-DD[THH:MM:SS] UTC")
+  exportParser.add_argument("--end", type=_parseTime, dest="endTs",
+                            help="Latest time, as epoch seconds or "
+                            "YYYY-MM-DD[THH:MM:SS] UTC")
+
+  importParser = subparsers.add_parser(
+    "import", help="Add the records of a CSV file written by the collector")
+  importParser.add_argument("csvPath", metavar="CSV_FILE")
+
+  compactParser = subparsers.add_parser(
+    "compact", help="Compact past days' partitions and drop expired ones")
+  compactParser.add_argument("--retention-days", type=int,
+                             dest="retentionDays",
+                             help="Drop partitions older than this many days")
+
+  args = parser.parse_args()
+  store = MetricHistoryStore(args.historyDir)
+
+  if args.command == "export":
+    store.exportCsv(sys.stdout, args.metricNames, args.startTs, args.endTs)
+  elif args.command == "import":
+    with open(args.csvPath, "rb") as fp:
+      print >> sys.stderr, "Imported {} records".format(store.importCsv(fp))
+  else:
+    numCompacted, numDropped = store.compact(
+      retentionDays=args.retentionDays)
+    print >> sys.stderr, "Compacted {} and dropped {} partitions".format(
+      numCompacted, numDropped)
+
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Replays burn rate history from a CSV file (optionally gzip-compressed) to
+Grok in large buffered sends, with optional rate limiting and a checkpoint so
+that an interrupted replay resumes where it stopped."""
+
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+
+_DEFAULT_BUFFER_SIZE = (1 << 20)
+
+
+
+def openHistory(path):
+  """Open a CSV history file, transparently decompressing `.gz` files
+
+  :returns: file object positioned at the start of the CSV data
+  """
+  if path.endswith(".gz"):
+    return gzip.open(path, "rb")
+  return open(path, "rb")
+
+
+
+def loadCheckpoint(checkpointPath, inputPath):
+  """Return the offset to resume a replay of `inputPath` from
+
+  :returns: offset into the (uncompressed) input, or 0 if there is no
+    checkpoint for this input
+  """
+  if not checkpointPath or not os.path.exists(checkpointPath):
+    return 0
+
+  with open(checkpointPath) as fp:
+    checkpoint = json.load(fp)
+
+  if checkpoint.get("inputPath") != os.path.abspath(inputPath):
+    return 0
+
+  return checkpoint["offset"]
+
+
+
+def saveCheckpoint(checkpointPath, inputPath, offset, recordsSent):
+  # Write to a temp file first, then move into place, so that the checkpoint
+  # is never left half-written
+  tempFd, tempPath = tempfile.mkstemp(
+    dir=os.path.dirname(os.path.abspath(checkpointPath)),
+    suffix=".burnrate_replay_checkpoint")
+
+  with os.fdopen(tempFd, "w") as fp:
+    json.dump({"inputPath": os.path.abspath(inputPath),
+               "offset": offset,
+               "recordsSent": recordsSent}, fp)
+
+  shutil.move(tempPath, checkpointPath)
+
+
+
+def _formatLine(line, scale):
+  """Convert one CSV history row to a Grok custom metric line
+
+  :returns: str, or None for blank lines
+  """
+  line = line.rstrip("\r\n")
+  if not line:
+    return None
+
+  if '"' in line:
+    row = next(csv.reader([line]))
+  else:
+    row = line.split(",")
+
+  metricName, value, ts = row[0], row[1], row[2]
+
+  if scale != 1:
+    value = float(value) * scale
+
+  return "%s %s %d\n" % (metricName, value, int(float(ts)))
+
+
+
+def _iterBatches(fp, offset, scale, bufferSize):
+  """Read the history file into batches of Grok lines
+
+  :returns: generator of (data, number of records, input offset after the
+    batch) tuples
+  """
+  lines = []
+  pendingBytes = 0
+
+  # readline rather than iteration, which reads ahead and would make the
+  # offsets inaccurate
+  for line in iter(fp.readline, ""):
+    offset += len(line)
+    formatted = _formatLine(line, scale)
+    if formatted is None:
+      continue
+
+    lines.append(formatted)
+    pendingBytes += len(formatted)
+
+    if pendingBytes >= bufferSize:
+      yield "".join(lines), len(lines), offset
+      lines = []
+      pendingBytes = 0
+
+  if lines:
+    yield "".join(lines), len(lines), offset
+
+
+
+def replayHistory(inputPath, sock, scale=1, bufferSize=_DEFAULT_BUFFER_SIZE,
+                  maxRecordsPerSec=None, checkpointPath=None,
+                  clock=time.time, sleep=time.sleep):
+  """Send the metrics recorded in a CSV history file to Grok
+
+  Rows are streamed from the file and coalesced into sends of about
+  `bufferSize` bytes. If `checkpointPath` is given, the input offset of the
+  last completed send is recorded there after every send, and a later replay
+  of the same file resumes from it; rows appended to the file since then are
+  picked up as well. Rows in a send that was interrupted may be sent again
+  on resume.
+
+  :param str inputPath: CSV history file as written by the collector, or a
+    gzip-compressed one ending in `.gz`
+  :param sock: connected Grok socket
+  :param int scale: factor to scale values by
+  :param int bufferSize: approximate number of bytes per send
+  :param float maxRecordsPerSec: limit on the average send rate; None for no
+    limit
+  :param str checkpointPath: file recording replay progress, or None
+
+  :returns: number of records sent
+  """
+  offset = loadCheckpoint(checkpointPath, inputPath)
+  recordsSent = 0
+  startTime = clock()
+
+  with openHistory(inputPath) as fp:
+    if offset:
+      fp.seek(offset)
+
+    for data, numRecords, offset in _iterBatches(fp, offset, scale,
+                                                 bufferSize):
+      sock.sendall(data)
+      recordsSent += numRecords
+
+      if maxRecordsPerSec:
+        # Sleep until the average rate since the start is within the limit
+        aheadBy = (recordsSent / float(maxRecordsPerSec) -
+                   (clock() - startTime))
+        if aheadBy > 0:
+          sleep(aheadBy)
+
+      if checkpointPath:
+        saveCheckpoint(checkpointPath, inputPath, offset, recordsSent)
+
+  return recordsSent
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" HTTP endpoint serving the latest burn rate metrics in the
+Prometheus/OpenMetrics text exposition format.
+
+Each collection renders its metrics once into an immutable snapshot, which is
+swapped in with a single reference assignment. Scrapes only write out the
+current snapshot, so they never wait for or trigger a collection.
+
+A Grok metric "<scope>.<metric>" is exposed as the gauge family named after
+the metric in snake case, with the rest of the name as its "scope" label;
+e.g. "aws.us-east-1.runningInstances" becomes
+`running_instances{scope="aws.us-east-1"}`.
+"""
+
+import BaseHTTPServer
+import gzip
+import re
+import SocketServer
+import StringIO
+import threading
+import time
+
+
+
+_OPENMETRICS_CONTENT_TYPE = ("application/openmetrics-text; version=1.0.0; "
+                             "charset=utf-8")
+_TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_CAMEL_CASE_BOUNDARY = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+_INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_]")
+
+
+
+def _familyName(metric):
+  name = _INVALID_NAME_CHARS.sub(
+    "_", _CAMEL_CASE_BOUNDARY.sub("_", metric)).lower()
+  if name[:1].isdigit():
+    name = "_" + name
+  return name
+
+
+
+def _escapeLabelValue(value):
+  return (value.replace("\\", "\\\\").replace("\"", "\\\"")
+          .replace("\n", "\\n"))
+
+
+
+def renderExposition(records, collectedAt=None):
+  """Render metric records in the text exposition format
+
+  :param records: (metric name, value, ts) records, e.g. as returned by
+    `metric_batch.buildMetricBatch`
+  :param float collectedAt: time of the collection, exposed as
+    `burnrate_last_collection_timestamp_seconds`
+
+  :returns: str
+  """
+  families = {}
+  for name, value, _ in records:
+    scope, _, metric = name.rpartition(".")
+    families.setdefault(_familyName(metric), []).append((scope, value))
+
+  lines = []
+  for family, samples in sorted(families.iteritems()):
+    lines.append("# TYPE %s gauge\n" % family)
+    for scope, value in samples:
+      lines.append("%s{scope=\"%s\"} %r\n" % (family, _escapeLabelValue(scope),
+                                              float(value)))
+
+  if collectedAt is not None:
+    lines.append("# TYPE burnrate_last_collection_timestamp_seconds gauge\n")
+    lines.append("burnrate_last_collection_timestamp_seconds %r\n" %
+                 float(collectedAt))
+
+  lines.append("# EOF\n")
+  return "".join(lines)
+
+
+
+class _Exposition(object):
+  """Immutable rendered snapshot, plain and gzip-compressed"""
+
+  def __init__(self, body):
+    self.body = body
+
+    buf = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as fp:
+      fp.write(body)
+    self.gzippedBody = buf.getvalue()
+
+
+
+class MetricsSnapshot(object):
+  """Latest collected metrics, ready to be served"""
+
+  def __init__(self):
+    self._exposition = _Exposition(renderExposition([]))
+
+
+  def update(self, records, collectedAt=None):
+    """Render a collection's records and swap them in for scrapers
+
+    :param records: (metric name, value, ts) records
+    :param float collectedAt: time of the collection; defaults to now
+    """
+    if collectedAt is None:
+      collectedAt = time.time()
+
+    # Replacing the reference is atomic, so scrapers see either the old or the
+    # new snapshot, never a mix
+    self._exposition = _Exposition(renderExposition(records, collectedAt))
+
+
+  def getExposition(self):
+    return self._exposition
+
+
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def do_GET(self):  # pylint: disable=C0103
+    if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+      self.send_error(404)
+      return
+
+    exposition = self.server.snapshot.getExposition()
+
+    if "application/openmetrics-text" in self.headers.get("Accept", ""):
+      contentType = _OPENMETRICS_CONTENT_TYPE
+    else:
+      contentType = _TEXT_CONTENT_TYPE
+
+    self.send_response(200)
+    self.send_header("Content-Type", contentType)
+    if "gzip" in self.headers.get("Accept-Encoding", ""):
+      body = exposition.gzippedBody
+      self.send_header("Content-Encoding", "gzip")
+    else:
+      body = exposition.body
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+  def log_message(self, format, *args):  # pylint: disable=W0622
+    # Scrapes are frequent and routine; don't log each one to stderr
+    pass
+
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Threaded HTTP server for a `MetricsSnapshot`"""
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, snapshot):
+    """
+    :param tuple address: (host, port) to listen on; port 0 picks a free port
+    :param MetricsSnapshot snapshot: metrics to serve
+    """
+    BaseHTTPServer.HTTPServer.__init__(self, address, _MetricsRequestHandler)
+    self.snapshot = snapshot
+
+
+  def start(self):
+    """Serve requests from a daemon thread"""
+    thread = threading.Thread(target=self.serve_forever, name="MetricsServer")
+    thread.daemon = True
+    thread.start()
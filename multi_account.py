@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Collects burn rate data from several AWS accounts in a process pool and
+builds per-account and organization-wide metric batches.
+
+Accounts are listed in a JSON config file:
+
+  {
+    "prefix": "aws",
+    "accounts": [
+      {"name": "production",
+       "accessKeyId": "AKIA...",
+       "secretAccessKey": "...",
+       "prefix": "aws.production"},
+      ...
+    ]
+  }
+
+"prefix" is the organization-wide metric prefix; each account's "prefix"
+defaults to "<organization prefix>.<account name>".
+"""
+
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+
+import calculate_burn_rate
+import instrumentation
+from metric_batch import buildMetricBatch, mergeRegionalData
+from tag_attribution import DEFAULT_MAX_TAG_VALUES
+
+
+
+_DEFAULT_PROCESSES = 4
+
+# Pool of worker processes kept across collections, if started with
+# `startPool`
+_pool = None
+
+
+
+def loadAccounts(fp, defaultPrefix="aws"):
+  """Read an accounts config file
+
+  :param file fp: file object of the JSON config
+  :param str defaultPrefix: organization prefix if the config has none
+
+  :returns: two-tuple (organization prefix, list of account dicts with keys
+    "name", "accessKeyId", "secretAccessKey" and "prefix")
+  """
+  config = json.load(fp)
+  orgPrefix = str(config.get("prefix", defaultPrefix))
+
+  accounts = []
+  names = set()
+  for account in config["accounts"]:
+    for key in ("name", "accessKeyId", "secretAccessKey"):
+      if not account.get(key):
+        raise ValueError("Account {!r} has no {!r}".format(account.get("name"),
+                                                           key))
+
+    name = str(account["name"])
+    if name in names:
+      raise ValueError("Duplicate account {!r}".format(name))
+    names.add(name)
+
+    accounts.append({
+      "name": name,
+      "accessKeyId": str(account["accessKeyId"]),
+      "secretAccessKey": str(account["secretAccessKey"]),
+      "prefix": str(account.get("prefix") or "%s.%s" % (orgPrefix, name)),
+    })
+
+  return orgPrefix, accounts
+
+
+
+def _initWorker():
+  """Pool initializer: replace the locks and drop the state inherited from
+  the parent, whose other threads may have held a lock when it forked"""
+  instrumentation.resetAfterFork()
+  calculate_burn_rate.resetAfterFork()
+
+
+
+def _createPool(processes):
+  return multiprocessing.Pool(max(processes, 1), initializer=_initWorker)
+
+
+
+def _collectInPool(tasks, processes):
+  """Collect accounts in a pool started for just these tasks"""
+  pool = _createPool(processes)
+  try:
+    results = pool.map(_collectAccount, tasks)
+    pool.close()
+  except BaseException:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+  return results
+
+
+
+def startPool(processes=_DEFAULT_PROCESSES):
+  """Start a pool of worker processes that `collectAccounts` reuses, keeping
+  their EC2 connections across collections, instead of starting one per
+  call
+
+  Call it before starting any threads, and after loading the price table, so
+  that the workers share the parent's table.
+
+  :param int processes: number of worker processes
+  """
+  global _pool  # pylint: disable=W0603
+  if _pool is None:
+    _pool = _createPool(processes)
+
+
+
+def stopPool():
+  """Stop the pool started by `startPool`, if any"""
+  global _pool  # pylint: disable=W0603
+  if _pool is not None:
+    _pool.close()
+    _pool.join()
+    _pool = None
+
+
+
+def _collectAccount(task):
+  """Pool worker: collect one account's regions
+
+  :returns: four-tuple (account name, regionalData, failedRegions,
+    instrumentation snapshot) with failures as strings; regionalData is None
+    and failedRegions a traceback if the account could not be collected at
+    all
+  """
+  account, collectOptions = task
+
+  # Drop values left by an earlier task
+  instrumentation.takeSnapshot()
+
+  try:
+    # Another worker may have collected the account last, and the parent may
+    # have refreshed the price table
+    calculate_burn_rate.discardPersistentState()
+    calculate_burn_rate.reloadPriceTable()
+
+    if collectOptions.get("scheduleDir"):
+      collectOptions = dict(collectOptions, scheduleDir=os.path.join(
+        collectOptions["scheduleDir"], account["name"]))
+
+    regionalData, failedRegions = calculate_burn_rate.collectRegionalData(
+      credentials=(account["accessKeyId"], account["secretAccessKey"]),
+      **collectOptions)
+  except Exception:  # pylint: disable=W0703
+    return (account["name"], None, traceback.format_exc(),
+            instrumentation.takeSnapshot())
+
+  return (account["name"], regionalData,
+          {name: str(error) for name, error in failedRegions.iteritems()},
+          instrumentation.takeSnapshot())
+
+
+
+def collectAccounts(accounts, processes=_DEFAULT_PROCESSES, **collectOptions):
+  """Collect the regional data of several accounts in a process pool
+
+  The pool started by `startPool` is used if there is one; otherwise a pool
+  is started for this call. The price table is loaded before that pool is
+  started, so every worker shares the parent's read-only, memory-mapped table
+  instead of loading its own. Failed accounts and regions are reported to
+  stderr. The workers' instrumentation is merged into this process's, with
+  per-account names under "accounts.<name>.".
+
+  :param accounts: account dicts as returned by `loadAccounts`
+  :param int processes: number of worker processes of a pool started for
+    this call
+  :param collectOptions: keyword arguments for
+    `calculate_burn_rate.collectRegionalData`; a "scheduleDir" gets a
+    subdirectory per account
+
+  :returns: dict of account name -> regionalData for the accounts that could
+    be collected
+  """
+  tasks = [(account, collectOptions) for account in accounts]
+
+  if _pool is not None:
+    results = _pool.map(_collectAccount, tasks)
+  else:
+    calculate_burn_rate.loadPriceTable()
+    results = _collectInPool(tasks, min(processes, len(tasks)))
+
+  accountData = {}
+  for name, regionalData, failures, values in results:
+    instrumentation.merge(values, prefix="accounts.%s." % name)
+
+    if regionalData is None:
+      print >> sys.stderr, "Failed to collect account {}:\n{}".format(
+        name, failures)
+      continue
+
+    for regionName, error in sorted(failures.iteritems()):
+      print >> sys.stderr, "Failed to collect account {} region {}: {}".format(
+        name, regionName, error)
+
+    accountData[name] = regionalData
+
+  return accountData
+
+
+
+def buildAccountsMetricBatch(accounts, accountData, ts, orgPrefix,
+                             regionalMetrics=(), breakdowns=(),
+                             pricingModels=(), accrual=None,
+                             maxTagValues=DEFAULT_MAX_TAG_VALUES,
+                             forecastHours=None):
+  """Build each account's metrics under its own prefix, plus the metrics of
+  all accounts merged under the organization prefix
+
+  :param accounts: account dicts as returned by `loadAccounts`
+  :param dict accountData: as returned by `collectAccounts`
+
+  :returns: list of (metric name, value, ts) records
+  """
+  records = []
+  for account in accounts:
+    regionalData = accountData.get(account["name"])
+    if regionalData is not None:
+      records.extend(buildMetricBatch(regionalData, ts,
+                                      prefix=account["prefix"],
+                                      regionalMetrics=regionalMetrics,
+                                      breakdowns=breakdowns,
+                                      pricingModels=pricingModels,
+                                      accrual=accrual,
+                                      maxTagValues=maxTagValues,
+                                      forecastHours=forecastHours))
+
+  records.extend(buildMetricBatch(mergeRegionalData(accountData.itervalues(),
+                                                    maxTagValues),
+                                  ts, prefix=orgPrefix,
+                                  regionalMetrics=regionalMetrics,
+                                  breakdowns=breakdowns,
+                                  pricingModels=pricingModels,
+                                  accrual=accrual,
+                                  maxTagValues=maxTagValues,
+                                  forecastHours=forecastHours))
+  return records
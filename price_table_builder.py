@@ -23,23 +23,39 @@
 Output EC2 Instance pricing table to stdout as a JSON list. Each element in the
 JSON list is a two-tuple, where the first value key consists
 of (all lower-case): instance type, region, platform; the second value is
-an object with key="USD" and value is the amount per hour in US$.
+an object with key="USD" and value is the OnDemand amount per hour in US$.
 
-Example:  [["c1.medium", "ap-northeast-1", "rhel"], {"USD": 0.218}]
+The object also holds the effective hourly US$ amount of each standard
+Reserved Instance offering of the instance, keyed by the names in
+`RESERVED_PRICING_MODELS`; the upfront fee is spread over the hours of the
+lease and added to the hourly fee.
+
+Example:  [["c1.medium", "ap-northeast-1", "rhel"],
+           {"USD": 0.218, "reserved1yrNoUpfront": 0.152, ...}]
+
+With `--format binary`, the table is instead written in the compact binary
+format read by `loadBinary`.
 
 Reference https://aws.amazon.com/blogs/aws/new-aws-price-list-api/
 """
 
 import argparse
 import json
+import math
+import mmap
+import re
+import struct
 import sys
-import urllib2
 
 
 
 _DEFAULT_OFFERS_URL = ("https://pricing.us-east-1.amazonaws.com/"
                        "offers/v1.0/aws/AmazonEC2/current/index.json")
 
+_DEFAULT_REGION_INDEX_URL = ("https://pricing.us-east-1.amazonaws.com/"
+                             "offers/v1.0/aws/AmazonEC2/current/"
+                             "region_index.json")
+
 _REGION_NAME_TO_REGION = {
   "US East (N. Virginia)": "us-east-1",
   "US West (N. California)": "us-west-1",
@@ -53,6 +69,145 @@ _REGION_NAME_TO_REGION = {
   "South America (Sao Paulo)": "sa-east-1"
 }
 
+# (LeaseContractLength, PurchaseOption) of a standard Reserved Instance
+# offering -> price column
+_RESERVED_COLUMNS = {
+  ("1yr", "No Upfront"): "reserved1yrNoUpfront",
+  ("1yr", "Partial Upfront"): "reserved1yrPartialUpfront",
+  ("1yr", "All Upfront"): "reserved1yrAllUpfront",
+  ("3yr", "No Upfront"): "reserved3yrNoUpfront",
+  ("3yr", "Partial Upfront"): "reserved3yrPartialUpfront",
+  ("3yr", "All Upfront"): "reserved3yrAllUpfront",
+}
+
+RESERVED_PRICING_MODELS = tuple(sorted(_RESERVED_COLUMNS.itervalues()))
+
+_HOURS_PER_YEAR = 365 * 24
+
+# Binary price table format; see `dumpBinary`
+_BINARY_MAGIC = "BRPT"
+_BINARY_VERSION = 2
+_BINARY_HEADER = struct.Struct("<4sHIIII")
+_BINARY_COLUMN_COUNT = struct.Struct("<H")
+_BINARY_STRING_LENGTH = struct.Struct("<H")
+_BINARY_ENTRY_CODES = struct.Struct("<HHH")
+
+# Version 1 tables have a single "USD" column and no column table
+_BINARY_V1_COLUMNS = ("USD",)
+
+# Price columns of version 2 tables, in the order stored in each entry
+_BINARY_COLUMNS = ("USD",) + RESERVED_PRICING_MODELS
+
+# Stored for a column without a price
+_MISSING_PRICE = float("nan")
+
+
+
+def _getComputeInstanceKey(sku):
+  """Derive the price table key for a product SKU
+
+  :param dict sku: element of the offers file's "products" object
+
+  :returns: (instanceType, region, platform) tuple, or None if the SKU is not a
+    priced Compute Instance that we track
+  """
+  if sku.get("productFamily") != "Compute Instance":
+    return None
+
+  attributes = sku["attributes"]
+
+  regionName = str(attributes["location"])
+
+  if regionName == "AWS GovCloud (US)":
+    return None
+
+  instanceType = str(attributes["instanceType"])
+
+  operatingSystem = str(attributes["operatingSystem"]).lower()
+
+  return (instanceType, _REGION_NAME_TO_REGION[regionName], operatingSystem)
+
+
+
+def _getOnDemandPrice(terms):
+  """Extract the hourly US$ amount from a SKU's OnDemand terms
+
+  :param dict terms: value of the offers file's "terms"."OnDemand"[skuId]
+
+  :returns: float; amount per hour in US$
+  """
+  if len(terms) != 1:
+    raise Exception("Unexpected number of terms != 1: {}".format(terms))
+
+  term = terms.values()[0]
+
+  priceDimensions = term["priceDimensions"]
+
+  if len(priceDimensions) != 1:
+    raise Exception("Unexpected number of priceDimensions != 1: {}".format(
+      priceDimensions))
+
+  priceDimension = priceDimensions.values()[0]
+
+  pricesPerUnit = priceDimension["pricePerUnit"]
+
+  if len(pricesPerUnit) != 1:
+    raise Exception(
+      "Unexpected number of pricesPerUnit != 1 in rateCode={}: {}".format(
+        priceDimension["rateCode"], pricesPerUnit))
+
+  currency, amount = pricesPerUnit.items()[0]
+  if currency != "USD":
+    raise Exception("Unexpected currency {} in rateCode {}".format(
+      currency, priceDimension["rateCode"]))
+
+  return float(amount)
+
+
+
+def _getReservedPrices(terms):
+  """Extract the effective hourly US$ amount of each standard Reserved
+  Instance offering from a SKU's Reserved terms
+
+  Convertible offerings, and terms that aren't in US$ or have price dimensions
+  other than an hourly and an upfront fee, are skipped.
+
+  :param dict terms: value of the offers file's "terms"."Reserved"[skuId]
+
+  :returns: dict of price column -> amount per hour in US$
+  """
+  prices = dict()
+
+  for term in terms.itervalues():
+    attributes = term.get("termAttributes", {})
+    if attributes.get("OfferingClass", "standard") != "standard":
+      continue
+
+    leaseLength = attributes.get("LeaseContractLength")
+    column = _RESERVED_COLUMNS.get((leaseLength,
+                                    attributes.get("PurchaseOption")))
+    if column is None:
+      continue
+
+    leaseHours = int(leaseLength[:-2]) * _HOURS_PER_YEAR
+
+    amount = 0.0
+    for priceDimension in term["priceDimensions"].itervalues():
+      price = priceDimension["pricePerUnit"].get("USD")
+      if price is None:
+        break
+
+      if priceDimension["unit"] == "Hrs":
+        amount += float(price)
+      elif priceDimension["unit"] == "Quantity":
+        amount += float(price) / leaseHours
+      else:
+        break
+    else:
+      prices[column] = amount
+
+  return prices
+
 
 
 def buildLookupTable(offers):
@@ -63,84 +218,421 @@ def buildLookupTable(offers):
 
   :returns: dict; each property's key consists of (all lower-case):
     instance type, region, platform; and the value is a dict with key="USD" and
-    value is the amount per hour in US$. Example:
-    {("c1.medium", "ap-northeast-1", "rhel"): {"USD": 0.218}, ...}
+    value is the OnDemand amount per hour in US$, plus the effective amount
+    per hour of each Reserved Instance offering keyed by its name in
+    `RESERVED_PRICING_MODELS`. Example:
+    {("c1.medium", "ap-northeast-1", "rhel"):
+       {"USD": 0.218, "reserved1yrNoUpfront": 0.152, ...}, ...}
   """
   products = offers["products"]
 
   onDemandTerms = offers["terms"]["OnDemand"]
+  reservedTerms = offers["terms"].get("Reserved", {})
 
   priceMap = dict()
 
   for sku in products.itervalues():
-    if sku.get("productFamily") != "Compute Instance":
+    key = _getComputeInstanceKey(sku)
+    if key is None:
       continue
 
-    attributes = sku["attributes"]
+    # Find pricing
+    prices = _getReservedPrices(reservedTerms.get(sku["sku"], {}))
+    prices["USD"] = _getOnDemandPrice(onDemandTerms[sku["sku"]])
+    priceMap[key] = prices
 
-    regionName = str(attributes["location"])
 
-    if regionName == "AWS GovCloud (US)":
-      continue
+  return priceMap
 
-    instanceType = str(attributes["instanceType"])
 
-    operatingSystem = str(attributes["operatingSystem"]).lower()
 
-    skuId = sku["sku"]
+class _JsonStreamReader(object):
+  """Minimal pull-style JSON reader over a file object.
 
-    # Find pricing
-    terms = onDemandTerms[skuId]
+  Only the members being navigated are ever held in memory: objects can be
+  walked key-by-key with `iterObjectKeys`, while individual values are decoded
+  with `readValue` or discarded with `skipValue`.
+  """
 
-    if len(terms) != 1:
-      raise Exception("Unexpected number of terms != 1: {}".format(terms))
+  _NON_WHITESPACE = re.compile(r"[^ \t\n\r]")
+  _NUMBER_CHARS = "0123456789.eE+-"
+
+  def __init__(self, fp, chunkSize=(1 << 20)):
+    """
+    :param file fp: file-like object with a `read(size)` method
+    :param int chunkSize: number of bytes to read from `fp` at a time
+    """
+    self._fp = fp
+    self._chunkSize = chunkSize
+    self._buf = ""
+    self._pos = 0
+    self._eof = False
+    self._decoder = json.JSONDecoder()
+
+
+  def _fill(self):
+    """Read the next chunk into the buffer, dropping consumed data
+
+    :returns: False if the input is exhausted
+    """
+    if self._eof:
+      return False
+
+    chunk = self._fp.read(self._chunkSize)
+    if not chunk:
+      self._eof = True
+      return False
+
+    self._buf = self._buf[self._pos:] + chunk
+    self._pos = 0
+    return True
+
+
+  def _peek(self):
+    """Skip whitespace and return the next character without consuming it"""
+    while True:
+      match = self._NON_WHITESPACE.search(self._buf, self._pos)
+      if match is not None:
+        self._pos = match.start()
+        return self._buf[self._pos]
+
+      self._pos = len(self._buf)
+      if not self._fill():
+        raise ValueError("Unexpected end of JSON stream")
+
+
+  def _expect(self, char):
+    if self._peek() != char:
+      raise ValueError("Expected {!r} at offset {} but found {!r}".format(
+        char, self._pos, self._buf[self._pos]))
+    self._pos += 1
+
+
+  def readValue(self):
+    """Decode and return the next complete JSON value"""
+    self._peek()
+
+    while True:
+      try:
+        value, end = self._decoder.raw_decode(self._buf, self._pos)
+      except ValueError:
+        if not self._fill():
+          raise
+        continue
+
+      # A number that ends at the end of the buffer, or that stops short of a
+      # fraction/exponent, may continue in the next chunk
+      if (not self._eof and
+          (end == len(self._buf) or
+           (isinstance(value, (int, long, float)) and
+            self._buf[end] in self._NUMBER_CHARS))):
+        self._fill()
+        continue
+
+      self._pos = end
+      return value
+
+
+  def iterObjectKeys(self):
+    """Consume a JSON object member-by-member
+
+    Yields each member's key; the caller must consume the member's value (via
+    `readValue`, `skipValue` or a nested `iterObjectKeys`) before advancing.
+    """
+    self._expect("{")
+
+    first = True
+    while True:
+      char = self._peek()
+      if char == "}":
+        self._pos += 1
+        return
+
+      if not first:
+        self._expect(",")
+      first = False
+
+      key = self.readValue()
+      self._expect(":")
+
+      yield key
+
+
+  def skipValue(self, depth=1):
+    """Consume the next JSON value
+
+    :param int depth: number of levels of nested containers to walk
+      member-by-member; values below that depth are decoded whole and
+      discarded, which is much faster for the small per-SKU objects of the
+      offers file
+    """
+    char = self._peek()
+
+    if depth <= 0:
+      self.readValue()
+    elif char == "{":
+      for _ in self.iterObjectKeys():
+        self.skipValue(depth - 1)
+    elif char == "[":
+      self._pos += 1
+      first = True
+      while self._peek() != "]":
+        if not first:
+          self._expect(",")
+        first = False
+        self.skipValue(depth - 1)
+      self._pos += 1
+    else:
+      self.readValue()
+
+
+
+def buildLookupTableFromStream(fp):
+  """Build lookup table of instance prices by streaming over the offers file.
+
+  Unlike `buildLookupTable`, the offers document is never fully loaded; only
+  the keys of Compute Instance SKUs and their OnDemand and Reserved prices are
+  retained, so peak memory is independent of the size of the offers file. All
+  term types are extracted in the same pass.
+
+  :param file fp: file-like object positioned at the start of an AmazonEC2
+    offers JSON document
+
+  :returns: lookup table in the same format as returned by `buildLookupTable`
+  """
+  reader = _JsonStreamReader(fp)
+
+  # skuId -> price table key for the Compute Instance SKUs we track
+  skuKeys = None
 
-    term = terms.values()[0]
+  # skuId -> amount per hour in US$
+  onDemandPrices = dict()
 
-    priceDimensions = term["priceDimensions"]
+  # skuId -> {price column -> effective amount per hour in US$}
+  reservedPrices = dict()
 
-    if len(priceDimensions) != 1:
-      raise Exception("Unexpected number of priceDimensions != 1: {}".format(
-        priceDimensions))
+  for section in reader.iterObjectKeys():
+    if section == "products":
+      skuKeys = dict()
+      for skuId in reader.iterObjectKeys():
+        key = _getComputeInstanceKey(reader.readValue())
+        if key is not None:
+          skuKeys[skuId] = key
 
-    priceDimension = priceDimensions.values()[0]
+    elif section == "terms":
+      for termType in reader.iterObjectKeys():
+        if termType == "OnDemand":
+          prices, getPrices = onDemandPrices, _getOnDemandPrice
+        elif termType == "Reserved":
+          prices, getPrices = reservedPrices, _getReservedPrices
+        else:
+          reader.skipValue()
+          continue
 
-    pricesPerUnit = priceDimension["pricePerUnit"]
+        for skuId in reader.iterObjectKeys():
+          if skuKeys is not None and skuId not in skuKeys:
+            reader.skipValue()
+            continue
 
-    if len(pricesPerUnit) != 1:
-      raise Exception(
-        "Unexpected number of pricesPerUnit != 1 in rateCode={}: {}".format(
-          priceDimension["rateCode"], pricesPerUnit))
+          prices[skuId] = getPrices(reader.readValue())
 
-    currency, amount = pricesPerUnit.items()[0]
-    if currency != "USD":
-      raise Exception("Unexpected currency {} in rateCode {}".format(
-        currency, priceDimension["rateCode"]))
+    else:
+      reader.skipValue()
 
-    key = (instanceType, _REGION_NAME_TO_REGION[regionName], operatingSystem)
-    priceMap[key] = {
-      "USD": float(amount)
-    }
+  if skuKeys is None:
+    raise Exception("No products found in offers")
 
+  priceMap = dict()
+  for skuId, key in skuKeys.iteritems():
+    prices = reservedPrices.get(skuId, {})
+    prices["USD"] = onDemandPrices[skuId]
+    priceMap[key] = prices
 
   return priceMap
 
 
 
-def dump(fp, offersUrl=_DEFAULT_OFFERS_URL):
+def _openIfChanged(url, validators=None):
+  """Open a URL unless its content is unchanged since it was last fetched
+
+  :param str url: Internet URL (https://...) or absolute file path
+    (file:///...)
+  :param dict validators: {"etag": ..., "lastModified": ...} as returned by a
+    previous call for the same URL, or None
+
+  :returns: two-tuple (response, validators); response is None if the content
+    has not changed, in which case validators are the ones passed in
+  """
+  # urllib2 pulls in most of the network stack, so it is only imported by the
+  # runs that actually fetch offers
+  import urllib2
+
+  request = urllib2.Request(url)
+  if validators:
+    if validators.get("etag"):
+      request.add_header("If-None-Match", validators["etag"])
+    if validators.get("lastModified"):
+      request.add_header("If-Modified-Since", validators["lastModified"])
+
+  try:
+    response = urllib2.urlopen(request, timeout=300)
+  except urllib2.HTTPError as e:
+    if e.code == 304:
+      return None, validators
+    raise
+
+  headers = response.info()
+  newValidators = {
+    "etag": headers.getheader("ETag"),
+    "lastModified": headers.getheader("Last-Modified")
+  }
+
+  # file:// URLs and some servers ignore conditional headers, so compare the
+  # validators ourselves before reading the body
+  if validators and any(newValidators.values()) and newValidators == validators:
+    response.close()
+    return None, validators
+
+  return response, newValidators
+
+
+
+def fetchLookupTable(offersUrl=_DEFAULT_OFFERS_URL, streaming=True,
+                     validators=None):
+  """Download the offers table and build the lookup table of instance prices,
+  unless the offers are unchanged since they were last fetched
+
+  :param str offersUrl: AmazonEC2 pricing offers URL, which may be an Internet
+    URL (https://...) or an absolute file path (file:///...).
+  :param bool streaming: parse the offers incrementally with
+    `buildLookupTableFromStream` instead of loading the whole document into
+    memory.
+  :param dict validators: ETag/Last-Modified validators returned by a
+    previous call; None to fetch unconditionally
+
+  :returns: two-tuple (priceMap, validators); priceMap is a lookup table as
+    returned by `buildLookupTable`, or None if the offers have not changed.
+  """
+  response, validators = _openIfChanged(offersUrl, validators)
+  if response is None:
+    return None, validators
+
+  if streaming:
+    priceMap = buildLookupTableFromStream(response)
+  else:
+    priceMap = buildLookupTable(json.loads(response.read()))
+
+  return priceMap, validators
+
+
+
+def fetchRegionalLookupTable(regions, regionIndexUrl=_DEFAULT_REGION_INDEX_URL,
+                             versions=None, previousTable=None):
+  """Build the lookup table from the per-region offer files of only the given
+  regions, re-downloading just the regions whose offers have a new version
+
+  :param regions: region names, e.g. ["us-east-1", "us-west-2"]
+  :param str regionIndexUrl: URL of the AmazonEC2 region index, which maps
+    each region to the URL of its current offer file (resolved relative to the
+    index URL)
+  :param dict versions: region -> offer file URL as returned by a previous
+    call; regions with the same URL are taken from `previousTable`
+  :param previousTable: lookup table built with `versions`, as returned by
+    this function, `load` or `loadBinary`
+
+  :returns: two-tuple (priceMap, versions); priceMap is a lookup table as
+    returned by `buildLookupTable`, or None if no region's offers have
+    changed.
+  """
+  import urllib2
+  import urlparse
+
+  regionIndex = json.load(urllib2.urlopen(regionIndexUrl, timeout=300))
+
+  if previousTable is None:
+    versions = None
+  versions = versions or {}
+
+  newVersions = {}
+  changedRegions = set()
+  for region in regions:
+    try:
+      versionUrl = regionIndex["regions"][region]["currentVersionUrl"]
+    except KeyError:
+      raise Exception("Region {} not found in {}".format(region,
+                                                        regionIndexUrl))
+
+    newVersions[region] = urlparse.urljoin(regionIndexUrl, versionUrl)
+    if versions.get(region) != newVersions[region]:
+      changedRegions.add(region)
+
+  if not changedRegions and set(versions) == set(newVersions):
+    return None, versions
+
+  priceMap = dict()
+  if previousTable is not None:
+    for key, value in previousTable.iteritems():
+      if key[1] in newVersions and key[1] not in changedRegions:
+        priceMap[key] = value
+
+  for region in sorted(changedRegions):
+    response = urllib2.urlopen(newVersions[region], timeout=300)
+    priceMap.update(buildLookupTableFromStream(response))
+
+  return priceMap, newVersions
+
+
+
+def dump(fp, offersUrl=_DEFAULT_OFFERS_URL, streaming=True,
+         outputFormat="json", regions=None,
+         regionIndexUrl=_DEFAULT_REGION_INDEX_URL):
   """Download the offers table fromt he given URL, extract the instance pricing
-  info and dump to a file in a format that may be retrieved with `load`
+  info and dump to a file in a format that may be retrieved with `load` (JSON)
+  or `loadBinary` (binary)
 
   :params file fp: file object for writing the instance pricing dump.
   :param str offersUrl: AmazonEC2 pricing offers URL, which may be an Internet "
     "URL (https://...) or an absolute file path (file:///...).
+  :param bool streaming: parse the offers incrementally with
+    `buildLookupTableFromStream` instead of loading the whole document into
+    memory.
+  :param str outputFormat: "json" or "binary"
+  :param regions: if given, build the table from only these regions' offer
+    files, located via `regionIndexUrl`, instead of from `offersUrl`
+  :param str regionIndexUrl: AmazonEC2 region index URL
+  """
+  if regions:
+    priceMap, _ = fetchRegionalLookupTable(regions, regionIndexUrl)
+  else:
+    priceMap, _ = fetchLookupTable(offersUrl, streaming=streaming)
+
+  writeTable(priceMap, fp, outputFormat)
+
+
+
+def writeTable(priceMap, fp, outputFormat="json"):
+  """Write a lookup table with `dumpJson` or `dumpBinary`
+
+  :param priceMap: lookup table as returned by `buildLookupTable`
+  :params file fp: file object for writing the instance pricing dump.
+  :param str outputFormat: "json" or "binary"
   """
-  # Load the offers table
-  response = urllib2.urlopen(offersUrl, timeout=300)
-  offers = json.loads(response.read())
+  if outputFormat == "binary":
+    dumpBinary(priceMap, fp)
+  else:
+    dumpJson(priceMap, fp)
+
+
+
+def dumpJson(priceMap, fp):
+  """Write a lookup table to a file in the JSON format read by `load`
 
+  :param priceMap: lookup table as returned by `buildLookupTable`, `load` or
+    `loadBinary`
+  :params file fp: file object for writing the instance pricing dump.
+  """
   # Convert map to list, because json can't handle our multi-item keys
-  mapAsList = sorted(buildLookupTable(offers).iteritems())
+  mapAsList = sorted(priceMap.iteritems())
 
   json.dump(mapAsList, fp, indent=4)
 
@@ -152,11 +644,8 @@ def load(fp):
   :params file fp: file object for reading JSON dump created by this
     tool.
 
-  :returns: dict; each property's key consists of (all lower-case):
-    instance type, region, platform; and the value is a dict with key="USD" and
-    value is the amount per hour in US$. Example:
-    {("c1.medium", "ap-northeast-1", "rhel"): {"USD": 0.218}, ...}
-
+  :returns: lookup table in the same format as returned by
+    `buildLookupTable`
   """
   return {
     tuple(key) : value for key, value in json.load(fp)
@@ -164,6 +653,234 @@ def load(fp):
 
 
 
+def dumpBinary(priceMap, fp):
+  """Write a lookup table to a file in the compact binary format read by
+  `loadBinary`.
+
+  Layout (all integers little-endian):
+
+    header: magic "BRPT", format version, and the number of instance types,
+      regions, platforms and price entries
+    three string tables (instance types, regions, platforms), each a sorted
+      sequence of length-prefixed UTF-8 strings; a string's index in its table
+      is its code
+    the number of price columns, and a table of their names in the same
+      format
+    price entries sorted by (instance type, region, platform) code, each a
+      fixed-width record of the three codes followed by the US$ hourly price
+      in each column; NaN where the instance has no such price
+
+  Version 1 tables, which have only the "USD" column and no column table, can
+  still be read.
+
+  :param priceMap: lookup table as returned by `buildLookupTable` or `load`
+  :params file fp: file object, opened in binary mode, for writing the dump.
+  """
+  stringTables = [sorted(set(key[i] for key in priceMap)) for i in xrange(3)]
+  codeMaps = [{value: code for code, value in enumerate(table)}
+              for table in stringTables]
+
+  fp.write(_BINARY_HEADER.pack(_BINARY_MAGIC, _BINARY_VERSION,
+                               *([len(table) for table in stringTables] +
+                                 [len(priceMap)])))
+
+  for table in stringTables:
+    _writeStringTable(table, fp)
+
+  fp.write(_BINARY_COLUMN_COUNT.pack(len(_BINARY_COLUMNS)))
+  _writeStringTable(_BINARY_COLUMNS, fp)
+
+  entryStruct = _getEntryStruct(len(_BINARY_COLUMNS))
+  entries = sorted(
+    (tuple(codeMaps[i][key[i]] for i in xrange(3)),
+     tuple(value.get(column, _MISSING_PRICE) for column in _BINARY_COLUMNS))
+    for key, value in priceMap.iteritems())
+
+  for codes, prices in entries:
+    fp.write(entryStruct.pack(*(codes + prices)))
+
+
+
+def _writeStringTable(table, fp):
+  for value in table:
+    encoded = value.encode("utf-8")
+    fp.write(_BINARY_STRING_LENGTH.pack(len(encoded)))
+    fp.write(encoded)
+
+
+
+def _getEntryStruct(numColumns):
+  """Struct of a binary price table entry: three codes and the prices"""
+  return struct.Struct("<HHH" + "d" * numColumns)
+
+
+
+class BinaryPriceTable(object):
+  """Read-only, memory-mapped view of a price table written by `dumpBinary`.
+
+  Only the small string tables are decoded when the table is opened; price
+  entries stay in the mapped file and are found by binary search, so opening
+  the table costs next to nothing regardless of its size. Lookups return the
+  same values as the dict returned by `load`.
+  """
+
+  def __init__(self, fp):
+    """
+    :params file fp: file object for reading a dump created by `dumpBinary`;
+      the table remains valid after `fp` is closed.
+    """
+    self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header = _BINARY_HEADER.unpack_from(self._mm, 0)
+    if header[0] != _BINARY_MAGIC or header[1] not in (1, _BINARY_VERSION):
+      raise ValueError("Not a price table of version {}: {!r}".format(
+        _BINARY_VERSION, header[:2]))
+
+    counts = header[2:5]
+    self._numEntries = header[5]
+
+    offset = _BINARY_HEADER.size
+    self._stringTables = []
+    for count in counts:
+      table, offset = self._readStringTable(count, offset)
+      self._stringTables.append(table)
+
+    if header[1] == 1:
+      self.columns = _BINARY_V1_COLUMNS
+    else:
+      count, = _BINARY_COLUMN_COUNT.unpack_from(self._mm, offset)
+      columns, offset = self._readStringTable(
+        count, offset + _BINARY_COLUMN_COUNT.size)
+      self.columns = tuple(columns)
+
+    self._usdIndex = 3 + self.columns.index("USD")
+    self._entry = _getEntryStruct(len(self.columns))
+    self._codeMaps = [{value: code for code, value in enumerate(table)}
+                      for table in self._stringTables]
+    self._entriesOffset = offset
+
+
+  def _readStringTable(self, count, offset):
+    """:returns: two-tuple (list of strings, offset past the table)"""
+    table = []
+    for _ in xrange(count):
+      length, = _BINARY_STRING_LENGTH.unpack_from(self._mm, offset)
+      offset += _BINARY_STRING_LENGTH.size
+      table.append(str(self._mm[offset:offset + length].decode("utf-8")))
+      offset += length
+    return table, offset
+
+
+  def _entryCodes(self, index):
+    return _BINARY_ENTRY_CODES.unpack_from(
+      self._mm, self._entriesOffset + index * self._entry.size)
+
+
+  def _findEntry(self, key):
+    """Binary search for a key
+
+    :returns: the unpacked entry, or None if the key is not in the table
+    """
+    try:
+      codes = tuple(self._codeMaps[i][key[i]] for i in xrange(3))
+    except KeyError:
+      return None
+
+    lo = 0
+    hi = self._numEntries
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._entryCodes(mid) < codes:
+        lo = mid + 1
+      else:
+        hi = mid
+
+    if lo == self._numEntries or self._entryCodes(lo) != codes:
+      return None
+
+    return self._entry.unpack_from(
+      self._mm, self._entriesOffset + lo * self._entry.size)
+
+
+  def _toPrices(self, entry):
+    """Convert an unpacked entry's prices to a dict, omitting missing ones"""
+    return {column: price
+            for column, price in zip(self.columns, entry[3:])
+            if not math.isnan(price)}
+
+
+  def getPrice(self, key):
+    """Look up the hourly US$ OnDemand price for a key
+
+    :param tuple key: (instance type, region, platform)
+
+    :returns: float price, or None if the key is not in the table
+    """
+    entry = self._findEntry(key)
+    if entry is None:
+      return None
+    return entry[self._usdIndex]
+
+
+  def get(self, key, default=None):
+    """Look up all prices of a key with a single search
+
+    :returns: dict of price column -> hourly US$ price, or `default` if the
+      key is not in the table
+    """
+    entry = self._findEntry(key)
+    if entry is None:
+      return default
+    return self._toPrices(entry)
+
+
+  def __contains__(self, key):
+    return self._findEntry(key) is not None
+
+
+  def __getitem__(self, key):
+    value = self.get(key)
+    if value is None:
+      raise KeyError(key)
+    return value
+
+
+  def __len__(self):
+    return self._numEntries
+
+
+  def __iter__(self):
+    for key, _ in self.iteritems():
+      yield key
+
+
+  def iteritems(self):
+    """Yield (key, {price column: price}) pairs in key order"""
+    types, regions, platforms = self._stringTables
+    for index in xrange(self._numEntries):
+      entry = self._entry.unpack_from(
+        self._mm, self._entriesOffset + index * self._entry.size)
+      yield ((types[entry[0]], regions[entry[1]], platforms[entry[2]]),
+             self._toPrices(entry))
+
+
+  def close(self):
+    self._mm.close()
+
+
+
+def loadBinary(fp):
+  """Open a lookup table of instance prices written by `dumpBinary`.
+
+  :params file fp: file object for reading a binary dump created by this tool.
+
+  :returns: BinaryPriceTable, which supports the same lookups as the dict
+    returned by `load`.
+  """
+  return BinaryPriceTable(fp)
+
+
+
 def main():
   """Get AmazonEC2 offers URL from command-line options, load the offers table,
   parse it, and dump to stdout
@@ -179,12 +896,44 @@ def main():
     "(https://...) or an absolute file path (file:///...). Amazon's URL for "
     "retrieving the current AmazonEC2 offers is {}".format(_DEFAULT_OFFERS_URL))
 
+  parser.add_argument(
+    "--no-streaming", action="store_false",
+    dest="streaming",
+    help="Load the entire offers document into memory before parsing it "
+    "instead of streaming over it.")
+
+  parser.add_argument(
+    "--format", choices=("json", "binary"), required=False,
+    default="json",
+    dest="outputFormat",
+    help="Output format: JSON as read by `load`, or the compact binary format "
+    "read by `loadBinary`. (default: %(default)s)")
+
+  parser.add_argument(
+    "--regions", type=str, required=False,
+    metavar="REGION[,REGION...]",
+    help="Build the table from only these regions' offer files, located via "
+    "--region-index-url, instead of from --url.")
+
+  parser.add_argument(
+    "--region-index-url", type=str, required=False,
+    default=_DEFAULT_REGION_INDEX_URL,
+    metavar="EC2_REGION_INDEX_URL",
+    dest="regionIndexUrl",
+    help="AmazonEC2 region index URL, which may be an Internet URL "
+    "(https://...) or an absolute file path (file:///...). "
+    "(default: %(default)s)")
+
   args = parser.parse_args()
 
-  dump(sys.stdout, args.offersUrl)
+  dump(sys.stdout, args.offersUrl, streaming=args.streaming,
+       outputFormat=args.outputFormat,
+       regions=args.regions.split(",") if args.regions else None,
+       regionIndexUrl=args.regionIndexUrl)
 
-  # Add a newline
-  sys.stdout.write("\n")
+  if args.outputFormat == "json":
+    # Add a newline
+    sys.stdout.write("\n")
 
 
 
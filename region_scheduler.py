@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Adaptive polling schedule of EC2 regions.
+
+A region whose instances changed since its last poll is polled again on the
+next collection. Each poll that finds it unchanged doubles the time until its
+next poll, up to a maximum that is short for regions with instances and long
+for empty regions. Regions that fail, e.g. because they reject our
+credentials, back off the same way unless they are known to have instances.
+Between polls, a region's last data is carried forward.
+
+API calls and collection time thus follow the regions actually in use rather
+than the number of regions AWS has. The schedule is persisted, so it also
+applies across cron-driven runs.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+
+_DEFAULT_MIN_INTERVAL_SEC = 60
+_DEFAULT_MAX_ACTIVE_INTERVAL_SEC = 900
+_DEFAULT_MAX_IDLE_INTERVAL_SEC = 6 * 3600
+
+# Fraction of its interval by which a region may be polled early, so that a
+# collection running on a fixed cadence doesn't narrowly miss a due region
+_EARLY_POLL_FRACTION = 0.1
+
+
+
+def _fromJson(value):
+  """Convert the unicode strings of decoded JSON back to str"""
+  if isinstance(value, unicode):
+    return str(value)
+  if isinstance(value, dict):
+    return {_fromJson(key): _fromJson(item) for key, item in value.iteritems()}
+  if isinstance(value, list):
+    return [_fromJson(item) for item in value]
+  return value
+
+
+
+def _hasChanged(previous, data):
+  return (previous is None or
+          previous["numberRunningInstances"] !=
+          data["numberRunningInstances"] or
+          previous["numberStoppedInstances"] !=
+          data["numberStoppedInstances"] or
+          round(previous["burnrate"], 6) != round(data["burnrate"], 6))
+
+
+
+class RegionScheduler(object):
+  """Decides which regions a collection polls, and carries forward the data
+  of the others"""
+
+  def __init__(self, path=None, minInterval=_DEFAULT_MIN_INTERVAL_SEC,
+               maxActiveInterval=_DEFAULT_MAX_ACTIVE_INTERVAL_SEC,
+               maxIdleInterval=_DEFAULT_MAX_IDLE_INTERVAL_SEC):
+    """
+    :param str path: file the schedule is persisted to, or None to keep it in
+      memory only
+    :param float minInterval: seconds until the next poll of a region that
+      was found unchanged once
+    :param float maxActiveInterval: maximum seconds between polls of a region
+      with instances
+    :param float maxIdleInterval: maximum seconds between polls of an empty or
+      failing region
+    """
+    self._path = path
+    self.minInterval = minInterval
+    self.maxActiveInterval = maxActiveInterval
+    self.maxIdleInterval = maxIdleInterval
+
+    # Region name -> {"interval": seconds, "nextPollAt": time,
+    #                 "numInstances": count at the last successful poll,
+    #                 "data": data of the last poll, None if it failed}
+    self._regions = {}
+
+    if path is not None and os.path.exists(path):
+      with open(path) as fp:
+        self._regions = _fromJson(json.load(fp))
+
+
+  def isDue(self, regionName, now=None):
+    """Whether a region should be polled; unknown regions always are"""
+    if now is None:
+      now = time.time()
+
+    state = self._regions.get(regionName)
+    if state is None:
+      return True
+
+    return now >= state["nextPollAt"] - state["interval"] * _EARLY_POLL_FRACTION
+
+
+  def getCarriedForward(self, regionName):
+    """Return the data of a region's last poll, or None if it failed"""
+    state = self._regions.get(regionName)
+    return state["data"] if state is not None else None
+
+
+  def recordSuccess(self, regionName, data, now=None):
+    """Schedule the next poll of a region after a successful one
+
+    :param dict data: as returned by `calculate_burn_rate._getRegionData`
+    """
+    if now is None:
+      now = time.time()
+
+    state = self._regions.get(regionName)
+    if state is None or _hasChanged(state["data"], data):
+      interval = 0
+    else:
+      interval = self._backOff(state["interval"], data["numberAllInstances"])
+
+    self._regions[regionName] = {"interval": interval,
+                                 "nextPollAt": now + interval,
+                                 "numInstances": data["numberAllInstances"],
+                                 "data": data}
+
+
+  def recordFailure(self, regionName, now=None):
+    """Schedule the next poll of a region after a failed or timed out one"""
+    if now is None:
+      now = time.time()
+
+    state = self._regions.get(regionName)
+    numInstances = state["numInstances"] if state is not None else 0
+
+    if numInstances:
+      # We need this region's data, so keep trying
+      interval = 0
+    else:
+      interval = self._backOff(state["interval"] if state is not None else 0,
+                               numInstances)
+
+    self._regions[regionName] = {"interval": interval,
+                                 "nextPollAt": now + interval,
+                                 "numInstances": numInstances,
+                                 "data": None}
+
+
+  def _backOff(self, interval, numInstances):
+    maxInterval = (self.maxActiveInterval if numInstances
+                   else self.maxIdleInterval)
+    return min(max(interval * 2, self.minInterval), maxInterval)
+
+
+  def save(self):
+    if self._path is None:
+      return
+
+    # Write to a temp file first, then move into place, to minimize window for
+    # corruption
+    tempFd, tempPath = tempfile.mkstemp(dir=os.path.dirname(self._path),
+                                        suffix=".burnrate_schedule")
+    with os.fdopen(tempFd, "w") as fp:
+      json.dump(self._regions, fp)
+
+    shutil.move(tempPath, self._path)
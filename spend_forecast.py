@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Forecast of the spend of running instances over the next hours.
+
+Instances are billed by the hour from their launch, each hour when it starts.
+Whether an instance starts a new billing hour within a horizon thus depends on
+how far through its current hour it is, i.e. on the minute of the hour it was
+launched at. Instances are counted by launch minute when they are listed, and
+each launch minute's hourly spend is kept in a 60-element array, so that the
+forecast for any horizon is computed over that array rather than over the
+instances. Instances are taken to have launched in the middle of their
+launch minute, and to keep running through the horizon.
+"""
+
+import array
+
+
+
+# Launch minutes counted; each covers this many seconds of the hour
+LAUNCH_BINS = 60
+_BIN_SEC = 3600 / LAUNCH_BINS
+
+# States of the instances that keep being billed
+BILLED_STATES = frozenset(("pending", "running"))
+
+# Name of the forecast metric
+FORECAST_METRIC = "forecastSpend"
+
+
+
+def getLaunchBin(launchTime):
+  """Return the launch minute of an instance
+
+  :param str launchTime: launch time as reported by DescribeInstances, e.g.
+    "2016-03-01T12:34:56.000Z"
+  """
+  return int(launchTime[14:16])
+
+
+
+def newLaunchSpend():
+  """Return an empty array of hourly spend by launch minute"""
+  return array.array("d", [0.0] * LAUNCH_BINS)
+
+
+
+def forecastSpend(launchSpend, horizonHours, now):
+  """Forecast the spend of instances over a horizon
+
+  :param launchSpend: sequence of the hourly spend of the instances by launch
+    minute, as built with `newLaunchSpend`
+  :param float horizonHours: length of the horizon in hours
+  :param float now: start of the horizon, in seconds since the epoch
+
+  :returns: US$ billed for the hours the instances start within the horizon
+  """
+  fullHours, remainder = divmod(horizonHours * 3600.0, 3600.0)
+
+  # Every instance starts a billing hour within each full hour of the
+  # horizon, and those at least (3600 - remainder) seconds into their current
+  # hour start one more within the remainder
+  spend = fullHours * sum(launchSpend)
+  secondOfHour = now % 3600
+  for launchBin, binSpend in enumerate(launchSpend):
+    elapsed = (secondOfHour - launchBin * _BIN_SEC - _BIN_SEC / 2.0) % 3600
+    if elapsed >= 3600 - remainder:
+      spend += binSpend
+
+  return spend
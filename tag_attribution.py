@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Attribution of the burn rate of running instances to the values of their
+tags, in bounded memory.
+
+Each tag key keeps a Space-Saving summary of a fixed multiple of `maxValues`
+tag values: a value that isn't tracked replaces the tracked value with the
+lowest burn rate, and starts from that value's burn rate. The values with the
+highest burn rates are thus kept however many distinct values there are, and
+the `maxValues` highest are reported. Each reported value counts only the
+burn rate and instances added since it was last admitted, so that its figures
+are never overstated, and the remainder is reported as the "other" group. The
+groups of a tag key therefore always add up to the exact totals.
+"""
+
+import heapq
+import re
+
+
+
+DEFAULT_MAX_TAG_VALUES = 20
+
+# Group of the instances not attributed to any reported tag value
+OTHER_GROUP = "other"
+
+# Group of the instances that don't have the tag
+UNTAGGED_GROUP = "untagged"
+
+# Groups that tag values must not be reported as
+_RESERVED_GROUPS = frozenset((OTHER_GROUP, UNTAGGED_GROUP))
+
+# (metric name, key in the per-group dicts)
+TAG_METRICS = (
+  ("burnrate", "burnrate"),
+  ("runningInstances", "numberRunningInstances"),
+)
+
+# Tag values tracked per value reported; the extra values absorb the churn of
+# rare values, which keeps the reported ones from being evicted
+_TRACKED_PER_REPORTED = 4
+
+_METRIC_NAME_UNSAFE_RE = re.compile(r"[^A-Za-z0-9_\-]")
+
+
+
+def sanitizeTagName(name):
+  """Return a tag key or value as a single metric name component"""
+  return _METRIC_NAME_UNSAFE_RE.sub("_", name)
+
+
+
+def getTagGroup(value):
+  """Return the group of a tag value
+
+  Values that would collide with `OTHER_GROUP` or `UNTAGGED_GROUP`, and those
+  starting with "_", get a leading "_", so that no value is reported as one
+  of those groups, and values that differ stay apart.
+
+  :param str value: tag value, or None if the instance doesn't have the tag
+  """
+  if not value:
+    return UNTAGGED_GROUP
+
+  group = sanitizeTagName(value)
+  if group in _RESERVED_GROUPS or group.startswith("_"):
+    group = "_" + group
+  return group
+
+
+
+class _HeavyHitters(object):
+  """Space-Saving summary of the groups with the highest burn rates"""
+
+  def __init__(self, maxValues):
+    self._maxValues = maxValues
+    self._maxTracked = maxValues * _TRACKED_PER_REPORTED
+
+    # Group -> [estimated burn rate, burn rate inherited on admission,
+    #           instances since admission]
+    self._entries = {}
+
+    # (estimated burn rate, group) of each entry; an entry's heap key may lag
+    # behind its estimate, which only ever grows
+    self._heap = []
+
+    self.burnrate = 0.0
+    self.numRunning = 0
+
+
+  def add(self, group, price):
+    self.burnrate += price
+    self.numRunning += 1
+
+    entry = self._entries.get(group)
+    if entry is not None:
+      entry[0] += price
+      entry[2] += 1
+      return
+
+    inherited = 0.0
+    if len(self._entries) >= self._maxTracked:
+      inherited = self._evictMinimum()
+
+    self._entries[group] = [inherited + price, inherited, 1]
+    heapq.heappush(self._heap, (inherited + price, group))
+
+
+  def _evictMinimum(self):
+    """Drop the entry with the lowest estimate
+
+    :returns: its estimate
+    """
+    while True:
+      estimate, group = heapq.heappop(self._heap)
+      current = self._entries[group][0]
+      if current == estimate:
+        del self._entries[group]
+        return estimate
+      heapq.heappush(self._heap, (current, group))
+
+
+  def getGroups(self):
+    """
+    :returns: dict of group -> {"burnrate": ..., "numberRunningInstances": ...}
+      of the `maxValues` groups with the highest estimates and
+      `OTHER_GROUP`
+    """
+    groups = {}
+    otherBurnrate = self.burnrate
+    otherNumRunning = self.numRunning
+    top = heapq.nlargest(self._maxValues, self._entries.iteritems(),
+                         key=lambda (group, entry): (entry[0], group))
+    for group, (estimate, inherited, numRunning) in top:
+      groups[group] = {"burnrate": estimate - inherited,
+                       "numberRunningInstances": numRunning}
+      otherBurnrate -= estimate - inherited
+      otherNumRunning -= numRunning
+
+    groups[OTHER_GROUP] = {"burnrate": max(otherBurnrate, 0.0),
+                           "numberRunningInstances": otherNumRunning}
+    return groups
+
+
+
+class TagAttribution(object):
+  """Burn rate and running instances of one region by tag value, for each of
+  a set of tag keys"""
+
+  def __init__(self, tagKeys, maxValues=DEFAULT_MAX_TAG_VALUES):
+    """
+    :param tagKeys: tag keys to group by, e.g. ("team", "service")
+    :param int maxValues: maximum number of values reported per tag key,
+      besides `OTHER_GROUP`
+    """
+    self._sketches = {key: _HeavyHitters(maxValues) for key in tagKeys}
+
+
+  def add(self, tags, price):
+    """Attribute a running instance
+
+    :param dict tags: the instance's tags
+    :param float price: its hourly price
+    """
+    for key, sketch in self._sketches.iteritems():
+      sketch.add(getTagGroup(tags.get(key)), price)
+
+
+  def getData(self):
+    """
+    :returns: dict of tag key -> dict of group -> {"burnrate": ...,
+      "numberRunningInstances": ...}
+    """
+    return {key: sketch.getGroups()
+            for key, sketch in self._sketches.iteritems()}
+
+
+
+def mergeTagGroups(groupsList, maxValues=DEFAULT_MAX_TAG_VALUES):
+  """Sum the groups of one tag key, e.g. across regions, keeping the
+  `maxValues` groups with the highest burn rates and adding the others to
+  `OTHER_GROUP`
+
+  :param groupsList: iterable of dicts of group -> {"burnrate": ...,
+    "numberRunningInstances": ...} as returned by `TagAttribution.getData`
+
+  :returns: dict of the same form
+  """
+  merged = {}
+  for groups in groupsList:
+    for group, groupData in groups.iteritems():
+      mergedGroup = merged.setdefault(group,
+                                      {key: 0 for _, key in TAG_METRICS})
+      for _, key in TAG_METRICS:
+        mergedGroup[key] += groupData[key]
+
+  other = merged.pop(OTHER_GROUP, {key: 0 for _, key in TAG_METRICS})
+  ranked = sorted(merged.iteritems(),
+                  key=lambda (group, groupData): (-groupData["burnrate"],
+                                                  group))
+  for _, groupData in ranked[maxValues:]:
+    for _, key in TAG_METRICS:
+      other[key] += groupData[key]
+
+  merged = dict(ranked[:maxValues])
+  merged[OTHER_GROUP] = other
+  return merged
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Tests of calculate_burn_rate """
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _REPO_DIR)
+sys.path.insert(0, os.path.join(_REPO_DIR, "benchmarks"))
+
+import calculate_burn_rate
+from synthetic_data import FakeEC2Connection, FakeInstance, FakeRegion
+
+
+
+def _makeInstances(region, states):
+  return [FakeInstance("i-%08x" % i, state, "m1.small", region, None,
+                       "2016-03-01T12:34:56.000Z", region.name + "a", {})
+          for i, state in enumerate(states)]
+
+
+
+class IterInstancesTest(unittest.TestCase):
+
+  def testFollowsNextTokenAcrossPages(self):
+    region = FakeRegion("us-east-1")
+    instances = _makeInstances(region, ["running"] * 10)
+    conn = FakeEC2Connection(region, instances)
+
+    listed = list(calculate_burn_rate.iterInstances(conn, pageSize=3))
+
+    self.assertEqual([instance.id for instance in listed],
+                     [instance.id for instance in instances])
+    self.assertEqual(conn.numCalls, 4)
+
+
+  def testSkipsTerminatedInstances(self):
+    region = FakeRegion("us-east-1")
+    conn = FakeEC2Connection(region, _makeInstances(
+      region, ["running", "terminated", "stopped", "pending"]))
+
+    listed = list(calculate_burn_rate.iterInstances(conn))
+
+    self.assertEqual([instance.state for instance in listed],
+                     ["running", "stopped", "pending"])
+
+
+
+class CollectRegionalDataTest(unittest.TestCase):
+
+  def setUp(self):
+    for name in ("_getRegions", "_getRegionData"):
+      self.addCleanup(setattr, calculate_burn_rate, name,
+                      getattr(calculate_burn_rate, name))
+    self.addCleanup(setattr, calculate_burn_rate._PriceTable,
+                    "_priceTableSingleton",
+                    calculate_burn_rate._PriceTable._priceTableSingleton)
+    calculate_burn_rate._PriceTable._priceTableSingleton = {}
+
+
+  def testReplacedWorkerTakesNoMoreRegions(self):
+    regions = [FakeRegion("hung")] + [FakeRegion("region-%d" % i)
+                                      for i in xrange(9)]
+    lock = threading.Lock()
+    active = set()
+    maxActive = [0]
+
+    def getRegionData(region, *args):
+      if region.name == "hung":
+        time.sleep(0.5)
+        return {}
+
+      with lock:
+        active.add(region.name)
+        maxActive[0] = max(maxActive[0], len(active))
+      time.sleep(0.2)
+      with lock:
+        active.remove(region.name)
+      return {}
+
+    calculate_burn_rate._getRegions = lambda: regions
+    calculate_burn_rate._getRegionData = getRegionData
+
+    regionalData, failedRegions = calculate_burn_rate.collectRegionalData(
+      maxConcurrency=2, regionTimeout=0.3, credentials=("key", "secret"))
+
+    self.assertEqual(failedRegions.keys(), ["hung"])
+    self.assertEqual(len(regionalData), 9)
+    # Besides the abandoned region, never more than maxConcurrency at once
+    self.assertEqual(maxActive[0], 2)
+
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Tests of emission_filter and its use by the collector """
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import burnrate_collect_data
+from emission_filter import DeadbandFilter
+from grok_transport import GrokTransport, SocketConnection
+
+
+
+_RECORDS = [("burnrate.total", 10.0, 1456790400),
+            ("burnrate.us-east-1", 4.0, 1456790400)]
+
+
+
+def _getRefusingAddress():
+  """Return the address of a local port that refuses connections"""
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.bind(("127.0.0.1", 0))
+  address = sock.getsockname()
+  sock.close()
+  return address
+
+
+
+class _Options(object):
+  """Collector options of a cron run with --changeonly and no --journal"""
+
+  def __init__(self, emissionFile):
+    self.changeOnly = True
+    self.emissionFile = emissionFile
+    self.deadband = 0.0
+    self.deadbandRelative = 0.0
+    self.heartbeat = 3600
+    self.journal = ""
+    self.sendTimeout = 0.5
+    self.scale = 1
+    self.verbose = False
+
+
+
+class DeadbandFilterTest(unittest.TestCase):
+
+  def testCommittedValuesAreSuppressed(self):
+    emissionFilter = DeadbandFilter()
+    self.assertEqual(emissionFilter.filter(_RECORDS), _RECORDS)
+    emissionFilter.commit()
+
+    self.assertEqual(emissionFilter.filter(_RECORDS), [])
+
+
+  def testUncommittedValuesAreSentAgain(self):
+    emissionFilter = DeadbandFilter()
+    emissionFilter.filter(_RECORDS)
+
+    self.assertEqual(emissionFilter.filter(_RECORDS), _RECORDS)
+
+
+
+class SendMetricsToGrokTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tempDir)
+
+    self.address = _getRefusingAddress()
+    patches = {
+      "collectMetricBatch": lambda opt: list(_RECORDS),
+      "_writeHistory": lambda opt, records: None,
+      "_createTransport": lambda opt: GrokTransport(
+        SocketConnection(self.address), minBackoff=0.01, maxBackoff=0.01,
+        sendTimeout=opt.sendTimeout),
+    }
+    for name, value in patches.iteritems():
+      self.addCleanup(setattr, burnrate_collect_data, name,
+                      getattr(burnrate_collect_data, name))
+      setattr(burnrate_collect_data, name, value)
+
+    self.addCleanup(burnrate_collect_data._emissionFilters.clear)
+
+
+  def testFailedSendIsNotRememberedAsSent(self):
+    opt = _Options(os.path.join(self.tempDir, "emission.json"))
+    burnrate_collect_data.sendMetricsToGrok(opt)
+
+    # The next run starts from the emission file, as a run from cron would
+    burnrate_collect_data._emissionFilters.clear()
+    burnrate_collect_data.sendMetricsToGrok(opt)
+
+    emissionFilter = burnrate_collect_data._emissionFilters[opt.emissionFile]
+    self.assertEqual(emissionFilter.numSent, len(_RECORDS))
+    self.assertEqual(emissionFilter.numSuppressed, 0)
+
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Tests of grok_transport """
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from grok_transport import GrokTransport, SocketConnection
+
+
+
+def _getRefusingAddress():
+  """Return the address of a local port that refuses connections"""
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.bind(("127.0.0.1", 0))
+  address = sock.getsockname()
+  sock.close()
+  return address
+
+
+
+class _HungConnection(object):
+  """Connection whose connect hangs for a while and then fails"""
+
+  def __init__(self, hangSec):
+    self._hangSec = hangSec
+
+
+  def getSocket(self):
+    time.sleep(self._hangSec)
+    raise socket.error("Timed out")
+
+
+  def close(self):
+    pass
+
+
+
+class GrokTransportTest(unittest.TestCase):
+
+  def testCloseWithoutJournalReportsDroppedLines(self):
+    transport = GrokTransport(SocketConnection(_getRefusingAddress()),
+                              minBackoff=0.01, maxBackoff=0.01,
+                              sendTimeout=1.0)
+    transport.send("a.metric 1.0 1456790400\nb.metric 2.0 1456790400\n")
+
+    self.assertFalse(transport.close(timeout=0.5))
+    self.assertEqual(transport.linesSent, 0)
+    self.assertEqual(transport.linesDropped, 2)
+
+
+
+  def testCloseDuringHungConnectDropsBatch(self):
+    transport = GrokTransport(_HungConnection(1.0), sendTimeout=0.1)
+    transport.send("a.metric 1.0 1456790400\n")
+    time.sleep(0.1)
+
+    self.assertFalse(transport.close(timeout=0.1))
+    self.assertEqual(transport.linesSent, 0)
+    self.assertEqual(transport.linesDropped, 1)
+
+    # The sender gives the batch up when its connect fails
+    time.sleep(1.0)
+    self.assertEqual(transport.linesDropped, 1)
+
+
+  def testCloseDuringHungConnectJournalsBatch(self):
+    tempDir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tempDir)
+    journalPath = os.path.join(tempDir, "journal")
+
+    transport = GrokTransport(_HungConnection(1.0), journalPath=journalPath,
+                              sendTimeout=0.1)
+    transport.send("a.metric 1.0 1456790400\n")
+    time.sleep(0.1)
+
+    self.assertFalse(transport.close(timeout=0.1))
+    self.assertEqual(transport.linesJournaled, 1)
+    time.sleep(1.0)
+    with open(journalPath) as fp:
+      self.assertEqual(fp.read(), "a.metric 1.0 1456790400\n")
+
+
+
+if __name__ == "__main__":
+  unittest.main()
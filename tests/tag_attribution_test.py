@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# Copyright 2014-2016 Numenta Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+""" Tests of tag_attribution """
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tag_attribution import OTHER_GROUP, TagAttribution, UNTAGGED_GROUP
+
+
+
+class TagAttributionTest(unittest.TestCase):
+
+  def testValuesNamedLikeReservedGroupsAddUpToTotals(self):
+    attribution = TagAttribution(["team"], maxValues=5)
+    for value, price in (("other", 1.0), ("untagged", 2.0), ("_other", 4.0),
+                         ("payments", 8.0), (None, 16.0)):
+      attribution.add({"team": value} if value else {}, price)
+
+    groups = attribution.getData()["team"]
+
+    self.assertEqual(groups["_other"]["burnrate"], 1.0)
+    self.assertEqual(groups["_untagged"]["burnrate"], 2.0)
+    self.assertEqual(groups["__other"]["burnrate"], 4.0)
+    self.assertEqual(groups[UNTAGGED_GROUP]["burnrate"], 16.0)
+    self.assertEqual(groups[OTHER_GROUP]["burnrate"], 0.0)
+    self.assertEqual(sum(group["burnrate"] for group in groups.itervalues()),
+                     31.0)
+    self.assertEqual(sum(group["numberRunningInstances"]
+                         for group in groups.itervalues()), 5)
+
+
+
+if __name__ == "__main__":
+  unittest.main()